@@ -1,170 +1,165 @@
-import time
 import asyncio
-import threading
 import discord
 import json
 from discord.ext import commands
-from flask import Flask, request, render_template, redirect, url_for
-from service_functions import add_new_order, add_order_reference_sql, update_order_status_sql, delete_order_sql, update_user_last_payment_date_sql
-from wayforpay import WayForPay
+from hypercorn.asyncio import serve
+from hypercorn.config import Config as HypercornConfig
+from quart import Quart, request, render_template, redirect, url_for
+from service_functions import add_new_order, delete_order_sql, apply_payment_sql
+from wayforpay import accept_response, new_order_reference
+import payment_client
+from payment_client import PLANS, get_plan, create_plan_invoice, delete_invoice
+from idempotency import seen_deliveries, delivery_key, body_fingerprint
+from notifications import paid_orders, payment_waiters
+from checkout import checkouts
+from invite_pool import InvitePool
+from gateway import bot
+from models import pool_metrics, dispose_engine
+from discord_bot import create_invite
+import config
 from config import *
-from scheduler import run_scheduler  # Import the scheduler
-
-app = Flask(__name__)
-
-# Main bot for invites and general functionality
-intents = discord.Intents.default()
-intents.members = True
-intents.message_content = True
-bot = commands.Bot(command_prefix="!", intents=intents)
-guild_invites = {}
-async def generate_invite() -> str:
-    await bot.wait_until_ready()
-    channel = bot.get_channel(invite_channel_id)
-    if channel is None:
-        raise Exception("Channel for generating invite not found. Check invite_channel_id in config.")
-    try:
-        invite = await channel.create_invite(max_uses=1, unique=True)
-        guild = channel.guild
-        if guild.id in guild_invites:
-            guild_invites[guild.id][invite.code] = invite.uses
-        else:
-            guild_invites[guild.id] = {invite.code: invite.uses}
-        return invite.url
-    except Exception as e:
-        raise Exception(f"Error creating invite: {e}")
 
-@app.route("/", methods=["GET"])
-def index():
-    return render_template("index.html")
+# The web app is served by hypercorn on the same event loop as the bot and the DB engine,
+# so handlers await Discord and the database directly instead of hopping threads
+app = Quart(__name__)
+WEB_BIND = getattr(config, 'WEB_BIND', '0.0.0.0:5000')
 
-@app.route("/payment_year", methods=["GET", "POST"])
-def payment_yearly():
-    if request.method == "GET":
-        return redirect(url_for("index"))
+# Checkout takes a ready invite from the pool and only calls Discord itself when it is empty
+invite_pool = InvitePool(create_invite)
 
-    email = request.form.get("email")
-    amount_value = COST_VALUE_YEARLY
-    sub_time = request.form.get('sub_time') or 365
-    currency = "USD"
-    sub_period = int(int(sub_time) / 30)
+async def get_checkout_invite():
+    """(code, url, expires_at) of the invite for a new order"""
+    entry = invite_pool.take()
+    if entry is None:
+        invite = await asyncio.wait_for(create_invite(), timeout=10)
+        entry = (invite.code, invite.url, int(invite.expires_at.timestamp()) if invite.expires_at else None)
+    return entry
 
-    if not email:
-        response = redirect(url_for("index"))
-        response.status_code = 400
-        return response
+@bot.listen('on_ready')
+async def start_invite_pool():
+    await invite_pool.start()
 
-    try:
-        future = asyncio.run_coroutine_threadsafe(generate_invite(), bot.loop)
-        invite_url = future.result(timeout=10)
-
-        future = asyncio.run_coroutine_threadsafe(
-            add_new_order(email, invite_url, amount_value, sub_time), 
-            bot.loop
-        )
-        order_id = future.result(timeout=10)
-
-        merchant_domain = "upworkrevolution.com"
-        wfp = WayForPay(MERCHANT_SECRET, merchant_domain)
-
-        invoice_result = wfp.create_yearly_invoice(
-            merchantAccount=MERCHANT_ID,
-            merchantAuthType="SimpleSignature",
-            amount=amount_value,
-            currency=currency,
-            productNames=["Оплата доступу до закритого Discord-каналу Community Upwork Revolution"],
-            productPrices=[amount_value],
-            productCounts=[1],
-            recurring="true",
-            subscriptionPeriod=f"{sub_period}"
-        )
-
-        order_reference = invoice_result.orderReference
-        
-        future = asyncio.run_coroutine_threadsafe(
-            add_order_reference_sql(order_id, order_reference), 
-            bot.loop
-        )
-        future.result(timeout=10)
+@app.before_serving
+async def warm_up_wayforpay():
+    # the shared client opens its connection now instead of on the first checkout
+    await payment_client.warm_up()
+
+@app.route("/", methods=["GET"])
+async def index():
+    return await render_template("index.html")
+
+async def release_checkout(invite_task, invoice_task, order_reference):
+    """Undo a checkout that produced no order: remove its invoice and return its invite to the pool"""
+    # both requests are left to finish first: a REMOVE_INVOICE sent while the invoice is
+    # still being created would arrive before it and leave the invoice payable
+    invite, _ = await asyncio.gather(invite_task, invoice_task, return_exceptions=True)
+    if not isinstance(invite, BaseException):
+        try:
+            await invite_pool.give_back(invite)
+        except Exception as e:
+            print(f"Error returning the invite of {order_reference} to the pool: {e}")
+    # the invoice may exist even if its request failed or timed out on our side
+    if not await delete_invoice(order_reference):
+        print(f"Could not remove invoice {order_reference}")
+
+checkout_cleanups = set()
+
+async def checkout_pipeline(job, email, plan):
+    """Invite and invoice concurrently, then the order is stored once with both"""
+    order_reference = new_order_reference()
+    invite_task = asyncio.ensure_future(job.timed("invite", get_checkout_invite()))
+    invoice_task = asyncio.ensure_future(job.timed("invoice", create_plan_invoice(plan, order_reference)))
+    stored = False
 
+    try:
+        # shielded, so neither request is cut off when the job times out; release_checkout waits for them
+        (_, invite_url, _), invoice_result = await asyncio.gather(asyncio.shield(invite_task),
+                                                                  asyncio.shield(invoice_task))
         if not invoice_result:
             raise Exception("Failed to create transaction via WayForPay")
 
-        return redirect(invoice_result.invoiceUrl)
-
-    except Exception as e:
-        print(f"Error creating yearly order: {e}")
-        response = redirect(url_for("index"))
-        response.status_code = 501
-        return response
-    
-@app.route("/payment", methods=["GET", "POST"])
-def payment():
+        order_id = await job.timed("order", add_new_order(email, invite_url, plan.amount, plan.sub_time, order_reference))
+        if order_id is None:
+            raise Exception("Failed to store the order")
+
+        stored = True
+        return invoice_result.invoiceUrl
+    finally:
+        if not stored:
+            # also runs when the job timed out and this is being cancelled, so the cleanup
+            # goes to the background instead of holding up the failed job
+            task = asyncio.create_task(release_checkout(invite_task, invoice_task, order_reference))
+            checkout_cleanups.add(task)
+            task.add_done_callback(checkout_cleanups.discard)
+
+async def start_checkout(plan):
     if request.method == "GET":
         return redirect(url_for("index"))
 
-    email = request.form.get("email")
-    amount_value = COST_VALUE
-    sub_time = request.form.get('sub_time') or 365
-    currency = "USD"
-    sub_period = int(int(sub_time) / 30)
+    form = await request.form
+    email = form.get("email")
 
     if not email:
         response = redirect(url_for("index"))
         response.status_code = 400
         return response
 
-    try:
-        future = asyncio.run_coroutine_threadsafe(generate_invite(), bot.loop)
-        invite_url = future.result(timeout=10)
-
-        future = asyncio.run_coroutine_threadsafe(
-            add_new_order(email, invite_url, amount_value, sub_time), 
-            bot.loop
-        )
-        order_id = future.result(timeout=10)
-
-        merchant_domain = "upworkrevolution.com"
-        wfp = WayForPay(MERCHANT_SECRET, merchant_domain)
-
-        invoice_result = wfp.create_invoice(
-            merchantAccount=MERCHANT_ID,
-            merchantAuthType="SimpleSignature",
-            amount=amount_value,
-            currency=currency,
-            productNames=["Оплата доступу до закритого Discord-каналу Community Upwork Revolution"],
-            productPrices=[amount_value],
-            productCounts=[1],
-            recurring="true",
-            subscriptionPeriod=f"{sub_period}"
-        )
-
-        order_reference = invoice_result.orderReference
-        
-        future = asyncio.run_coroutine_threadsafe(
-            add_order_reference_sql(order_id, order_reference), 
-            bot.loop
-        )
-        future.result(timeout=10)
+    # Answer right away; the status page follows the job until the invoice is ready
+    job = checkouts.start(lambda job: checkout_pipeline(job, email, plan))
+    return redirect(url_for("checkout_page", token=job.token), 303)
 
-        if not invoice_result:
-            raise Exception("Failed to create transaction via WayForPay")
+@app.route("/payment_year", methods=["GET", "POST"])
+async def payment_yearly():
+    return await start_checkout(PLANS["yearly"])
+    
+@app.route("/payment", methods=["GET", "POST"])
+async def payment():
+    return await start_checkout(PLANS["monthly"])
 
-        return redirect(invoice_result.invoiceUrl)
+@app.route("/payment/<plan_name>", methods=["GET", "POST"])
+async def payment_plan(plan_name):
+    plan = get_plan(plan_name)
+    if plan is None:
+        return redirect(url_for("index"))
+    return await start_checkout(plan)
 
-    except Exception as e:
-        print(f"Error creating order: {e}")
-        response = redirect(url_for("index"))
-        response.status_code = 501
-        return response
+@app.route("/checkout/<token>", methods=["GET"])
+async def checkout_page(token):
+    job = checkouts.get(token)
+    if job is None:
+        return redirect(url_for("index"))
+    if job.state == "ready":
+        return redirect(job.invoice_url)
+    return await render_template("checkout_pending.html", token=token, status=job.status())
+
+@app.route("/checkout/<token>/status", methods=["GET"])
+async def checkout_status(token):
+    """Long-poll: answers as soon as the job is finished, or after CHECKOUT_POLL_TIMEOUT"""
+    job = checkouts.get(token)
+    if job is None:
+        return {"state": "unknown"}, 404
+    return await checkouts.wait(job)
+
+@app.route("/metrics/checkout", methods=["GET"])
+async def checkout_metrics():
+    """Per-stage checkout latency (invite, invoice, order, total) over recent checkouts"""
+    return checkouts.stage_report()
 
 @app.route("/response", methods=["GET", "POST"])
-def response():
+async def response():
     return "Payment completed. Thank you!"
 
 @app.route("/callback_success", methods=["POST"])
-def callback_success():
-    form_data = request.form
+async def callback_success():
+    # WayForPay retries a callback until it gets a signed accept; a retry has the same body,
+    # so it is answered from the cache before any parsing or database work
+    body = await request.get_data()
+    fingerprint = body_fingerprint(body)
+    seen_reference = seen_deliveries.get(fingerprint)
+    if seen_reference is not None:
+        return accept_response(MERCHANT_SECRET, seen_reference)
+
+    form_data = await request.form
     
     json_str = ''
     keys = list(form_data.keys())
@@ -173,7 +168,7 @@ def callback_success():
         json_str = keys[0]
     else:
         # Try to get raw data
-        json_str = request.get_data(as_text=True)
+        json_str = body.decode("utf-8", errors="replace")
         if not json_str:
             return "No data", 400
 
@@ -186,47 +181,54 @@ def callback_success():
 
     print("Callback success - parsed_data:", parsed_data)
     
-    tx_status = parsed_data.get('transactionStatus')
-    if tx_status == "Declined":
-        print("Transaction declined")
-        return "OK", 200
-    
     order_reference = parsed_data.get("orderReference")
     print("order_reference:", order_reference)
 
     if not order_reference:
         return "orderReference not found", 400
+
+    tx_status = parsed_data.get('transactionStatus')
+    if tx_status == "Declined":
+        print("Transaction declined")
+        seen_deliveries.put(fingerprint, order_reference)
+        return accept_response(MERCHANT_SECRET, order_reference)
+
+    try:
+        key = delivery_key(parsed_data)
+    except (TypeError, ValueError):
+        print(f"Invalid processingDate in callback: {parsed_data.get('processingDate')!r}")
+        return "Invalid processingDate", 400
+
+    if key in seen_deliveries:
+        seen_deliveries.put(fingerprint, order_reference)
+        return accept_response(MERCHANT_SECRET, order_reference)
         
     user_email = parsed_data.get("email")
-    new_date = parsed_data.get("processingDate")
+    new_date = key[2] or None  # processingDate, already parsed into the delivery key
     
     try:
-        # Update user payment date if available
-        if user_email and new_date:
-            future = asyncio.run_coroutine_threadsafe(
-                update_user_last_payment_date_sql(user_email, new_date), 
-                bot.loop
-            )
-            result = future.result(timeout=10)
-            print(f"Updated payment date for {user_email}: {new_date}")
-        
-        # Update order status
-        future = asyncio.run_coroutine_threadsafe(
-            update_order_status_sql(order_reference, paid_order_status), 
-            bot.loop
-        )
-        result = future.result(timeout=10)
-        print(f"Updated order status for {order_reference}")
+        # User payment date, warning reset and order status in one transaction, together
+        # with the delivery record that makes a retried delivery a no-op
+        paid_order_id = await apply_payment_sql(order_reference, user_email, new_date, delivery_key=key)
+
+        # None is a duplicate delivery, False means there was no pending order to mark paid
+        if paid_order_id:
+            print(f"Applied payment for {order_reference}")
+            # Wake the mail service right away instead of waiting for its next sweep
+            paid_orders.publish(order_reference)
+            payment_waiters.resolve(paid_order_id)
         
     except Exception as e:
         print(f"Error updating database in callback_success: {e}")
         return "Database error", 500
 
-    return "OK", 200
+    seen_deliveries.put(fingerprint, order_reference)
+    seen_deliveries.put(key, order_reference)
+    return accept_response(MERCHANT_SECRET, order_reference)
 
 @app.route("/callback_failure", methods=["POST"])
-def callback_failure():
-    data = request.form if request.form else request.get_json()
+async def callback_failure():
+    data = (await request.form) or (await request.get_json(silent=True))
     if not data:
         return "No data", 400
 
@@ -235,11 +237,7 @@ def callback_failure():
         return "orderReference not found", 400
 
     try:
-        future = asyncio.run_coroutine_threadsafe(
-            delete_order_sql(order_reference), 
-            bot.loop
-        )
-        future.result(timeout=10)
+        await delete_order_sql(order_reference)
         print(f"Deleted failed order: {order_reference}")
     except Exception as e:
         print(f"Error deleting order in callback_failure: {e}")
@@ -247,32 +245,33 @@ def callback_failure():
 
     return "OK", 200
 
-def run_bot():
-    """Run the main Discord bot"""
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
+@app.route("/metrics/db", methods=["GET"])
+async def db_metrics():
+    """Connection pool usage: connections in use, overflow and checkout wait times"""
+    return pool_metrics.snapshot()
+
+@app.route("/metrics/wayforpay", methods=["GET"])
+async def wayforpay_metrics():
+    """Result of the last round trip to the WayForPay API"""
+    return payment_client.health()
+
+async def serve_web():
+    """Serve the web app on the running event loop"""
+    web_config = HypercornConfig()
+    web_config.bind = [WEB_BIND]
+    await serve(app, web_config)
+
+
+async def run_bot_and_web():
+    """Run the gateway bot (with all its cogs) and the web app together on one event loop"""
     try:
-        bot.run(bot_token)
-    except Exception as e:
-        print(f"Error running main bot: {e}")
+        async with bot:
+            await asyncio.gather(bot.start(bot_token), serve_web())
+    finally:
+        await payment_client.close_wayforpay()
+        await dispose_engine()
 
-def run_flask():
-    """Run Flask application"""
-    app.run(debug=True, use_reloader=False, host='0.0.0.0', port=5000)
 
 if __name__ == '__main__':
-    # Start the scheduler first
-    print("Starting scheduler...")
-    scheduler_thread = run_scheduler()
-    
-    # Start the main bot in a separate thread
-    bot_thread = threading.Thread(target=run_bot, daemon=True)
-    bot_thread.start()
-    print("Main bot thread started")
-    
-    # Small delay to ensure bots are starting up
-    time.sleep(2)
-    
-    # Run Flask in the main thread
-    print("Starting Flask application...")
-    run_flask()
\ No newline at end of file
+    print(f"Starting gateway bot and web application on {WEB_BIND}...")
+    asyncio.run(run_bot_and_web())
@@ -0,0 +1,55 @@
+"""
+Shared helpers for the benchmark scripts in this directory.
+
+The benchmarks import the application modules, so they need the usual config.py
+next to them. They never touch DATABASE_URL from the config: every script takes
+its own --database-url and points the models at that scratch database instead.
+"""
+
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DEFAULT_DATABASE_URL = "sqlite+aiosqlite:///benchmark.db"
+
+
+async def use_scratch_database(database_url, reset=True):
+    """Point the models at a scratch database and (re)create the schema"""
+    import models
+
+    models.use_database(database_url)
+    engine = models.get_engine()
+
+    async with engine.begin() as conn:
+        if reset:
+            await conn.run_sync(models.Base.metadata.drop_all)
+        await conn.run_sync(models.Base.metadata.create_all)
+    return engine
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def report(label, samples):
+    """Print p50/p99/mean of a list of durations in seconds"""
+    print(
+        f"{label:<40} n={len(samples):<6} "
+        f"p50={percentile(samples, 50) * 1000:8.3f}ms "
+        f"p99={percentile(samples, 99) * 1000:8.3f}ms "
+        f"mean={statistics.mean(samples) * 1000:8.3f}ms"
+    )
+
+
+async def timed(coro_factory, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await coro_factory()
+        samples.append(time.perf_counter() - start)
+    return samples
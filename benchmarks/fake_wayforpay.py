@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the WayForPay API (https://api.wayforpay.com/api).
+
+Implements CREATE_INVOICE, CHECK_STATUS and REMOVE_INVOICE closely enough for the
+client in wayforpay.py: request signatures are verified with the merchant secret and
+invoices are kept in memory. Point a client at it with api_url=http://127.0.0.1:8765/api.
+
+    python benchmarks/fake_wayforpay.py --port 8765 --secret <MERCHANT_SECRET> --latency 0.05
+"""
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import time
+
+from aiohttp import web
+
+
+class FakeWayForPay:
+    def __init__(self, secret, latency=0.0, default_status="Approved"):
+        self.secret = secret
+        self.latency = latency
+        self.default_status = default_status
+        self.invoices = {}
+        self.requests = 0
+        self.connections = set()
+
+    def sign(self, *parts):
+        data = ";".join(str(part) for part in parts)
+        return hmac.new(self.secret.encode("utf-8"), data.encode("utf-8"), hashlib.md5).hexdigest()
+
+    def expected_signature(self, params):
+        if params.get("transactionType") == "CREATE_INVOICE":
+            return self.sign(
+                params["merchantAccount"], params["merchantDomainName"], params["orderReference"],
+                params["orderDate"], params["amount"], params["currency"],
+                ";".join(map(str, params.get("productName", []))),
+                ";".join(map(str, params.get("productCount", []))),
+                ";".join(map(str, params.get("productPrice", []))),
+            )
+        return self.sign(params["merchantAccount"], params["orderReference"])
+
+    async def handle(self, request):
+        self.requests += 1
+        # remote port identifies the client connection, so this counts distinct TCP connections
+        self.connections.add(request.transport.get_extra_info("peername"))
+        params = json.loads(await request.text())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if params.get("merchantSignature") != self.expected_signature(params):
+            return web.json_response({"reason": "Invalid signature", "reasonCode": 1113})
+
+        transaction_type = params["transactionType"]
+        order_reference = params["orderReference"]
+
+        if transaction_type == "CREATE_INVOICE":
+            self.invoices[order_reference] = dict(params, transactionStatus=self.default_status,
+                                                  createdDate=int(time.time()))
+            return web.json_response({
+                "reason": "Ok",
+                "reasonCode": 1100,
+                "invoiceUrl": f"https://secure.wayforpay.com/invoice/{order_reference}",
+                "qrCode": f"https://secure.wayforpay.com/qr/{order_reference}",
+            })
+
+        if transaction_type == "CHECK_STATUS":
+            invoice = self.invoices.get(order_reference)
+            if invoice is None:
+                return web.json_response({"reason": "Order not found", "reasonCode": 1112,
+                                          "orderReference": order_reference})
+            processing_date = int(time.time())
+            status = invoice["transactionStatus"]
+            return web.json_response({
+                "reason": "Ok",
+                "reasonCode": 1100,
+                "orderReference": order_reference,
+                "amount": invoice["amount"],
+                "currency": invoice["currency"],
+                "createdDate": invoice["createdDate"],
+                "processingDate": processing_date,
+                "transactionStatus": status,
+                "merchantSignature": self.sign(invoice["merchantAccount"], order_reference, invoice["amount"],
+                                               invoice["currency"], "", "", status, 1100),
+            })
+
+        if transaction_type == "REMOVE_INVOICE":
+            self.invoices.pop(order_reference, None)
+            return web.json_response({"reason": "Ok", "reasonCode": 1100})
+
+        return web.json_response({"reason": "Unknown transactionType", "reasonCode": 1101}, status=400)
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post("/api", self.handle)
+        return app
+
+
+async def start_fake_server(secret, host="127.0.0.1", port=8765, **options):
+    """Start the fake API in the running loop; returns (FakeWayForPay, AppRunner)"""
+    fake = FakeWayForPay(secret, **options)
+    runner = web.AppRunner(fake.make_app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return fake, runner
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--secret", required=True)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to wait before answering")
+    parser.add_argument("--status", default="Approved", help="transactionStatus reported by CHECK_STATUS")
+    args = parser.parse_args()
+
+    fake = FakeWayForPay(args.secret, latency=args.latency, default_status=args.status)
+    web.run_app(fake.make_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Memory used by the Discord member cache with one gateway connection vs. one per bot.
+
+Before the shared gateway, start_all_services.py ran three bots with the same token
+(app_main, discord_bot, scheduler), each holding its own copy of the guild's member
+list. This builds those caches offline from synthetic GUILD_CREATE payloads, without
+connecting to Discord, and reports tracemalloc and RSS for both layouts.
+
+    python benchmarks/gateway_memory.py --members 20000
+"""
+
+import argparse
+import asyncio
+import gc
+import resource
+import tracemalloc
+
+import discord
+from discord.ext import commands
+
+
+def guild_payload(guild_id, members):
+    return {
+        "id": str(guild_id),
+        "name": "Upwork Revolution",
+        "owner_id": "1",
+        "roles": [{"id": str(guild_id), "name": "@everyone", "permissions": "0", "position": 0,
+                   "color": 0, "hoist": False, "managed": False, "mentionable": False}],
+        "channels": [],
+        "emojis": [],
+        "stickers": [],
+        "features": [],
+        "member_count": members,
+        "members": [
+            {
+                "user": {"id": str(10**17 + i), "username": f"member{i}", "discriminator": "0",
+                         "global_name": f"Member {i}", "avatar": None},
+                "roles": [],
+                "joined_at": "2024-01-01T00:00:00+00:00",
+                "deaf": False,
+                "mute": False,
+                "flags": 0,
+            }
+            for i in range(members)
+        ],
+    }
+
+
+def new_bot():
+    intents = discord.Intents.default()
+    intents.members = True
+    intents.message_content = True
+    return commands.Bot(command_prefix="!", intents=intents)
+
+
+def fill_cache(bot, payload):
+    """What the library does with GUILD_CREATE: a Guild plus a Member/User per member"""
+    state = bot._connection
+    guild = discord.Guild(data=payload, state=state)
+    state._add_guild(guild)
+    return guild
+
+
+def rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(label, bots, members):
+    gc.collect()
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    clients = [new_bot() for _ in range(bots)]
+    for client in clients:
+        fill_cache(client, guild_payload(1, members))
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    cached = sum(len(client.get_guild(1).members) for client in clients)
+    print(f"{label:<28} gateway sessions={bots}  cached members={cached:<7} "
+          f"heap={(current - start) / 2**20:8.1f}MB  peak={(peak - start) / 2**20:8.1f}MB  "
+          f"max RSS so far={rss_mb():7.1f}MB")
+    return clients, current - start
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--members", type=int, default=20000)
+    args = parser.parse_args()
+
+    # one-gateway layout first, so the RSS high-water mark isn't inflated by the larger run
+    after, after_bytes = measure("after: shared gateway", 1, args.members)
+    del after
+    before, before_bytes = measure("before: bot per module", 3, args.members)
+    del before
+    print(f"saved {(before_bytes - after_bytes) / 2**20:.1f}MB of member cache "
+          f"({before_bytes / max(after_bytes, 1):.1f}x) and 2 IDENTIFYs per start")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
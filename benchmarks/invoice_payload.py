@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+CREATE_INVOICE payload construction: per-call string joins + hmac.new vs. InvoicePlan.
+
+The legacy builder below is the old AsyncWayForPay._create_invoice body up to the
+request: it joined the product lists and keyed a new HMAC on every invoice. The current
+one reuses the plan's precomputed signature tail and copies a keyed HMAC prototype.
+No network involved.
+
+    python benchmarks/invoice_payload.py --iterations 200000
+"""
+
+import argparse
+import hashlib
+import hmac
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wayforpay import AsyncWayForPay, InvoicePlan
+
+KEY = "benchmark-secret-key"
+DOMAIN = "upworkrevolution.com"
+MERCHANT = "upworkrevolution_com"
+PRODUCTS = ["Оплата доступу до закритого Discord-каналу Community Upwork Revolution"]
+
+
+def legacy_build(merchantAccount, merchantAuthType, amount, currency, regularMode, regularCount, **kwargs):
+    orderReference = "DH1234567890"
+    orderDate = int(time.time())
+    productNames = kwargs.get('productNames', [])
+    productPrices = kwargs.get('productPrices', [])
+    productCounts = kwargs.get('productCounts', [])
+
+    product_names_data = ';'.join(map(str, productNames))
+    product_counts_data = ';'.join(map(str, productCounts))
+    product_prices_data = ';'.join(map(str, productPrices))
+
+    string = f'{merchantAccount};{DOMAIN};{orderReference};{orderDate};{amount};{currency};{product_names_data};{product_counts_data};{product_prices_data}'
+
+    return {
+        "transactionType": "CREATE_INVOICE",
+        "merchantSecretKey": KEY,
+        "merchantAccount": merchantAccount,
+        "merchantAuthType": merchantAuthType,
+        "merchantDomainName": DOMAIN,
+        "merchantSignature": hmac.new(KEY.encode('utf-8'), string.encode('utf-8'), hashlib.md5).hexdigest(),
+        "apiVersion": "1",
+        "orderReference": orderReference,
+        "orderDate": orderDate,
+        "amount": amount,
+        "currency": currency,
+        "productName": productNames,
+        "productPrice": productPrices,
+        "productCount": productCounts,
+        "requiredRectoken": 1,
+        "allowRegular": True,
+        "regularMode": regularMode,
+        "regularCount": regularCount,
+        "regularBehavior": "preset"
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200_000)
+    args = parser.parse_args()
+
+    client = AsyncWayForPay(KEY, DOMAIN)
+    plan = InvoicePlan("monthly", 14.99, "USD", "monthly", 60, PRODUCTS, sub_time=30)
+
+    # both builders must sign the same payload identically
+    assert client.build_invoice_params(MERCHANT, "SimpleSignature", plan, "DH1234567890", 1)["merchantSignature"] == \
+        hmac.new(KEY.encode(), f"{MERCHANT};{DOMAIN};DH1234567890;1;{plan.signature_tail}".encode(), hashlib.md5).hexdigest()
+
+    variants = [
+        ("legacy join + hmac.new", lambda: legacy_build(
+            MERCHANT, "SimpleSignature", 14.99, "USD", "monthly", 60,
+            productNames=PRODUCTS, productPrices=[14.99], productCounts=[1])),
+        ("InvoicePlan + hmac copy", lambda: client.build_invoice_params(
+            MERCHANT, "SimpleSignature", plan, "DH1234567890")),
+    ]
+    for label, build in variants:
+        best = min(timeit.repeat(build, number=args.iterations, repeat=5))
+        print(f"{label:<28} {best / args.iterations * 1e6:7.3f}us per payload  "
+              f"({args.iterations / best:,.0f} payloads/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+HTTP load test for the web app: requests per second and latency percentiles.
+
+Give one or more name=url targets to compare deployments side by side, e.g. the
+current ASGI app against the old Flask-on-a-thread setup checked out in a worktree:
+
+    git worktree add ../baseline <old-commit> && (cd ../baseline && python app_main.py)  # serves :5000
+    python app_main.py  # with WEB_BIND = "127.0.0.1:5001" in config.py
+    python benchmarks/load_test.py --target flask=http://127.0.0.1:5000 --target asgi=http://127.0.0.1:5001
+
+The default request is a failure webhook for an order reference that does not exist:
+it exercises request parsing plus one database round trip and changes no data.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import aiohttp
+
+from _common import percentile
+
+
+async def run_target(name, base_url, args):
+    latencies = []
+    errors = 0
+    counter = iter(range(args.requests))
+
+    async def worker(session):
+        nonlocal errors
+        for n in counter:
+            body = args.body.replace("{n}", str(n))
+            start = time.perf_counter()
+            try:
+                async with session.request(args.method, base_url + args.path, data=body,
+                                           headers={"Content-Type": args.content_type}) as response:
+                    await response.read()
+                    if response.status >= 400:
+                        errors += 1
+            except aiohttp.ClientError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+
+    print(
+        f"{name:<12} {len(latencies) / elapsed:9.1f} req/s  "
+        f"p50={percentile(latencies, 50) * 1000:8.2f}ms  "
+        f"p99={percentile(latencies, 99) * 1000:8.2f}ms  "
+        f"errors={errors}/{len(latencies)}"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", action="append", required=True, help="name=base_url, repeatable")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--method", default="POST")
+    parser.add_argument("--path", default="/callback_failure")
+    parser.add_argument("--body", default=json.dumps({"orderReference": "LOADTEST{n}"}),
+                        help="request body, {n} is replaced with the request number")
+    parser.add_argument("--content-type", default="application/json")
+    args = parser.parse_args()
+
+    for target in args.target:
+        name, _, base_url = target.partition("=")
+        await run_target(name, base_url.rstrip("/"), args)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Order id allocation benchmark.
+
+Seeds a scratch database with 10k / 100k / 1M orders and measures the database part
+of a /payment request (service_functions.add_new_order). With the unique index on
+orders.order_id the latency should stay flat as the table grows.
+
+    python benchmarks/order_id_allocation.py --database-url sqlite+aiosqlite:///bench.db
+    python benchmarks/order_id_allocation.py --with-legacy   # also time the old full-table scan
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+from _common import DEFAULT_DATABASE_URL, use_scratch_database, report, timed
+
+from sqlalchemy import insert, func, select
+from models import Orders
+import sql_scripts
+import service_functions
+
+SEED_BATCH = 10_000
+
+
+async def seed_orders(engine, total):
+    """Top the orders table up to `total` rows"""
+    async with engine.begin() as conn:
+        existing = (await conn.execute(select(func.count()).select_from(Orders))).scalar()
+    now = int(time.time())
+    while existing < total:
+        batch = min(SEED_BATCH, total - existing)
+        rows = [
+            {
+                "order_id": service_functions.generate_order_id(),
+                "email": f"bench{existing + i}@example.com",
+                "link": f"https://discord.gg/bench{existing + i}",
+                "amount_to_pay": "10",
+                "order_reference": f"DH{random.randint(1000000000, 9999999999)}",
+                "sub_time": 30,
+                "order_date": now,
+                "order_status": 0,
+            }
+            for i in range(batch)
+        ]
+        async with engine.begin() as conn:
+            # prefix_with keeps the (astronomically rare) random id collision from aborting the seed
+            await conn.execute(insert(Orders).prefix_with("OR IGNORE", dialect="sqlite"), rows)
+        existing += batch
+    return existing
+
+
+async def legacy_add_new_order():
+    """The pre-index allocator: load every order to build the set of taken ids"""
+    taken = {order["order_id"] for order in await sql_scripts.select_orders()}
+    while True:
+        order_id = service_functions.generate_order_id()
+        if order_id not in taken:
+            break
+    await sql_scripts.add_order(order_id, "legacy@example.com", "https://discord.gg/legacy", "10", 30)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=DEFAULT_DATABASE_URL)
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--with-legacy", action="store_true")
+    args = parser.parse_args()
+
+    engine = await use_scratch_database(args.database_url)
+
+    for size in (int(s) for s in args.sizes.split(",")):
+        await seed_orders(engine, size)
+
+        samples = await timed(
+            lambda: service_functions.add_new_order("bench@example.com", "https://discord.gg/bench", "10", 30),
+            args.repeat,
+        )
+        report(f"add_new_order @ {size} orders", samples)
+
+        if args.with_legacy:
+            samples = await timed(legacy_add_new_order, max(1, args.repeat // 20))
+            report(f"legacy full-scan @ {size} orders", samples)
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Reading and serializing all orders: ORM entities vs. column selects.
+
+The old select_orders loaded Orders entities and rebuilt each dict with
+class_mapper(Orders).columns + getattr; sql_scripts now selects the columns and
+zips each row with the column keys computed at import. Seeds --orders rows (100k by default) and times a full
+read of the table with each variant, including json.dumps of the result. Then it
+compares peak traced memory of exporting the table as JSON lines from select_orders()
+against streaming it with sql_scripts.iter_orders().
+
+    python benchmarks/order_serialization.py --orders 100000
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import tracemalloc
+
+from _common import DEFAULT_DATABASE_URL, use_scratch_database, report
+
+from sqlalchemy import insert, select, func
+from sqlalchemy.orm import class_mapper
+from models import Orders, async_session
+import sql_scripts
+
+SEED_BATCH = 10_000
+
+
+async def seed(engine, total):
+    now = int(time.time())
+    async with engine.begin() as conn:
+        existing = (await conn.execute(select(func.count()).select_from(Orders))).scalar()
+        for start in range(existing, total, SEED_BATCH):
+            await conn.execute(insert(Orders), [
+                {"order_id": 10**9 + n, "email": f"bench{n}@example.com", "link": f"https://discord.gg/bench{n}",
+                 "amount_to_pay": "10", "order_reference": f"BENCH{n}", "sub_time": 30,
+                 "order_date": now, "order_status": n % 3}
+                for n in range(start, min(start + SEED_BATCH, total))
+            ])
+
+
+async def legacy_select_orders():
+    async with async_session() as session:
+        result = await session.execute(select(Orders))
+        order = result.fetchall()
+        if order:
+            return [{column.key: getattr(row.Orders, column.key) for column in class_mapper(Orders).columns} for row in order]
+        return order
+
+
+async def mapping_rows():
+    """Column select returning RowMapping objects (the .mappings() alternative), for reference"""
+    async with async_session() as session:
+        result = await session.execute(sql_scripts.select_order_rows)
+        return result.mappings().all()
+
+
+VARIANTS = [
+    ("ORM entities + class_mapper", legacy_select_orders),
+    ("column select -> zip dict (current)", sql_scripts.select_orders),
+    ("column select -> RowMapping", mapping_rows),
+]
+
+
+async def export_all(sink):
+    for order in await sql_scripts.select_orders():
+        sink.write(json.dumps(order))
+
+
+async def export_streamed(sink):
+    async for order in sql_scripts.iter_orders():
+        sink.write(json.dumps(order))
+
+
+class NullSink:
+    def write(self, data):
+        pass
+
+
+async def peak_memory(export):
+    tracemalloc.start()
+    start = time.perf_counter()
+    await export(NullSink())
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=DEFAULT_DATABASE_URL)
+    parser.add_argument("--orders", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    engine = await use_scratch_database(args.database_url, reset=False)
+    await seed(engine, args.orders)
+
+    for label, read in VARIANTS:
+        read_samples, dump_samples = [], []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            orders = await read()
+            read_samples.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            json.dumps([dict(order) for order in orders])
+            dump_samples.append(time.perf_counter() - start)
+        report(f"{label} read", read_samples)
+        report(f"{label} json", dump_samples)
+
+    for label, export in [("export via select_orders", export_all), ("export via iter_orders", export_streamed)]:
+        elapsed, peak = await peak_memory(export)
+        print(f"{label:<40} {elapsed:8.2f}s  peak traced memory={peak / 2**20:8.1f}MB")
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
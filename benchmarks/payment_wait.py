@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Waiting for payments: polling the orders table vs. notifications.payment_waiters.
+
+Before, sql_scripts.wait_for_payment opened a session and re-read the order every
+`interval` seconds until it was paid (kept below as legacy_wait_for_payment). Now it
+awaits a future that the webhook resolves. This starts --waiters waits on pending orders,
+pays them at random moments over --window seconds and counts the queries the waiting
+side issued (including the one read of each order once it is paid, and the one check of
+each order that starts waiting while the listener is already running), plus how long each
+waiter took to notice its payment.
+
+Three runs: polling; payments applied in this process (webhook path, resolve() wakes the
+waiter); and payments committed through a second engine without resolve(), standing in
+for another process, so only the database listener (SQLite data_version watcher here,
+LISTEN/NOTIFY on Postgres) can wake the waiters.
+
+    python benchmarks/payment_wait.py --waiters 500 --window 5 --interval 0.5
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+
+from _common import DEFAULT_DATABASE_URL, use_scratch_database, percentile
+
+from sqlalchemy import event, insert, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncSession
+import models
+from models import Orders, async_session
+import sql_scripts
+from notifications import payment_waiters
+from config import paid_order_status
+
+
+async def legacy_wait_for_payment(order_id: int, timeout: int = 300, interval: float = 5):
+    start_time = time.monotonic()
+    while time.monotonic() - start_time < timeout:
+        async with async_session() as session:
+            result = await session.execute(select(Orders).where(Orders.order_id == order_id))
+            order = result.scalars().first()
+            if order and order.order_status == paid_order_status:
+                return order
+        await asyncio.sleep(interval)
+    return None
+
+
+def order_id(prefix, n):
+    # every run has its own ids, so none of them is in payment_waiters' recently paid cache
+    return 10**9 * (ord(prefix) - ord("A") + 1) + n
+
+
+statements = Counter()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    # every engine, including the one the payment listener holds a connection of
+    statements[statement.lstrip().split(None, 1)[0].upper()] += 1
+
+
+async def seed(engine, prefix, total):
+    now = int(time.time())
+    async with engine.begin() as conn:
+        await conn.execute(insert(Orders), [
+            {"order_id": order_id(prefix, i), "email": f"{prefix}{i}@example.com", "order_reference": f"{prefix}{i}",
+             "order_status": 0, "order_date": now, "sub_time": 30}
+            for i in range(total)
+        ])
+
+
+async def run(label, prefix, args, wait, pay):
+    engine = await use_scratch_database(args.database_url)
+    await seed(engine, prefix, args.waiters)
+
+    paid_at = {}
+    latencies = []
+
+    async def waiter(i):
+        order = await wait(order_id(prefix, i))
+        assert order is not None, f"order {i} was not seen as paid"
+        latencies.append(time.monotonic() - paid_at[i])
+
+    async def payer(i):
+        await asyncio.sleep(random.uniform(0, args.window))
+        await pay(f"{prefix}{i}")
+        paid_at[i] = time.monotonic()
+
+    waiters = [asyncio.create_task(waiter(i)) for i in range(args.waiters)]
+    await asyncio.sleep(0.1)  # let every waiter register before payments start
+    statements.clear()
+    start = time.perf_counter()
+    await asyncio.gather(*(payer(i) for i in range(args.waiters)))
+    await asyncio.gather(*waiters)
+    elapsed = time.perf_counter() - start
+
+    # the payer's own UPDATEs are not part of waiting
+    waiting = {kind: n for kind, n in statements.items() if kind not in ("UPDATE", "BEGIN", "COMMIT")}
+    print(f"{label:<34} {sum(waiting.values()):>6} queries for {args.waiters} waiters {dict(waiting)}  "
+          f"wake p50={percentile(latencies, 50) * 1000:.0f}ms p99={percentile(latencies, 99) * 1000:.0f}ms "
+          f"({elapsed:.1f}s)")
+    await models.dispose_engine()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=DEFAULT_DATABASE_URL)
+    parser.add_argument("--waiters", type=int, default=500)
+    parser.add_argument("--window", type=float, default=5, help="seconds over which the payments arrive")
+    parser.add_argument("--interval", type=float, default=0.5, help="polling interval of the legacy wait")
+    args = parser.parse_args()
+
+    async def pay_in_process(order_reference):
+        _, paid_order_id = await sql_scripts.apply_payment(order_reference)
+        payment_waiters.resolve(paid_order_id)
+
+    other_process = models.create_engine_for_url(args.database_url)
+
+    async def pay_elsewhere(order_reference):
+        # same statements as the webhook (including the NOTIFY on Postgres), but nobody calls resolve()
+        async with AsyncSession(other_process) as session:
+            async with session.begin():
+                await sql_scripts._apply_payment(session, order_reference, None, None, paid_order_status)
+
+    await run(f"before: poll every {args.interval}s", "P", args,
+              lambda order_id: legacy_wait_for_payment(order_id, interval=args.interval), pay_in_process)
+    await run("after: resolved in process", "R", args, sql_scripts.wait_for_payment, pay_in_process)
+    await run("after: paid by another process", "X", args, sql_scripts.wait_for_payment, pay_elsewhere)
+    await other_process.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
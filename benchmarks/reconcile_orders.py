@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Reconciliation of pending orders against the local fake WayForPay API.
+
+Seeds a scratch database with stale pending orders and the fake API with their invoices
+in a mix of states (approved, declined, expired, still processing, unknown), runs
+reconcile.reconcile_pending_orders and checks that exactly the approved orders were marked
+paid (with their users' payment dates moved), the failed ones deleted and the rest left
+pending. A second, smaller run checks that the rate cap holds, and a third one that orders
+older than RECONCILE_GIVE_UP_AFTER which are still processing or unknown are abandoned:
+deleted, with their open invoices removed.
+
+    python benchmarks/reconcile_orders.py --orders 20000 --concurrency 20 --latency 0.005
+    python benchmarks/reconcile_orders.py --orders 50000 --trace-memory
+"""
+
+import argparse
+import asyncio
+import time
+import tracemalloc
+
+from _common import DEFAULT_DATABASE_URL, use_scratch_database
+
+from sqlalchemy import insert, select, func
+from fake_wayforpay import start_fake_server
+from models import Orders, Users
+import payment_client
+import reconcile
+from config import MERCHANT_ID, MERCHANT_SECRET, paid_order_status
+
+# share of the invoices in each state, in order; the rest are unknown to the fake API
+STATUS_MIX = [("Approved", 0.6), ("Declined", 0.15), ("Expired", 0.05), ("InProcessing", 0.1)]
+
+
+def status_for(i, total):
+    position = i / total
+    for status, share in STATUS_MIX:
+        if position < share:
+            return status
+        position -= share
+    return None
+
+
+async def seed(engine, fake, prefix, total, placed_at):
+    async with engine.begin() as conn:
+        await conn.execute(insert(Users), [
+            {"email": f"{prefix}{i}@example.com", "discord_id": hash((prefix, i)) % 10**15,
+             "last_date_of_payment": placed_at, "warned_30_days": True}
+            for i in range(total)
+        ])
+        await conn.execute(insert(Orders), [
+            {"order_id": hash((prefix, "order", i)) % 10**10, "email": f"{prefix}{i}@example.com",
+             "order_reference": f"{prefix}{i}", "order_status": 0, "order_date": placed_at, "sub_time": 30}
+            for i in range(total)
+        ])
+    expected = {}
+    for i in range(total):
+        status = status_for(i, total)
+        expected[status] = expected.get(status, 0) + 1
+        if status is not None:
+            fake.invoices[f"{prefix}{i}"] = {"merchantAccount": MERCHANT_ID, "amount": 10, "currency": "USD",
+                                             "transactionStatus": status, "createdDate": placed_at}
+    return expected
+
+
+async def count(engine, query):
+    async with engine.connect() as conn:
+        return (await conn.execute(query)).scalar()
+
+
+async def run(engine, fake, prefix, total, args, rate, abandoned=False):
+    age = reconcile.RECONCILE_GIVE_UP_AFTER + 86400 if abandoned else 2 * 86400
+    placed_at = int(time.time()) - age
+    expected = await seed(engine, fake, prefix, total, placed_at)
+    calls_before = fake.requests
+
+    if args.trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    summary = await reconcile.reconcile_pending_orders(batch_size=args.batch_size, concurrency=args.concurrency,
+                                                       rate=rate)
+    elapsed = time.perf_counter() - start
+    memory = ""
+    if args.trace_memory:
+        memory = f", peak traced memory {tracemalloc.get_traced_memory()[1] / 1e6:.1f} MB"
+        tracemalloc.stop()
+
+    calls = fake.requests - calls_before
+    ours = Orders.order_reference.like(f"{prefix}%")
+    paid = await count(engine, select(func.count()).where(ours, Orders.order_status == paid_order_status))
+    pending = await count(engine, select(func.count()).where(ours, Orders.order_status == 0))
+    remaining = await count(engine, select(func.count()).where(ours))
+    moved = await count(engine, select(func.count()).where(
+        Users.email.like(f"{prefix}%"), Users.last_date_of_payment > placed_at, Users.warned_30_days.is_(False)))
+
+    failed = expected.get("Declined", 0) + expected.get("Expired", 0)
+    unsettled = expected.get("InProcessing", 0) + expected.get(None, 0)
+    checks = {
+        "approved orders marked paid": paid == expected.get("Approved", 0),
+        "approved users' payment date moved": moved == expected.get("Approved", 0),
+    }
+    if abandoned:
+        open_invoices = sum(1 for invoice in fake.invoices.values() if invoice["transactionStatus"] == "InProcessing")
+        checks.update({
+            "declined/expired and abandoned orders deleted": total - remaining == failed + unsettled,
+            "abandoned orders' open invoices removed": open_invoices == 0,
+            "one status check per order, one removal per open invoice": calls == total + expected.get("InProcessing", 0),
+        })
+    else:
+        checks.update({
+            "declined/expired orders deleted": total - remaining == failed,
+            "processing/unknown orders still pending": pending == unsettled,
+            "one status check per order": calls == total,
+        })
+    print(f"{total} pending orders, concurrency {args.concurrency}, rate cap {rate or 'none'}: "
+          f"{elapsed:.2f}s ({calls / elapsed:,.0f} checks/s){memory}")
+    print(f"   {summary}")
+    for label, ok in checks.items():
+        print(f"   {'✓' if ok else '✗'} {label}")
+    return all(checks.values()), calls / elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=DEFAULT_DATABASE_URL)
+    parser.add_argument("--orders", type=int, default=20000)
+    parser.add_argument("--batch-size", type=int, default=reconcile.RECONCILE_BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds the fake API takes per call")
+    parser.add_argument("--rate", type=float, default=50, help="rate cap for the second, smaller run")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="report peak Python memory of the run (tracing slows it down several times)")
+    args = parser.parse_args()
+
+    engine = await use_scratch_database(args.database_url)
+    fake, runner = await start_fake_server(MERCHANT_SECRET, port=args.port, latency=args.latency)
+    payment_client.WAYFORPAY_API_URL = f"http://127.0.0.1:{args.port}/api"
+
+    try:
+        ok, _ = await run(engine, fake, "R", args.orders, args, rate=0)
+        # start over, so the orders the first run left pending are not checked again
+        await engine.dispose()
+        engine = await use_scratch_database(args.database_url)
+        fake.invoices.clear()
+        capped_ok, observed = await run(engine, fake, "C", int(args.rate * 4), args, rate=args.rate)
+        within_cap = observed <= args.rate * 1.05
+        print(f"   {'✓' if within_cap else '✗'} rate cap held ({observed:.1f}/s <= {args.rate:g}/s)")
+        await engine.dispose()
+        engine = await use_scratch_database(args.database_url)
+        fake.invoices.clear()
+        abandoned_ok, _ = await run(engine, fake, "A", args.orders // 10, args, rate=0, abandoned=True)
+    finally:
+        await payment_client.close_wayforpay()
+        await runner.cleanup()
+        await engine.dispose()
+
+    if not (ok and capped_ok and within_cap and abandoned_ok):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
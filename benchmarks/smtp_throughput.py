@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Mail throughput benchmark: 1,000 queued order emails through mail_sender.send_mail.
+
+Runs a local debugging SMTP server (accepts and discards everything, optional per-message
+delay to mimic a real relay) and compares the old one-connection-per-email transport with
+SMTPPool at a few pool sizes.
+
+    python benchmarks/smtp_throughput.py --orders 1000 --delay 0.005 --pool-sizes 1,4,8
+"""
+
+import argparse
+import asyncio
+import smtplib
+import time
+
+import _common  # noqa: F401  (puts the repo root on sys.path)
+import mail_sender
+
+
+class DebuggingSMTPServer(asyncio.Protocol):
+    """Just enough SMTP for smtplib: EHLO/MAIL/RCPT/DATA/NOOP/RSET/QUIT, no STARTTLS"""
+
+    stats = {"connections": 0, "messages": 0}
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.buffer = b""
+        self.in_data = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.stats["connections"] += 1
+        transport.write(b"220 localhost debugging SMTP\r\n")
+
+    def data_received(self, data):
+        self.buffer += data
+        while True:
+            if self.in_data:
+                end = self.buffer.find(b"\r\n.\r\n")
+                if end < 0:
+                    return
+                self.buffer = self.buffer[end + 5:]
+                self.in_data = False
+                self.stats["messages"] += 1
+                asyncio.get_running_loop().call_later(self.delay, self.transport.write, b"250 OK queued\r\n")
+                continue
+
+            line, sep, rest = self.buffer.partition(b"\r\n")
+            if not sep:
+                return
+            self.buffer = rest
+            command = line[:4].upper()
+            if command == b"EHLO":
+                self.transport.write(b"250-localhost\r\n250 8BITMIME\r\n")
+            elif command == b"DATA":
+                self.in_data = True
+                self.transport.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+            elif command == b"QUIT":
+                self.transport.write(b"221 Bye\r\n")
+                self.transport.close()
+            else:
+                self.transport.write(b"250 OK\r\n")
+
+
+class OneShotTransport(mail_sender.SMTPPool):
+    """The pre-pool behaviour: connect, EHLO, send, QUIT for every email"""
+
+    async def send(self, sender, receiver, message):
+        def send_once():
+            server = smtplib.SMTP(self.host, self.port)
+            try:
+                server.ehlo()
+                server.sendmail(sender, receiver, message)
+            finally:
+                server.quit()
+        await asyncio.to_thread(send_once)
+
+
+async def send_backlog(transport, orders):
+    mail_sender.smtp_pool = transport
+    stats = DebuggingSMTPServer.stats
+    stats.update(connections=0, messages=0)
+
+    # deliver_orders fans out the same way, minus the database claim
+    limit = asyncio.Semaphore(mail_sender.SMTP_POOL_SIZE)
+
+    async def send(n):
+        async with limit:
+            await mail_sender.send_mail(f"bench.user{n}@example.com", f"https://discord.gg/bench{n}", f"DH{n}")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send(n) for n in range(orders)))
+    elapsed = time.perf_counter() - start
+    await transport.close()
+    return elapsed, dict(stats)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=8025)
+    parser.add_argument("--delay", type=float, default=0.0, help="server-side seconds per message")
+    parser.add_argument("--pool-sizes", default="1,4,8")
+    args = parser.parse_args()
+
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(lambda: DebuggingSMTPServer(args.delay), "127.0.0.1", args.port)
+
+    mail_sender.print = lambda *a, **kw: None  # silence the per-email log lines
+
+    runs = [("one connection per email", OneShotTransport("127.0.0.1", args.port, starttls=False), 1)]
+    for size in (int(s) for s in args.pool_sizes.split(",")):
+        pool = mail_sender.SMTPPool("127.0.0.1", args.port, starttls=False, size=size)
+        runs.append((f"SMTPPool size={size}", pool, size))
+
+    for label, transport, concurrency in runs:
+        mail_sender.SMTP_POOL_SIZE = concurrency
+        elapsed, stats = await send_backlog(transport, args.orders)
+        print(f"{label:<28} {args.orders / elapsed:8.1f} emails/s  {elapsed:6.2f}s  "
+              f"messages={stats['messages']} connections={stats['connections']}")
+
+    server.close()
+    await server.wait_closed()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Per-operation latency of the sql_scripts writers: select-then-mutate vs. set-based.
+
+The legacy_* functions below are the old implementations (SELECT the row, mutate the ORM
+object, commit); the current sql_scripts functions issue a single UPDATE/DELETE. Each
+operation is timed against its own seeded rows so both variants do the same work.
+Repeat --database-url to compare backends:
+
+    python benchmarks/sql_writers.py --database-url sqlite+aiosqlite:///bench.db \
+        --database-url postgresql+asyncpg://localhost/bench
+"""
+
+import argparse
+import asyncio
+import time
+
+from _common import DEFAULT_DATABASE_URL, use_scratch_database, report
+
+from sqlalchemy import insert, select
+from models import Orders, Users, async_session
+import sql_scripts
+
+
+async def legacy_update_user_with_discord_id(join_link, discord_id):
+    async with async_session() as session:
+        result = await session.execute(select(Users).where(Users.link == join_link))
+        user = result.scalars().first()
+        if user:
+            user.discord_id = discord_id
+            user.link = None
+            await session.commit()
+            return user
+        return None
+
+
+async def legacy_update_user_order_reference(order_id, order_reference):
+    async with async_session() as session:
+        result = await session.execute(select(Orders).where(Orders.order_id == order_id))
+        order = result.scalars().first()
+        if order:
+            order.order_reference = order_reference
+            await session.commit()
+
+
+async def legacy_update_order_status_by_order_reference(order_reference, new_status):
+    async with async_session() as session:
+        result = await session.execute(
+            select(Orders).where(Orders.order_reference == order_reference, Orders.order_status == 0)
+        )
+        order = result.scalars().first()
+        if order:
+            order.order_status = new_status
+            await session.commit()
+
+
+async def legacy_delete_order_by_order_reference(order_reference):
+    async with async_session() as session:
+        result = await session.execute(select(Orders).where(Orders.order_reference == order_reference))
+        order = result.scalars().first()
+        if order:
+            await session.delete(order)
+            await session.commit()
+
+
+async def legacy_update_user_last_payment_date(user_email, new_date):
+    async with async_session() as session:
+        async with session.begin():
+            result = await session.execute(select(Users).where(Users.email == user_email))
+            user = result.scalar_one_or_none()
+            if user:
+                user.last_date_of_payment = new_date
+                await session.commit()
+                return True
+            return False
+
+
+async def legacy_reset_user_warning_status(user_email):
+    async with async_session() as session:
+        result = await session.execute(select(Users).where(Users.email == user_email))
+        user = result.scalar_one_or_none()
+        if user:
+            user.warned_30_days = False
+            await session.commit()
+            return True
+        return False
+
+
+# name -> (legacy, current, args for row n)
+OPERATIONS = {
+    "update_user_with_discord_id": (
+        legacy_update_user_with_discord_id, sql_scripts.update_user_with_discord_id,
+        lambda p, n: (f"https://discord.gg/{p}{n}", order_id(p, n)),
+    ),
+    "update_order_status_by_order_reference": (
+        legacy_update_order_status_by_order_reference, sql_scripts.update_order_status_by_order_reference,
+        lambda p, n: (f"{p}{n}", 1),
+    ),
+    "update_user_last_payment_date": (
+        legacy_update_user_last_payment_date, sql_scripts.update_user_last_payment_date,
+        lambda p, n: (f"{p}{n}@example.com", int(time.time())),
+    ),
+    "update_user_order_reference": (
+        legacy_update_user_order_reference, sql_scripts.update_user_order_reference,
+        lambda p, n: (order_id(p, n), f"{p}R{n}"),
+    ),
+    # last, since it removes the orders the others use (by their new reference)
+    "delete_order_by_order_reference": (
+        legacy_delete_order_by_order_reference, sql_scripts.delete_order_by_order_reference,
+        lambda p, n: (f"{p}R{n}",),
+    ),
+}
+
+
+def order_id(prefix, n):
+    return (1 if prefix == "legacy" else 2) * 10**9 + n
+
+
+async def seed(engine, prefix, total):
+    now = int(time.time())
+    async with engine.begin() as conn:
+        await conn.execute(insert(Users), [
+            {"email": f"{prefix}{n}@example.com", "link": f"https://discord.gg/{prefix}{n}",
+             "last_date_of_payment": now, "warned_30_days": False}
+            for n in range(total)
+        ])
+        await conn.execute(insert(Orders), [
+            {"order_id": order_id(prefix, n), "email": f"{prefix}{n}@example.com", "order_reference": f"{prefix}{n}",
+             "link": f"https://discord.gg/{prefix}{n}", "order_status": 0, "order_date": now, "sub_time": 30}
+            for n in range(total)
+        ])
+
+
+async def time_operation(func, make_args, prefix, repeat):
+    samples = []
+    for n in range(repeat):
+        args = make_args(prefix, n)
+        start = time.perf_counter()
+        await func(*args)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+async def run_backend(database_url, args):
+    print(f"== {database_url.split('://')[0]}")
+    engine = await use_scratch_database(database_url)
+    await seed(engine, "legacy", args.repeat)
+    await seed(engine, "setbased", args.repeat)
+
+    for name, (legacy, current, make_args) in OPERATIONS.items():
+        report(f"{name} (select+mutate)", await time_operation(legacy, make_args, "legacy", args.repeat))
+        report(f"{name} (set-based)", await time_operation(current, make_args, "setbased", args.repeat))
+
+    await engine.dispose()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", action="append", help="repeatable; defaults to a local SQLite file")
+    parser.add_argument("--repeat", type=int, default=500)
+    args = parser.parse_args()
+
+    for database_url in args.database_url or [DEFAULT_DATABASE_URL]:
+        await run_backend(database_url, args)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
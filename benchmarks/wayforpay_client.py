@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+WayForPay client benchmark against the local fake API (benchmarks/fake_wayforpay.py).
+
+Creates, checks and removes invoices through AsyncWayForPay and through the blocking
+WayForPay facade, checks every response, and reports throughput and how many TCP
+connections the fake server saw. The old client opened one connection per call.
+
+    python benchmarks/wayforpay_client.py --invoices 500 --latency 0.02
+"""
+
+import argparse
+import asyncio
+import time
+
+import _common  # noqa: F401  (puts the repo root on sys.path)
+from fake_wayforpay import start_fake_server
+from wayforpay import AsyncWayForPay, WayForPay
+
+SECRET = "benchmark-secret"
+MERCHANT = "benchmark_merchant"
+
+
+INVOICE = dict(
+    merchantAccount=MERCHANT, merchantAuthType="SimpleSignature", amount=10, currency="USD",
+    productNames=["Benchmark"], productPrices=[10], productCounts=[1],
+)
+
+
+def check_results(invoice, status, deleted):
+    assert invoice and invoice.invoiceUrl.endswith(invoice.orderReference), invoice
+    assert status is not None and status.transactionStatus == "Approved", status and status.response_dict
+    assert deleted is True
+
+
+async def async_round_trip(client):
+    invoice = await client.create_invoice(**INVOICE)
+    status = await client.check_invoice(MERCHANT, invoice.orderReference)
+    check_results(invoice, status, await client.delete_invoice(MERCHANT, invoice.orderReference))
+
+
+def sync_round_trip(client):
+    invoice = client.create_invoice(**INVOICE)
+    status = client.check_invoice(MERCHANT, invoice.orderReference)
+    check_results(invoice, status, client.delete_invoice(MERCHANT, invoice.orderReference))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--invoices", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--concurrency", type=int, default=10)
+    args = parser.parse_args()
+
+    api_url = f"http://127.0.0.1:{args.port}/api"
+    fake, runner = await start_fake_server(SECRET, port=args.port, latency=args.latency)
+
+    async with AsyncWayForPay(SECRET, "example.com", api_url=api_url, max_concurrency=args.concurrency,
+                              max_connections=args.concurrency) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(async_round_trip(client) for _ in range(args.invoices)))
+        elapsed = time.perf_counter() - start
+    print(f"AsyncWayForPay: {args.invoices} invoices ({fake.requests} calls) in {elapsed:.2f}s "
+          f"= {fake.requests / elapsed:.0f} calls/s over {len(fake.connections)} connections")
+
+    fake.requests, fake.connections = 0, set()
+    sync_client = WayForPay(SECRET, "example.com", api_url=api_url)
+
+    def sync_round_trips():
+        for _ in range(args.invoices):
+            sync_round_trip(sync_client)
+
+    start = time.perf_counter()
+    # the facade blocks, so drive it from a worker thread while this loop serves the fake API
+    await asyncio.to_thread(sync_round_trips)
+    elapsed = time.perf_counter() - start
+    sync_client.close()
+    print(f"WayForPay (sync): {args.invoices} invoices ({fake.requests} calls) in {elapsed:.2f}s "
+          f"= {fake.requests / elapsed:.0f} calls/s over {len(fake.connections)} connections")
+
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Success webhook database work: three sessions vs. one unit of work.
+
+Before, callback_success ran update_user_last_payment_date, reset_user_warning_status and
+update_order_status_by_order_reference, each in its own session with its own commit (the
+select-then-mutate versions, kept in sql_writers.py). Now
+it calls sql_scripts.apply_payment once. This seeds matching users and pending orders in a
+scratch database and replays the webhook's database work at the given concurrency.
+
+    python benchmarks/webhook_transaction.py --webhooks 2000 --concurrency 20
+    python benchmarks/webhook_transaction.py --database-url postgresql+asyncpg://localhost/bench
+"""
+
+import argparse
+import asyncio
+import time
+
+from _common import DEFAULT_DATABASE_URL, use_scratch_database, percentile
+
+from sqlalchemy import insert
+from models import Orders, Users
+import sql_scripts
+from sql_writers import (legacy_update_user_last_payment_date, legacy_reset_user_warning_status,
+                         legacy_update_order_status_by_order_reference)
+from config import paid_order_status
+
+
+async def seed(engine, prefix, total):
+    now = int(time.time())
+    async with engine.begin() as conn:
+        await conn.execute(insert(Users), [
+            {"email": f"{prefix}{i}@example.com", "discord_id": hash((prefix, i)) % 10**15,
+             "last_date_of_payment": now - 30 * 86400, "warned_30_days": True}
+            for i in range(total)
+        ])
+        await conn.execute(insert(Orders), [
+            {"order_id": hash((prefix, "order", i)) % 10**10, "email": f"{prefix}{i}@example.com",
+             "order_reference": f"{prefix}{i}", "order_status": 0, "order_date": now, "sub_time": 30}
+            for i in range(total)
+        ])
+
+
+async def three_sessions(n, prefix, now):
+    email = f"{prefix}{n}@example.com"
+    await legacy_update_user_last_payment_date(email, now)
+    await legacy_reset_user_warning_status(email)
+    await legacy_update_order_status_by_order_reference(f"{prefix}{n}", paid_order_status)
+
+
+async def unit_of_work(n, prefix, now):
+    await sql_scripts.apply_payment(f"{prefix}{n}", f"{prefix}{n}@example.com", now)
+
+
+async def run(label, handler, prefix, args):
+    latencies = []
+    counter = iter(range(args.webhooks))
+    now = int(time.time())
+
+    async def worker():
+        for n in counter:
+            start = time.perf_counter()
+            await handler(n, prefix, now)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+    print(
+        f"{label:<24} {len(latencies) / elapsed:9.1f} webhooks/s  "
+        f"p50={percentile(latencies, 50) * 1000:8.2f}ms  p99={percentile(latencies, 99) * 1000:8.2f}ms"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=DEFAULT_DATABASE_URL)
+    parser.add_argument("--webhooks", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+
+    engine = await use_scratch_database(args.database_url)
+    await seed(engine, "before", args.webhooks)
+    await seed(engine, "after", args.webhooks)
+
+    await run("before: three sessions", three_sessions, "before", args)
+    await run("after: apply_payment", unit_of_work, "after", args)
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
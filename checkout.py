@@ -0,0 +1,119 @@
+"""
+Background checkout pipeline.
+
+/payment used to create the invite, insert the order, create the WayForPay invoice and
+store its reference one after another before redirecting, so the buyer waited for
+Discord, the database and WayForPay back to back. Now the request only starts a
+CheckoutJob and answers with a status page; the invite and the invoice are created
+concurrently (the order reference is chosen up front), the order is inserted once with
+both, and the page long-polls /checkout/<token>/status until the invoice url is ready.
+"""
+
+import asyncio
+import secrets
+import statistics
+import time
+from collections import deque
+
+import config
+
+CHECKOUT_TIMEOUT = getattr(config, 'CHECKOUT_TIMEOUT', 30)  # seconds for the whole pipeline
+CHECKOUT_POLL_TIMEOUT = getattr(config, 'CHECKOUT_POLL_TIMEOUT', 25)  # seconds a status long-poll is held open
+CHECKOUT_JOB_TTL = getattr(config, 'CHECKOUT_JOB_TTL', 600)  # seconds a finished job can still be looked up
+CHECKOUT_STAGES = ("invite", "invoice", "order", "total")
+
+
+class CheckoutJob:
+    def __init__(self, token):
+        self.token = token
+        self.state = "pending"  # pending -> ready | failed
+        self.invoice_url = None
+        self.error = None
+        self.timings = {}  # stage -> seconds
+        self.created_at = time.monotonic()
+        self.done = asyncio.Event()
+
+    def status(self):
+        return {
+            "state": self.state,
+            "invoice_url": self.invoice_url,
+            "error": self.error,
+            "timings_ms": {stage: round(seconds * 1000, 1) for stage, seconds in self.timings.items()},
+        }
+
+    async def timed(self, stage, awaitable):
+        start = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.timings[stage] = time.perf_counter() - start
+
+
+class CheckoutRegistry:
+    """Checkout jobs by token, plus the recent per-stage latencies for /metrics/checkout"""
+
+    def __init__(self, ttl=CHECKOUT_JOB_TTL, history=1000):
+        self.ttl = ttl
+        self._jobs = {}
+        self._tasks = set()
+        self._history = {stage: deque(maxlen=history) for stage in CHECKOUT_STAGES}
+
+    def get(self, token):
+        self._expire()
+        return self._jobs.get(token)
+
+    def start(self, pipeline):
+        """Create a job and run `pipeline(job)` in the background; returns the job right away"""
+        self._expire()
+        job = CheckoutJob(secrets.token_urlsafe(16))
+        self._jobs[job.token] = job
+        task = asyncio.create_task(self._run(job, pipeline))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    async def _run(self, job, pipeline):
+        start = time.perf_counter()
+        try:
+            job.invoice_url = await asyncio.wait_for(pipeline(job), timeout=CHECKOUT_TIMEOUT)
+            job.state = "ready"
+        except Exception as e:
+            job.state = "failed"
+            job.error = "Не удалось создать счёт на оплату, попробуйте ещё раз"
+            print(f"Error in checkout {job.token}: {e!r}")
+        job.timings["total"] = time.perf_counter() - start
+        job.done.set()
+
+        for stage, seconds in job.timings.items():
+            self._history[stage].append(seconds)
+        print(f"Checkout {job.token} {job.state}: " +
+              " ".join(f"{stage}={seconds * 1000:.0f}ms" for stage, seconds in job.timings.items()))
+
+    async def wait(self, job, timeout=CHECKOUT_POLL_TIMEOUT):
+        try:
+            await asyncio.wait_for(job.done.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        return job.status()
+
+    def stage_report(self):
+        """p50/p95 milliseconds per stage over the recent checkouts"""
+        report = {}
+        for stage, samples in self._history.items():
+            if samples:
+                ordered = sorted(samples)
+                report[stage] = {
+                    "count": len(ordered),
+                    "p50_ms": round(statistics.median(ordered) * 1000, 1),
+                    "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1),
+                }
+        return report
+
+    def _expire(self):
+        now = time.monotonic()
+        for token in [token for token, job in self._jobs.items()
+                      if job.done.is_set() and now - job.created_at > self.ttl]:
+            del self._jobs[token]
+
+
+checkouts = CheckoutRegistry()
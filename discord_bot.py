@@ -1,120 +1,334 @@
 import time
+import uuid
 import discord
 from discord.ext import commands
 import asyncio
+from collections import defaultdict
+import config
 from config import *
-from sql_scripts import update_user_with_discord_id, select_order_by_discord_link, add_or_update_user
+from sql_scripts import (update_user_with_discord_id, select_order_by_discord_link, add_or_update_user,
+                         add_pending_join, select_pending_joins, claim_pending_join)
+from gateway import bot, run_gateway
 
 
-intents = discord.Intents.default()
-intents.members = True
-intents.message_content = True
+INVITE_MATCH_SETTLE = getattr(config, 'INVITE_MATCH_SETTLE', 2)  # seconds joins are collected before invites are diffed
+INVITE_MATCH_ATTEMPTS = getattr(config, 'INVITE_MATCH_ATTEMPTS', 3)  # diffs per round while fewer uses than joins show up
+INVITE_MATCH_MAX_AGE = getattr(config, 'INVITE_MATCH_MAX_AGE', 60)  # older deletes were revokes, not joins
 
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+class InviteTracker:
+    """
+    Works out which invite each joining member used.
 
+    GUILD_MEMBER_ADD doesn't say which invite was used, and Discord doesn't promise that a
+    single-use invite's INVITE_DELETE arrives before (or after) the join it belongs to, so
+    the order of events can't be trusted. Instead we keep every invite of the guild by code
+    with its use count (kept current by the invite events) and, when members join, collect
+    the joins for INVITE_MATCH_SETTLE seconds and diff one guild.invites() fetch against
+    it: an invite whose uses went up, or a usable single-use invite that disappeared, was
+    used. A join is only attributed when that points at exactly one invite; otherwise the
+    joins of that round are left pending with the invites they could have used, rather
+    than given another buyer's invite (and their order), see resolve_pending_join.
 
-guild_invites = {}
+    This does not get rid of the REST fetch on join: the events alone can't tell which
+    member used which invite, so each round still costs one to INVITE_MATCH_ATTEMPTS
+    guild.invites() calls, shared by all joins that arrive within it.
+    """
 
+    def __init__(self):
+        self.invites = {}  # code -> (url, max_uses, expires_at timestamp or None)
+        self.uses = {}  # code -> uses at the last fetch or event
+        self.deleted = {}  # code -> monotonic time of its INVITE_DELETE, until the next diff
+        self._joins = []  # futures of joins waiting for the next round
+        self._resolver = None
+        self._pruned_at = time.time()
 
-@bot.event
-async def on_ready():
-    print(f"Бот {bot.user} запущен.")
-    for guild in bot.guilds:
-        try:
-            invites = await guild.invites()
-            guild_invites[guild.id] = {invite.code: invite.uses for invite in invites}
-            print(f"Инвайты для {guild.name} сохранены.")
-        except Exception as e:
-            print(f"Ошибка получения инвайтов для {guild.name}: {e}")
+    def track(self, invite):
+        expires_at = invite.expires_at.timestamp() if invite.expires_at else None
+        self.invites[invite.code] = (invite.url, invite.max_uses or 0, expires_at)
+        self.uses[invite.code] = invite.uses or 0
+        self._prune_expired()
 
+    def forget(self, code):
+        """Drop an invite we are about to delete ourselves, so its disappearance isn't taken for a join"""
+        self.invites.pop(code, None)
+        self.uses.pop(code, None)
+        self.deleted.pop(code, None)
 
-async def generate_invite() -> str:
+    def mark_deleted(self, code):
+        if code in self.invites:
+            self.deleted[code] = time.monotonic()
+
+    async def match_join(self, guild):
+        """
+        (url, candidates, batch) for a joining member: url is the invite it used, or None if
+        it can't be told apart from the rest of its round; then candidates are the invite urls
+        the round used (one per use) and batch names the round.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._joins.append(future)
+        if self._resolver is None or self._resolver.done():
+            self._resolver = asyncio.create_task(self._resolve(guild))
+        return await future
+
+    async def _resolve(self, guild):
+        while self._joins:
+            # joins arriving close together are resolved with one fetch
+            await asyncio.sleep(INVITE_MATCH_SETTLE)
+            joins, self._joins = self._joins, []
+            try:
+                url, candidates = await self._attribute(guild, len(joins))
+            except Exception as e:
+                print(f"Ошибка определения инвайта для {guild.name}: {e}")
+                url, candidates = None, []
+            batch = uuid.uuid4().hex
+            for future in joins:
+                if not future.done():
+                    future.set_result((url, candidates, batch))
+
+    async def _attribute(self, guild, joins):
+        """(url, candidates): url for all `joins` if they can only have come through one invite"""
+        used = {}  # code -> [url, new uses]
+        for attempt in range(INVITE_MATCH_ATTEMPTS):
+            for code, (url, count) in (await self._diff(guild)).items():
+                used.setdefault(code, [url, 0])[1] += count
+            if sum(count for _, count in used.values()) >= joins:
+                break
+            await asyncio.sleep(1)
+
+        candidates = [url for url, count in used.values() for _ in range(count)]
+        if len(used) == 1:
+            (url, count), = used.values()
+            if count >= joins:
+                return url, candidates
+        if used:
+            print(f"Неоднозначно: {joins} вход(а/ов), использованы инвайты {sorted(used)}")
+        return None, candidates
+
+    async def seed(self, guild):
+        """Snapshot every invite of the guild, once at startup; afterwards the events and diffs keep it current"""
+        for invite in (await self._fetch(guild)).values():
+            self.track(invite)
+
+    async def _fetch(self, guild):
+        current = {invite.code: invite for invite in await guild.invites()}
+        if "VANITY_URL" in guild.features:
+            # the vanity invite isn't in guild.invites(), but members do join through it
+            try:
+                vanity = await guild.vanity_invite()
+                if vanity is not None:
+                    current[vanity.code] = vanity
+            except discord.HTTPException:
+                pass
+        return current
+
+    async def _diff(self, guild):
+        """code -> (url, uses) of the invites used since the last fetch; refreshes the snapshot"""
+        current = await self._fetch(guild)
+
+        used = {}
+        for code, invite in current.items():
+            # an invite we didn't know about only gives us its baseline
+            new_uses = (invite.uses or 0) - self.uses.get(code, invite.uses or 0)
+            if new_uses > 0:
+                used[code] = (invite.url, new_uses)
+            self.track(invite)
+
+        now, now_monotonic = time.time(), time.monotonic()
+        for code in [code for code in self.invites if code not in current]:
+            url, max_uses, expires_at = self.invites[code]
+            deleted_at = self.deleted.get(code)
+            uses = self.uses.get(code, 0)
+            self.forget(code)
+            # gone because it ran out of uses, not because it expired or was revoked earlier
+            if (max_uses and uses + 1 >= max_uses
+                    and (expires_at is None or expires_at > now)
+                    and (deleted_at is None or now_monotonic - deleted_at <= INVITE_MATCH_MAX_AGE)):
+                used[code] = (url, 1)
+        return used
+
+    def _prune_expired(self):
+        # expired invites vanish without an event, so sweep them out about once an hour
+        now = time.time()
+        if now - self._pruned_at < 3600:
+            return
+        self._pruned_at = now
+        for code in [code for code, (_, _, expires_at) in self.invites.items() if expires_at and expires_at <= now]:
+            self.forget(code)
+
+
+invite_trackers = defaultdict(InviteTracker)  # guild id -> InviteTracker
+
+
+class Invites(commands.Cog):
+    """Keeps invite_trackers in sync with the guild's invites"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.seeded = set()  # guild ids; on_ready fires again after every reconnect
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        print(f"Бот {self.bot.user} запущен.")
+        for guild in self.bot.guilds:
+            if guild.id in self.seeded:
+                continue
+            try:
+                # one fetch at startup, afterwards the invite events and join diffs keep it current
+                await invite_trackers[guild.id].seed(guild)
+                self.seeded.add(guild.id)
+                print(f"Инвайты для {guild.name} сохранены.")
+            except Exception as e:
+                print(f"Ошибка получения инвайтов для {guild.name}: {e}")
+
+    @commands.Cog.listener()
+    async def on_invite_create(self, invite):
+        if invite.guild is not None:
+            invite_trackers[invite.guild.id].track(invite)
+
+    @commands.Cog.listener()
+    async def on_invite_delete(self, invite):
+        if invite.guild is not None:
+            invite_trackers[invite.guild.id].mark_deleted(invite.code)
+
+
+async def create_invite(max_age: int = 0) -> discord.Invite:
     await bot.wait_until_ready()
 
     channel = bot.get_channel(invite_channel_id)
-    print(f"ID канала: {invite_channel_id}")
-    print(f"Канал: {channel}")
 
     if channel is None:
         raise Exception("Канал для генерации инвайта не найден. Проверьте invite_channel_id в конфиге.")
 
     try:
         # Создаем инвайт
-        invite = await channel.create_invite(max_uses=1, unique=True)
+        invite = await channel.create_invite(max_uses=1, max_age=max_age, unique=True)
         guild = channel.guild
 
         # Обновляем локальное состояние инвайтов
-        if guild.id in guild_invites:
-            guild_invites[guild.id][invite.code] = invite.uses
-        else:
-            guild_invites[guild.id] = {invite.code: invite.uses}
+        invite_trackers[guild.id].track(invite)
 
-        return invite.url
+        return invite
     except Exception as e:
         raise Exception(f"Ошибка при создании инвайта: {e}")
 
-@bot.event
-async def on_member_join(member):
-    guild = member.guild
+
+async def generate_invite() -> str:
+    invite = await create_invite()
+    return invite.url
+
+
+async def link_member_to_invite(discord_id, discord_name, discord_server_name, invite_url, joined_at):
+    """Store a member who joined through `invite_url` with the order that invite belongs to"""
     try:
-        current_invites = await guild.invites()
+        order = await select_order_by_discord_link(invite_url)
+
+        if order:
+            email = order['email']
+            link = order['link']
+            sub_time = order['sub_time']
+            date_of_payment = order['order_date']
+
+            # Add user with proper payment dates
+            await add_or_update_user(email, link, discord_name, discord_server_name, discord_id, date_of_payment, sub_time)
+            print(f"Обновлена запись пользователя {email} с Discord ID {discord_id}")
+        else:
+            print(f"Заказ не найден для ссылки {invite_url}")
+            # Add user without payment (will be kicked later)
+            await add_or_update_user('', '', discord_name, discord_server_name, discord_id, joined_at, 1)
     except Exception as e:
-        print(f"Ошибка получения инвайтов для {guild.name}: {e}")
-        return
+        print(f"Ошибка при обработке пользователя с инвайтом: {e}")
+        # Add user without payment as fallback
+        await add_or_update_user('', '', discord_name, discord_server_name, discord_id, joined_at, 1)
 
-    used_invite = None
-    previous_invites = guild_invites.get(guild.id, {})
-    for invite in current_invites:
-        prev_uses = previous_invites.get(invite.code, 0)
-        if invite.uses > prev_uses:
-            used_invite = invite
-            break
 
-    guild_invites[guild.id] = {invite.code: invite.uses for invite in current_invites}
+async def register_member_join(member):
+    guild = member.guild
+    used_invite_url, candidates, batch = await invite_trackers[guild.id].match_join(guild)
 
     discord_id = member.id
     discord_name = member.name
     discord_server_name = member.display_name
     current_time = int(time.time())
 
-    if used_invite:
-        print(f"Пользователь {member} ({member.id}) присоединился по ссылке {used_invite.url}")
-        discord_link = used_invite.url
-
-        try:
-            order = await select_order_by_discord_link(discord_link)
-            
-            if order:
-                email = order['email']
-                link = order['link']
-                sub_time = order['sub_time']
-                date_of_payment = order['order_date']
-
-                # Add user with proper payment dates
-                await add_or_update_user(email, link, discord_name, discord_server_name, discord_id, date_of_payment, sub_time)
-                print(f"Обновлена запись пользователя {email} с Discord ID {member.id}")
-            else:
-                print(f"Заказ не найден для ссылки {discord_link}")
-                # Add user without payment (will be kicked later)
-                await add_or_update_user('', '', discord_name, discord_server_name, discord_id, current_time, 1)
-        except Exception as e:
-            print(f"Ошибка при обработке пользователя с инвайтом: {e}")
-            # Add user without payment as fallback
-            await add_or_update_user('', '', discord_name, discord_server_name, discord_id, current_time, 1)
+    if used_invite_url:
+        print(f"Пользователь {member} ({member.id}) присоединился по ссылке {used_invite_url}")
+        await link_member_to_invite(discord_id, discord_name, discord_server_name, used_invite_url, current_time)
+    elif candidates:
+        # joined together with others through these invites; stored as an unpaid user it would
+        # lose its order (and a renewing member its email), so it waits to be resolved instead
+        print(f"Вход {member.id} неоднозначен, ожидает привязки: {candidates}")
+        await add_pending_join(discord_id, discord_name, discord_server_name, current_time, batch, candidates)
     else:
         print(f"Не удалось определить, по какой ссылке присоединился {member.id}")
         # Add user without payment (will be kicked after grace period)
         await add_or_update_user('', '', discord_name, discord_server_name, discord_id, current_time, 1)
 
-@bot.command()
-@commands.has_permissions(kick_members=True)
-async def kick(ctx, member: discord.Member, *, reason=None):
-    try:
-        await member.kick(reason=reason)
-        await ctx.send(f"{member.mention} был кикнут. Причина: {reason}")
-    except Exception as e:
-        await ctx.send(f"Не удалось кикнуть пользователя: {e}")
+
+async def resolve_pending_join(discord_id, invite_url) -> bool:
+    """
+    Link a pending join to the invite it used. Once that leaves the rest of its round only
+    one way to have joined (as many uses of a single invite as members), they are linked too.
+    """
+    claimed = await claim_pending_join(discord_id, invite_url)
+    if claimed is None:
+        return False
+    join, rest = claimed
+    await link_member_to_invite(join['discord_id'], join['discord_name'], join['discord_server_name'],
+                                invite_url, join['joined_at'])
+    candidates = rest[0]['candidates'] if rest else []
+    if rest and len(candidates) == len(rest) and len(set(candidates)) == 1:
+        for other in rest:
+            await resolve_pending_join(other['discord_id'], candidates[0])
+    return True
+
+
+class JoinTracking(commands.Cog):
+    """Links members who join to the order whose invite they used"""
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        await register_member_join(member)
+
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def pending_joins(self, ctx):
+        """Members whose invite couldn't be determined, with the invites they could have used"""
+        joins = await select_pending_joins()
+        if not joins:
+            await ctx.send("Нет неопределённых входов.")
+            return
+        lines = [f"{join['discord_id']} ({join['discord_name']}): {' '.join(sorted(set(join['candidates'])))}"
+                 for join in joins]
+        await ctx.send("\n".join(lines)[:2000])
+
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def link_join(self, ctx, discord_id: int, invite: str):
+        """Link a pending join to the invite (url or code) it used"""
+        invite_url = invite if "/" in invite else f"https://discord.gg/{invite}"
+        if await resolve_pending_join(discord_id, invite_url):
+            await ctx.send(f"{discord_id} привязан к {invite_url}")
+        else:
+            await ctx.send(f"{discord_id} нет среди неопределённых входов")
+
+    @commands.command()
+    @commands.has_permissions(kick_members=True)
+    async def kick(self, ctx, member: discord.Member, *, reason=None):
+        try:
+            await member.kick(reason=reason)
+            await ctx.send(f"{member.mention} был кикнут. Причина: {reason}")
+        except Exception as e:
+            await ctx.send(f"Не удалось кикнуть пользователя: {e}")
+
+
+async def setup(bot):
+    await bot.add_cog(Invites(bot))
+    await bot.add_cog(JoinTracking(bot))
+
 
 if __name__ == "__main__":
-    bot.run(bot_token)
\ No newline at end of file
+    run_gateway(["discord_bot"])
\ No newline at end of file
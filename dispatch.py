@@ -0,0 +1,86 @@
+"""
+Bounded-concurrency fan-out for the scheduler's Discord jobs and the payment reconciliation.
+
+discord.py already queues requests per rate-limit bucket and retries 429s on its own;
+the limit here keeps a big batch from piling thousands of requests onto one bucket
+(and into the global 50 requests/second limit) at the same time.
+"""
+
+import asyncio
+import time
+
+
+class DispatchStats:
+    """Per-run counters, printed at the end of every scheduler job"""
+
+    def __init__(self, name):
+        self.name = name
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+        self.started_at = time.monotonic()
+        self.finished_at = None
+
+    @property
+    def elapsed(self):
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    def report(self):
+        done = self.succeeded + self.failed
+        rate = done / self.elapsed if self.elapsed > 0 else 0.0
+        return (f"{self.name}: {self.succeeded} succeeded, {self.failed} failed, {self.skipped} skipped "
+                f"in {self.elapsed:.1f}s ({rate:.1f}/s)")
+
+    def add(self, other):
+        """Fold the counters of another run (e.g. one batch of a larger job) into this one"""
+        self.succeeded += other.succeeded
+        self.failed += other.failed
+        self.skipped += other.skipped
+
+
+class RateLimiter:
+    """Spaces calls at least 1/rate seconds apart across all tasks sharing it; rate 0 means no cap"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def dispatch(name, items, worker, concurrency) -> DispatchStats:
+    """
+    Await worker(item) for every item with at most `concurrency` running at once.
+
+    The worker returns True on success, False on a handled failure and None when the
+    item needed no work; an exception counts as a failure and does not stop the batch.
+    """
+    stats = DispatchStats(name)
+    limit = asyncio.Semaphore(concurrency)
+
+    async def run(item):
+        async with limit:
+            try:
+                ok = await worker(item)
+            except Exception as e:
+                print(f"{name}: error processing {item!r}: {e}")
+                ok = False
+        if ok is None:
+            stats.skipped += 1
+        elif ok:
+            stats.succeeded += 1
+        else:
+            stats.failed += 1
+
+    await asyncio.gather(*(run(item) for item in items))
+    stats.finished_at = time.monotonic()
+    return stats
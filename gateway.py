@@ -0,0 +1,61 @@
+"""
+The one Discord gateway connection shared by every service.
+
+Invites, join tracking, warnings, kicks and payment reconciliation are cogs loaded as
+extensions into this bot, so there is a single IDENTIFY, a single member cache and a
+single event loop instead of one bot per module. Which extensions load is configurable
+with GATEWAY_EXTENSIONS.
+"""
+
+import importlib
+import os
+import sys
+import discord
+from discord.ext import commands
+import config
+from config import bot_token
+
+GATEWAY_EXTENSIONS = getattr(config, 'GATEWAY_EXTENSIONS', ["discord_bot", "scheduler", "reconcile"])
+
+intents = discord.Intents.default()
+intents.members = True
+intents.guilds = True
+intents.message_content = True
+
+
+class Gateway(commands.Bot):
+    def __init__(self, extensions=None):
+        # the scheduler used to be its own bot with the "!scheduler_" prefix; keep those commands working
+        super().__init__(command_prefix=["!scheduler_", "!"], intents=intents)
+        self.extension_names = list(GATEWAY_EXTENSIONS if extensions is None else extensions)
+
+    async def setup_hook(self):
+        # plain imports rather than load_extension: that would execute a second copy of modules
+        # like discord_bot that app_main has already imported, with their own invite trackers
+        for name in self.extension_names:
+            await extension_module(name).setup(self)
+            print(f"Loaded gateway extension {name}")
+
+
+def extension_module(name):
+    """
+    The module for an extension name. When that module is the script being run
+    (`python scheduler.py`), it is __main__ and importing it by name would execute a
+    second copy with its own locks, task loops and trackers, so __main__ is reused.
+    """
+    main = sys.modules.get("__main__")
+    main_name = getattr(getattr(main, "__spec__", None), "name", None) or \
+        os.path.splitext(os.path.basename(getattr(main, "__file__", "") or ""))[0]
+    if main is not None and main_name == name and name not in sys.modules:
+        sys.modules[name] = main
+    return importlib.import_module(name)
+
+
+bot = Gateway()
+
+
+def run_gateway(extensions=None):
+    """Run the gateway on its own, e.g. `python scheduler.py` with only the scheduler cogs"""
+    if extensions is not None:
+        bot.extension_names = list(extensions)
+    bot.run(bot_token)
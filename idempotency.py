@@ -0,0 +1,62 @@
+"""
+Deduplication of WayForPay webhook deliveries.
+
+WayForPay retries serviceUrl callbacks until it receives a signed accept, so the same
+(orderReference, transactionStatus, processingDate) can arrive several times. Recently
+seen deliveries live in a small in-process LRU with a TTL, keyed both by a fingerprint of
+the raw body and by the delivery key, so most retries are answered without parsing the
+body or querying the database; the webhook_deliveries table (written in the same transaction as the
+payment, see sql_scripts.apply_payment_once) catches the rest, e.g. after a restart.
+"""
+
+import hashlib
+import time
+from collections import OrderedDict
+
+import config
+
+WEBHOOK_DEDUP_CACHE_SIZE = getattr(config, 'WEBHOOK_DEDUP_CACHE_SIZE', 10000)
+WEBHOOK_DEDUP_TTL = getattr(config, 'WEBHOOK_DEDUP_TTL', 86400)  # seconds a delivery key is remembered in memory
+
+
+def delivery_key(data):
+    """(orderReference, transactionStatus, processingDate) of a callback payload; ValueError for a non-numeric date"""
+    return (data.get("orderReference"), data.get("transactionStatus") or "", int(data.get("processingDate") or 0))
+
+
+def body_fingerprint(body: bytes) -> bytes:
+    return hashlib.blake2b(body, digest_size=16).digest()
+
+
+class TTLCache:
+    """LRU mapping that also forgets entries older than `ttl` seconds"""
+
+    def __init__(self, max_size=WEBHOOK_DEDUP_CACHE_SIZE, ttl=WEBHOOK_DEDUP_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (value, time added)
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        if time.monotonic() - entry[1] > self.ttl:
+            del self._entries[key]
+            return default
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, key, value):
+        self._entries[key] = (value, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+seen_deliveries = TTLCache()  # body fingerprint or delivery key -> orderReference
@@ -0,0 +1,121 @@
+"""
+Pool of pre-generated single-use Discord invites for checkout.
+
+Creating an invite is a Discord REST call, so instead of doing it inside /payment a
+background task keeps INVITE_POOL_SIZE invites ready and checkout just pops one. The
+pool is mirrored in the pooled_invites table so it survives restarts.
+"""
+
+import asyncio
+import time
+from collections import deque
+
+import config
+from sql_scripts import add_pooled_invite, select_pooled_invites, delete_pooled_invites
+
+INVITE_POOL_SIZE = getattr(config, 'INVITE_POOL_SIZE', 20)
+INVITE_POOL_LOW_WATER = getattr(config, 'INVITE_POOL_LOW_WATER', 5)  # refill once fewer are left
+INVITE_POOL_CHECK_INTERVAL = getattr(config, 'INVITE_POOL_CHECK_INTERVAL', 3600)  # seconds between eviction passes
+# 0 keeps pooled invites valid forever, like the ones generated at checkout. With a max age,
+# invites that would expire within INVITE_POOL_MIN_REMAINING seconds are never handed out,
+# so a buyer always has that long to join after receiving the email.
+INVITE_POOL_MAX_AGE = getattr(config, 'INVITE_POOL_MAX_AGE', 0)
+INVITE_POOL_MIN_REMAINING = getattr(config, 'INVITE_POOL_MIN_REMAINING', 3 * 86400)
+
+
+class InvitePool:
+    def __init__(self, create_invite, size=INVITE_POOL_SIZE, low_water=INVITE_POOL_LOW_WATER,
+                 max_age=INVITE_POOL_MAX_AGE, min_remaining=INVITE_POOL_MIN_REMAINING):
+        self._create_invite = create_invite  # async (max_age) -> discord.Invite
+        self.size = size
+        self.low_water = low_water
+        self.max_age = max_age
+        # a fresh invite must count as usable, otherwise the refill loop would evict it straight away
+        self.min_remaining = min(min_remaining, max_age // 2) if max_age else min_remaining
+        self._invites = deque()  # (code, url, expires_at or None)
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._background = set()
+
+    def __len__(self):
+        return len(self._invites)
+
+    async def start(self):
+        """Load the persisted pool and start refilling it; safe to call on every on_ready"""
+        if self._task is not None:
+            return
+        self._invites.extend(tuple(row) for row in await select_pooled_invites())
+        print(f"Invite pool loaded with {len(self._invites)} invites")
+        self._task = asyncio.create_task(self._run())
+
+    def pop(self):
+        """Url of a ready invite, or None if the pool is empty (caller creates one itself)"""
+        entry = self.take()
+        return entry[1] if entry else None
+
+    def take(self):
+        """(code, url, expires_at) of a ready invite, or None if the pool is empty"""
+        now = time.time()
+        entry = None
+        stale = []
+        while self._invites:
+            code, invite_url, expires_at = self._invites.popleft()
+            stale.append(code)  # handed out or unusable, the row can go either way
+            if self._usable(expires_at, now):
+                entry = (code, invite_url, expires_at)
+                break
+
+        if stale:
+            self._spawn(delete_pooled_invites(stale))
+        if len(self._invites) < self.low_water:
+            self._wakeup.set()
+        return entry
+
+    async def give_back(self, entry):
+        """Return an invite that was taken but never sent to anyone, e.g. after a failed checkout"""
+        code, url, expires_at = entry
+        if not self._usable(expires_at, time.time()):
+            return
+        self._invites.appendleft(entry)
+        await add_pooled_invite(code, url, expires_at)
+
+    def _usable(self, expires_at, now):
+        return expires_at is None or expires_at - now >= self.min_remaining
+
+    def _spawn(self, coro):
+        # keep a reference so the task isn't garbage collected before it finishes
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _evict_expiring(self):
+        now = time.time()
+        evicted = [code for code, _, expires_at in self._invites if not self._usable(expires_at, now)]
+        if evicted:
+            evicted_codes = set(evicted)
+            self._invites = deque(entry for entry in self._invites if entry[0] not in evicted_codes)
+            await delete_pooled_invites(evicted)
+            print(f"Evicted {len(evicted)} expiring invites from the pool")
+
+    async def _fill(self):
+        while len(self._invites) < self.size:
+            invite = await self._create_invite(max_age=self.max_age)
+            expires_at = int(invite.expires_at.timestamp()) if invite.expires_at else None
+            await add_pooled_invite(invite.code, invite.url, expires_at)
+            self._invites.append((invite.code, invite.url, expires_at))
+
+    async def _run(self):
+        while True:
+            try:
+                await self._evict_expiring()
+                await self._fill()
+            except Exception as e:
+                print(f"Error refilling invite pool: {e}")
+                await asyncio.sleep(30)
+                continue
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=INVITE_POOL_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
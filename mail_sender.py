@@ -1,11 +1,113 @@
 import smtplib
 import asyncio
+import time
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from notifications import paid_orders
 from sql_scripts import *
+import config
 from config import *
 
 
+# Seconds between reconciliation sweeps for paid orders that were not announced through
+# notifications.paid_orders (e.g. when this service runs as a separate process)
+MAIL_RECONCILE_INTERVAL = getattr(config, 'MAIL_RECONCILE_INTERVAL', 300)
+MAIL_CLAIM_BATCH_SIZE = getattr(config, 'MAIL_CLAIM_BATCH_SIZE', 100)  # paid orders claimed per statement
+
+SMTP_SERVER = getattr(config, 'SMTP_SERVER', 'localhost')
+SMTP_PORT = getattr(config, 'SMTP_PORT', 25)
+SMTP_USERNAME = getattr(config, 'SMTP_USERNAME', None)
+SMTP_PASSWORD = getattr(config, 'SMTP_PASSWORD', None)
+SMTP_STARTTLS = getattr(config, 'SMTP_STARTTLS', True)
+SMTP_POOL_SIZE = getattr(config, 'SMTP_POOL_SIZE', 4)  # persistent connections = emails sent in parallel
+SMTP_IDLE_TIMEOUT = getattr(config, 'SMTP_IDLE_TIMEOUT', 60)  # seconds before an idle connection is re-checked
+
+
+class SMTPPool:
+    """
+    Small pool of persistent, authenticated SMTP connections.
+
+    smtplib is blocking, so every send runs in a worker thread and the event loop stays
+    free. At most `size` sends run at once, each on its own connection, and connections
+    are kept open between emails instead of doing EHLO/STARTTLS/login per message.
+    """
+
+    def __init__(self, host, port, username=None, password=None, starttls=True, size=4, idle_timeout=60, timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = []  # (connection, last used at)
+        self._semaphore = asyncio.Semaphore(size)
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        server.ehlo()
+        if self.starttls:
+            server.starttls()
+            server.ehlo()
+        if self.username:
+            server.login(self.username, self.password)
+        return server
+
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+    def _send_blocking(self, server, idle_for, sender, receiver, message):
+        """Runs in a worker thread, returns the connection to keep for the next email"""
+        if server is not None and idle_for > self.idle_timeout:
+            # servers drop idle clients, so make sure a long-unused connection is still alive
+            try:
+                server.noop()
+            except (smtplib.SMTPException, OSError):
+                self._close(server)
+                server = None
+
+        if server is None:
+            server = self._connect()
+
+        try:
+            server.sendmail(sender, receiver, message)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            server = self._connect()
+            try:
+                server.sendmail(sender, receiver, message)
+            except Exception:
+                # send() only knows about the dead connection, so the new one is closed here
+                self._close(server)
+                raise
+        return server
+
+    async def send(self, sender, receiver, message):
+        async with self._semaphore:
+            server, last_used = self._idle.pop() if self._idle else (None, 0)
+            try:
+                server = await asyncio.to_thread(
+                    self._send_blocking, server, time.monotonic() - last_used, sender, receiver, message
+                )
+            except Exception:
+                if server is not None:
+                    await asyncio.to_thread(self._close, server)
+                raise
+            self._idle.append((server, time.monotonic()))
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for server, _ in idle:
+            await asyncio.to_thread(self._close, server)
+
+
+smtp_pool = SMTPPool(SMTP_SERVER, SMTP_PORT, SMTP_USERNAME, SMTP_PASSWORD,
+                     starttls=SMTP_STARTTLS, size=SMTP_POOL_SIZE, idle_timeout=SMTP_IDLE_TIMEOUT)
+
+
 async def extract_name_from_email(email: str) -> str:
     local_part = email.split('@')[0]
     parts = local_part.split('.')
@@ -14,9 +116,6 @@ async def extract_name_from_email(email: str) -> str:
 
 
 async def send_mail(receiver_email: str, discord_link: str, order_reference: str) -> None:
-    smtp_server = "localhost"
-    smtp_port = 25
-    # если необходимо, задайте username и password для smtp (здесь они не используются)
     sender_email = "info@mail.upworkrevolution.com"
     subject = "Доступ до Discord каналу"
 
@@ -39,55 +138,69 @@ async def send_mail(receiver_email: str, discord_link: str, order_reference: str
     message["Subject"] = subject
     message.attach(MIMEText(body, "plain"))
 
-    server = None
     try:
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.ehlo()
-        server.starttls()
-        server.ehlo()
-        server.sendmail(sender_email, receiver_email, message.as_string())
+        await smtp_pool.send(sender_email, receiver_email, message.as_string())
         print(f"✓ Email sent successfully for order {order_reference} to {receiver_email}")
     except Exception as e:
         print(f"❌ Error sending email for order {order_reference}: {e}")
-    finally:
-        if server is not None:
-            server.quit()
+
+
+async def deliver_order(order) -> None:
+    """Send the invite email for an order already claimed with claim_paid_orders"""
+    await send_mail(order['email'], order['link'], order['order_reference'])
+    print(f"✓ Order {order['order_reference']} processed and email sent")
+
+
+async def deliver_orders(orders) -> None:
+    """Deliver a backlog of paid orders, as many at a time as there are SMTP connections"""
+    limit = asyncio.Semaphore(SMTP_POOL_SIZE)
+
+    async def deliver(order):
+        async with limit:
+            await deliver_order(order)
+
+    await asyncio.gather(*(deliver(order) for order in orders))
+
+
+async def deliver_paid_order_event(order_reference) -> None:
+    """Handle a paid order published by the payment callback"""
+    try:
+        # empty when the sweep or another worker has already claimed it
+        await deliver_orders(await claim_paid_orders(limit=1, order_reference=order_reference))
+    except Exception as e:
+        # the order stays paid, so the next reconciliation sweep retries it
+        print(f"❌ Error delivering paid order {order_reference}: {e}")
+
+
+async def sweep_paid_orders() -> None:
+    """Claim and deliver paid orders in batches until none are left"""
+    while True:
+        orders = await claim_paid_orders(MAIL_CLAIM_BATCH_SIZE)
+        if orders:
+            print(f"📬 Claimed {len(orders)} paid orders to process")
+            await deliver_orders(orders)
+        if len(orders) < MAIL_CLAIM_BATCH_SIZE:
+            return
 
 
 async def main():
     """Main mail service loop"""
-    print("📧 Mail service started - monitoring for paid orders...")
+    print("📧 Mail service started - waiting for paid orders...")
+
+    # Paid orders are pushed by app_main.callback_success. The sweep below is only a
+    # reconciliation pass for orders paid while this service was down or in another process.
+    paid_events = paid_orders.subscribe()
+    loop = asyncio.get_running_loop()
     
     consecutive_errors = 0
     max_consecutive_errors = 5
     
     while True:
         try:
-            orders = await select_orders_with_paid_status()
-            
-            if orders:
-                print(f"📬 Found {len(orders)} paid orders to process")
-                
-                for order in orders:
-                    order_reference = order['order_reference']
-                    receiver_email = order['email']
-                    discord_link = order['link']
-
-                    # Try to update order status first (prevents duplicate emails)
-                    updated = await update_order_status_by_order_reference_v2(order_reference, finished_order_status)
-                    
-                    if updated:
-                        await send_mail(receiver_email, discord_link, order_reference)
-                        print(f"✓ Order {order_reference} processed and email sent")
-                    else:
-                        print(f"⚠ Order {order_reference} was not updated (possibly already processed)")
+            await sweep_paid_orders()
                         
-                # Reset error counter on successful processing
-                consecutive_errors = 0
-                
-            else:
-                # No orders to process - this is normal
-                pass
+            # Reset error counter on successful processing
+            consecutive_errors = 0
                 
         except Exception as e:
             consecutive_errors += 1
@@ -101,8 +214,14 @@ async def main():
             await asyncio.sleep(10)
             continue
         
-        # Normal processing interval
-        await asyncio.sleep(5)
+        # Handle paid order events as they arrive until the next reconciliation sweep is due
+        next_sweep = loop.time() + MAIL_RECONCILE_INTERVAL
+        while (remaining := next_sweep - loop.time()) > 0:
+            try:
+                order_reference = await asyncio.wait_for(paid_events.get(), timeout=remaining)
+            except asyncio.TimeoutError:
+                break
+            await deliver_paid_order_event(order_reference)
 
 
 def run_mail_service():
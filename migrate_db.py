@@ -2,12 +2,15 @@
 """
 Database migration script to add new columns and update existing data
 Run this script once before starting the updated application
+
+    python migrate_db.py --indexes   # only create missing tables and model indexes, safe to repeat on a live database
 """
 
 import asyncio
+import sys
 import time
 from sqlalchemy import text
-from models import engine, async_session, Users
+from models import get_engine, async_session, Base, Users
 from sqlalchemy import select
 
 async def migrate_database():
@@ -15,7 +18,7 @@ async def migrate_database():
     print("Starting database migration...")
     
     try:
-        async with engine.begin() as conn:
+        async with get_engine().begin() as conn:
             print("1. Adding last_date_of_payment column...")
             try:
                 await conn.execute(text(
@@ -127,6 +130,93 @@ async def migrate_database():
     return True
 
 
+# Hot lookups from sql_scripts.py, used to show the query plans around the index migration
+HOT_QUERIES = [
+    ("webhook: order by reference", "SELECT * FROM orders WHERE order_reference = :value", "DH0000000000"),
+    ("member join: order by invite link", "SELECT * FROM orders WHERE link = :value", "https://discord.gg/x"),
+    ("checkout: order by order_id", "SELECT * FROM orders WHERE order_id = :value", 0),
+    ("mail sweep: paid orders", "SELECT * FROM orders WHERE order_status = :value ORDER BY order_date", 1),
+    ("payment: user by email", "SELECT * FROM users WHERE email = :value", "user@example.com"),
+    ("member join: user by link", "SELECT * FROM users WHERE link = :value", "https://discord.gg/x"),
+    ("scheduler: users by last payment", "SELECT * FROM users WHERE last_date_of_payment < :value", 0),
+]
+
+
+def model_indexes():
+    """(name, table, columns, unique) for every index declared in models.py"""
+    for table in Base.metadata.sorted_tables:
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            yield index.name, table.name, ", ".join(column.name for column in index.columns), bool(index.unique)
+
+
+async def explain_hot_queries():
+    explain = "EXPLAIN QUERY PLAN" if get_engine().dialect.name == "sqlite" else "EXPLAIN"
+    async with get_engine().connect() as conn:
+        for label, query, value in HOT_QUERIES:
+            try:
+                result = await conn.execute(text(f"{explain} {query}"), {"value": value})
+                plan = [str(row[-1]) for row in result]
+            except Exception as e:
+                plan = [f"⚠ {e}"]
+            print(f"   {label}:")
+            for line in plan:
+                print(f"      {line}")
+
+
+async def create_index(conn, name, table, columns, unique):
+    unique_sql = "UNIQUE " if unique else ""
+
+    if get_engine().dialect.name != "postgresql":
+        await conn.execute(text(f"CREATE {unique_sql}INDEX IF NOT EXISTS {name} ON {table} ({columns})"))
+        return
+
+    # An interrupted CREATE INDEX CONCURRENTLY leaves an INVALID index behind which
+    # IF NOT EXISTS would happily skip, so drop it first and build it again
+    result = await conn.execute(text(
+        "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"
+    ), {"name": name})
+    if result.scalar() is False:
+        print(f"   ⚠ {name} is INVALID (interrupted build), rebuilding")
+        await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+    # CONCURRENTLY builds the index without locking out writes, so this can run on a live database
+    await conn.execute(text(f"CREATE {unique_sql}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns})"))
+
+
+async def migrate_indexes():
+    """Create the tables and indexes that were added to models.py after the database was created"""
+    # New tables (e.g. job_cursors) only need creating; create_all leaves existing ones alone
+    print("Creating missing tables...")
+    try:
+        async with get_engine().begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+    except Exception as e:
+        print(f"Error creating tables: {e}")
+        return False
+
+    print("Query plans before:")
+    await explain_hot_queries()
+
+    print("Creating indexes...")
+    failed = False
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    async with get_engine().connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        for name, table, columns, unique in model_indexes():
+            try:
+                await create_index(conn, name, table, columns, unique)
+                print(f"   ✓ {name} on {table} ({columns})")
+            except Exception as e:
+                # e.g. duplicate order references preventing a unique index
+                print(f"   ⚠ Error creating {name}: {e}")
+                failed = True
+
+    print("Query plans after:")
+    await explain_hot_queries()
+
+    return not failed
+
+
 async def check_database_status():
     """Check current database status"""
     print("Checking current database status...")
@@ -171,6 +261,14 @@ async def check_database_status():
 
 
 if __name__ == "__main__":
+    if "--indexes" in sys.argv:
+        # Index-only migration: does not touch user data and can be run any number of times
+        if asyncio.run(migrate_indexes()):
+            print("\n✅ Indexes are up to date.")
+            exit(0)
+        print("\n❌ Index migration failed. Please check the errors above and try again.")
+        exit(1)
+
     print("=== Discord Bot Database Migration ===")
     print("This script will update your database to support:")
     print("- 30-day payment warnings")
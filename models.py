@@ -1,49 +1,231 @@
 import logging
 import asyncio
+import threading
+import time
+import weakref
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy import exc
 from sqlalchemy.orm import declarative_base, sessionmaker, class_mapper
-from sqlalchemy import Column, Integer, String, BigInteger, Float, insert, update, delete, Float, Boolean
+from sqlalchemy import Column, Integer, String, BigInteger, Float, insert, update, delete, Float, Boolean, Index
 from sqlalchemy import select
 from datetime import datetime, timedelta
+import config
 from config import *
 
 
 Base = declarative_base()
 
 
-engine = create_async_engine(DATABASE_URL, echo=False)
-async_session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+DB_POOL_SIZE = getattr(config, 'DB_POOL_SIZE', 5)  # connections kept open per engine
+DB_MAX_OVERFLOW = getattr(config, 'DB_MAX_OVERFLOW', 10)  # extra connections allowed under load
+DB_POOL_TIMEOUT = getattr(config, 'DB_POOL_TIMEOUT', 30)  # seconds to wait for a free connection
+DB_POOL_RECYCLE = getattr(config, 'DB_POOL_RECYCLE', 1800)  # reconnect connections older than this
+DB_POOL_PRE_PING = getattr(config, 'DB_POOL_PRE_PING', True)  # test connections on checkout
+# asyncpg/aiosqlite connections belong to the event loop that opened them, and the web
+# app/gateway and the mail service run on different loops, so each loop gets its own engine
+DB_ENGINE_PER_LOOP = getattr(config, 'DB_ENGINE_PER_LOOP', True)
+
+
+class PoolMetrics:
+    """Checkout counters shared by every engine's pool"""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.overflow_events = 0  # checkouts that had to open a connection beyond pool_size
+        self.timeouts = 0
+        self._lock = threading.Lock()
+
+    def record_checkout(self, waited):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def record_overflow(self):
+        with self._lock:
+            self.overflow_events += 1
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def snapshot(self):
+        # in-memory SQLite keeps its default pool, which has no counters
+        pools = [engine.pool for engine in list(_engines.values()) if isinstance(engine.pool, InstrumentedPool)]
+        with self._lock:
+            return {
+                "engines": len(pools),
+                "pool_size": DB_POOL_SIZE,
+                "max_overflow": DB_MAX_OVERFLOW,
+                "in_use": sum(pool.checkedout() for pool in pools),
+                "idle": sum(pool.checkedin() for pool in pools),
+                "overflow": sum(max(pool.overflow(), 0) for pool in pools),
+                "checkouts": self.checkouts,
+                "checkout_wait_avg_ms": round(self.wait_total / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+                "checkout_wait_max_ms": round(self.wait_max * 1000, 3),
+                "overflow_events": self.overflow_events,
+                "timeouts": self.timeouts,
+            }
+
+
+pool_metrics = PoolMetrics()
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long each checkout waited and when it overflowed"""
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except exc.TimeoutError:
+            pool_metrics.record_timeout()
+            raise
+        pool_metrics.record_checkout(time.perf_counter() - start)
+        return connection
+
+    def _inc_overflow(self):
+        allowed = super()._inc_overflow()
+        if allowed and self._overflow > 0:
+            pool_metrics.record_overflow()
+        return allowed
+
+
+_engines = weakref.WeakKeyDictionary()  # event loop (or the module itself) -> engine
+_engines_lock = threading.Lock()
+database_url = DATABASE_URL
+
+
+def create_engine_for_url(url):
+    options = {"echo": False}
+    if ":memory:" not in url:
+        # in-memory SQLite has to stay on a single connection, so it keeps the default pool
+        options.update(
+            poolclass=InstrumentedPool,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_pre_ping=DB_POOL_PRE_PING,
+        )
+    return create_async_engine(url, **options)
+
+
+def get_engine():
+    """Engine owned by the running event loop (or one shared engine with DB_ENGINE_PER_LOOP off)"""
+    if DB_ENGINE_PER_LOOP:
+        try:
+            owner = asyncio.get_running_loop()
+        except RuntimeError:
+            owner = Base  # called outside a loop, e.g. to inspect the dialect
+    else:
+        owner = Base
+    with _engines_lock:
+        engine = _engines.get(owner)
+        if engine is None:
+            engine = _engines[owner] = create_engine_for_url(database_url)
+        return engine
+
+
+def async_session():
+    return AsyncSession(get_engine(), expire_on_commit=False)
+
+
+async def dispose_engine():
+    """Close the running loop's connections, e.g. when its service shuts down"""
+    owner = asyncio.get_running_loop() if DB_ENGINE_PER_LOOP else Base
+    with _engines_lock:
+        engine = _engines.pop(owner, None)
+    if engine is not None:
+        await engine.dispose()
+
+
+def use_database(url):
+    """Point every future engine at another database (benchmarks use a scratch one)"""
+    global database_url
+    with _engines_lock:
+        database_url = url
+        _engines.clear()
 
 
 class Orders(Base):
     __tablename__ = 'orders'
     id = Column(Integer, primary_key=True)
-    order_id = Column(Integer)
+    order_id = Column(Integer, index=True, unique=True)  # allocated by service_functions.add_new_order
     email = Column(String)
-    link = Column(String)
+    link = Column(String, index=True)  # invite url, matched on member join
     amount_to_pay = Column(String)
-    order_reference = Column(String)
+    order_reference = Column(String, index=True, unique=True)  # WayForPay webhooks look orders up by it
     sub_time = Column(Integer)
     order_date = Column(Integer)
     order_status = Column(Integer)
 
+    __table_args__ = (
+        # mail sweep / pending order lookups filter on status and walk by date
+        Index('ix_orders_order_status_order_date', 'order_status', 'order_date'),
+    )
+
 
 class Users(Base):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
-    email = Column(String)
-    link = Column(String)
+    email = Column(String, index=True)
+    link = Column(String, index=True)
     discord_name = Column(String)
     discord_server_name = Column(String)
     discord_id = Column(Integer, unique=True)
     date_of_payment = Column(Integer)  # Initial join/payment date
-    last_date_of_payment = Column(Integer)  # Last payment date (for renewals)
+    last_date_of_payment = Column(Integer, index=True)  # Last payment date (for renewals)
     sub_time = Column(Integer)  # Subscription expiry timestamp
     warned_30_days = Column(Boolean, default=False)  # Whether user received 30-day warning
 
+    __table_args__ = (
+        Index('ix_users_discord_id_last_date_of_payment', 'discord_id', 'last_date_of_payment'),
+    )
+
+
+class JobCursors(Base):
+    """Progress of long-running scheduler jobs, so an interrupted run can resume"""
+    __tablename__ = 'job_cursors'
+    name = Column(String, primary_key=True)
+    position = Column(Integer)  # last processed row id
+    updated_at = Column(Integer)
+
+
+class PooledInvites(Base):
+    """Pre-generated single-use invites waiting to be handed out at checkout (see invite_pool.py)"""
+    __tablename__ = 'pooled_invites'
+    code = Column(String, primary_key=True)
+    url = Column(String)
+    expires_at = Column(Integer)  # unix time, NULL = never expires
+    created_at = Column(Integer)
+
+
+class WebhookDeliveries(Base):
+    """WayForPay callbacks already applied, so retried deliveries are acknowledged without redoing them"""
+    __tablename__ = 'webhook_deliveries'
+    order_reference = Column(String, primary_key=True)
+    transaction_status = Column(String, primary_key=True)
+    processing_date = Column(Integer, primary_key=True)  # 0 when the callback had none
+    received_at = Column(Integer, index=True)  # rows past the retry window are pruned by it
+
+
+class PendingJoins(Base):
+    """Members whose invite couldn't be told apart from others joining at the same time (see discord_bot.py)"""
+    __tablename__ = 'pending_joins'
+    discord_id = Column(BigInteger, primary_key=True)
+    discord_name = Column(String)
+    discord_server_name = Column(String)
+    joined_at = Column(Integer)
+    batch = Column(String, index=True)  # joins attributed together share it, and their candidates
+    candidates = Column(String)  # space-separated invite urls used in the batch, one per use
+
 
 async def init_db():
-    async with engine.begin() as conn:
+    async with get_engine().begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
 
 
@@ -51,7 +233,7 @@ async def init_db():
 async def migrate_add_new_columns():
     """Add new columns to existing Users table"""
     try:
-        async with engine.begin() as conn:
+        async with get_engine().begin() as conn:
             # Add last_date_of_payment column if it doesn't exist
             try:
                 await conn.execute(
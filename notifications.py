@@ -0,0 +1,227 @@
+"""
+In-process notifications between the services.
+
+start_all_services.py runs the web app (with the Discord gateway) and the mail service on
+their own threads, each with its own event loop, so publishing hands the item to every subscriber's
+loop with call_soon_threadsafe instead of touching its queue directly. PaymentWaiters does the
+same for code waiting on one order's payment, and can also hear about payments applied by
+another process through the database.
+"""
+
+import asyncio
+import threading
+import weakref
+
+import config
+from idempotency import TTLCache
+
+PAYMENT_CHANNEL = "orders_paid"  # Postgres NOTIFY channel, payload is the order_id
+PAYMENT_WAIT_TIMEOUT = getattr(config, 'PAYMENT_WAIT_TIMEOUT', 300)  # seconds wait_for_payment waits by default
+PAYMENT_LISTEN = getattr(config, 'PAYMENT_LISTEN', True)  # also pick up payments applied by other processes
+PAYMENT_WATCH_INTERVAL = getattr(config, 'PAYMENT_WATCH_INTERVAL', 0.5)  # seconds between SQLite data_version checks
+PAYMENT_LISTEN_RETRY = 5  # seconds before a failed listener connects again
+
+
+class Topic:
+    """Fan-out of published items to asyncio queues living on any loop or thread"""
+
+    def __init__(self, name):
+        self.name = name
+        self._subscribers = []  # (loop, queue)
+        self._lock = threading.Lock()
+
+    def subscribe(self) -> asyncio.Queue:
+        """Queue on the running loop that receives every item published from now on"""
+        queue = asyncio.Queue()
+        with self._lock:
+            self._subscribers.append((asyncio.get_running_loop(), queue))
+        return queue
+
+    def unsubscribe(self, queue):
+        with self._lock:
+            self._subscribers = [(loop, q) for loop, q in self._subscribers if q is not queue]
+
+    def publish(self, item) -> int:
+        """Thread-safe, never blocks. Returns how many subscribers the item was handed to"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+
+        delivered = 0
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+                delivered += 1
+            except RuntimeError:
+                # subscriber's loop is already closed
+                self.unsubscribe(queue)
+        return delivered
+
+
+def _complete(future):
+    if not future.done():
+        future.set_result(True)
+
+
+class PaymentWaiters:
+    """
+    Futures keyed by order_id that complete when the order is paid.
+
+    The code that marks an order paid (the success webhook, the reconciliation job) calls
+    resolve(), so a waiter in the same process wakes up without a single query. For payments
+    applied by another process, the first wait on a loop starts a listener on that loop's
+    database: on Postgres it LISTENs on PAYMENT_CHANNEL over a connection of its own
+    (outside the engine's pool), and the payment transaction NOTIFYs on commit; on SQLite
+    it watches PRAGMA data_version, which only changes when another connection commits.
+    It looks at the waited-for orders only when that happens (or after reconnecting).
+    """
+
+    def __init__(self, listen=PAYMENT_LISTEN):
+        self.listen = listen
+        self._waiters = {}  # order_id -> [(loop, future)]
+        self._recently_paid = TTLCache(ttl=PAYMENT_WAIT_TIMEOUT)  # for waits that start after the payment
+        self._listeners = weakref.WeakKeyDictionary()  # loop -> listener task
+        self._lock = threading.Lock()
+
+    async def wait(self, order_id, timeout=PAYMENT_WAIT_TIMEOUT) -> bool:
+        """True once the order is paid, False if `timeout` seconds pass first"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        listening = False
+        with self._lock:
+            if order_id in self._recently_paid:
+                return True
+            self._waiters.setdefault(order_id, []).append((loop, future))
+            if self.listen:
+                listener = self._listeners.get(loop)
+                if listener is None or listener.done():
+                    self._listeners[loop] = loop.create_task(self._listen())
+                else:
+                    listening = True
+        try:
+            if listening:
+                # a running listener only looks at the waited-for orders when it hears of a
+                # payment, so one another process committed before this wait would be missed
+                await self._check_paid(order_id)
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._discard(order_id, future)
+
+    def resolve(self, order_id) -> int:
+        """Thread-safe, never blocks. Wakes every waiter of the order, returns how many there were"""
+        with self._lock:
+            self._recently_paid.put(order_id, True)
+            waiters = self._waiters.pop(order_id, [])
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_complete, future)
+            except RuntimeError:
+                pass  # waiter's loop is already closed
+        return len(waiters)
+
+    def waiting(self) -> list:
+        """order_ids somebody is waiting for"""
+        with self._lock:
+            return list(self._waiters)
+
+    def _discard(self, order_id, future):
+        with self._lock:
+            waiters = [(loop, f) for loop, f in self._waiters.get(order_id, []) if f is not future]
+            if waiters:
+                self._waiters[order_id] = waiters
+            else:
+                self._waiters.pop(order_id, None)
+
+    async def _check_paid(self, order_id):
+        from models import get_engine
+
+        try:
+            async with get_engine().connect() as conn:
+                await self._resolve_paid(conn, [order_id])
+        except Exception as e:
+            print(f"Error checking payment of order {order_id}: {e!r}")
+
+    async def _resolve_paid(self, conn, order_ids=None):
+        """One query for the waited-for orders (or just `order_ids`) that are already paid"""
+        from sqlalchemy import select
+        from models import Orders
+
+        if order_ids is None:
+            order_ids = self.waiting()
+        if not order_ids:
+            return
+        result = await conn.execute(select(Orders.order_id).where(
+            Orders.order_id.in_(order_ids),
+            Orders.order_status.in_((config.paid_order_status, config.finished_order_status))
+        ))
+        for (order_id,) in result:
+            self.resolve(order_id)
+
+    async def _listen(self):
+        from models import get_engine
+
+        while True:
+            engine = get_engine()
+            try:
+                if engine.dialect.name == "postgresql":
+                    await self._listen_postgres(engine)
+                elif engine.dialect.name == "sqlite":
+                    await self._watch_sqlite(engine)
+                else:
+                    print(f"No payment listener for {engine.dialect.name}, only in-process payments wake waiters")
+                # only reached when the database cannot tell us about other processes' payments
+                self.listen = False
+                return
+            except Exception as e:
+                print(f"Payment listener error: {e!r}")
+            await asyncio.sleep(PAYMENT_LISTEN_RETRY)
+
+    async def _listen_postgres(self, engine):
+        if engine.dialect.driver != "asyncpg":
+            print(f"{engine.dialect.driver} cannot LISTEN, only in-process payments wake waiters")
+            return
+        import asyncpg
+
+        # LISTEN holds its connection for as long as the process runs, so it gets one of its
+        # own instead of keeping a pooled connection checked out for good
+        dsn = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+        connection = await asyncpg.connect(dsn)
+        try:
+            def on_notify(connection, pid, channel, payload):
+                self.resolve(int(payload))
+
+            await connection.add_listener(PAYMENT_CHANNEL, on_notify)
+            # anything paid while we were not listening
+            async with engine.connect() as conn:
+                await self._resolve_paid(conn)
+            while not connection.is_closed():
+                await asyncio.sleep(PAYMENT_LISTEN_RETRY)
+            raise ConnectionError("LISTEN connection closed")
+        finally:
+            await connection.close()
+
+    async def _watch_sqlite(self, engine):
+        from sqlalchemy import text
+
+        async with engine.connect() as conn:
+            version = None
+            while True:
+                if self.waiting():
+                    current = (await conn.execute(text("PRAGMA data_version"))).scalar()
+                    if current != version:
+                        await self._resolve_paid(conn)
+                        version = current
+                    # no read transaction is left open between checks
+                    await conn.rollback()
+                else:
+                    version = None  # the first waiter after a quiet spell checks once
+                await asyncio.sleep(PAYMENT_WATCH_INTERVAL)
+
+
+# order_reference of every order the payment callback has just marked as paid
+paid_orders = Topic("paid_orders")
+
+# order_id -> waiters for its payment, see sql_scripts.wait_for_payment
+payment_waiters = PaymentWaiters()
@@ -0,0 +1,149 @@
+"""
+Process-wide WayForPay client.
+
+Handlers used to build an AsyncWayForPay (with the merchant domain typed inline) for
+every checkout, so each invoice paid for a new HTTP pool and a cold TLS handshake. The
+client is now configured once from config.py and shared. aiohttp sessions belong to the
+loop that created them, so the registry keeps one client per event loop (like
+models.get_engine); the web app and the gateway bot share a loop and therefore a client.
+
+The registry also holds the plan config: PLANS / get_plan() are the invoice plans from
+plans.py, and create_plan_invoice() takes a plan or its name.
+
+warm_up() opens the pooled connection before the first checkout, and health() reports
+the outcome of the last round trip for /metrics/wayforpay; an answer other than 2xx
+counts as a failure. With WAYFORPAY_KEEPALIVE_INTERVAL set, keep_warm() pings the API
+that often so the pooled connection does not idle out between checkouts.
+"""
+
+import asyncio
+import threading
+import time
+import weakref
+
+import config
+from config import MERCHANT_ID, MERCHANT_SECRET
+from wayforpay import API_URL, AsyncWayForPay, DEFAULT_TIMEOUT, DEFAULT_MAX_CONNECTIONS, DEFAULT_MAX_CONCURRENCY
+from plans import PLANS, get_plan
+
+MERCHANT_DOMAIN = getattr(config, 'MERCHANT_DOMAIN', "upworkrevolution.com")
+WAYFORPAY_API_URL = getattr(config, 'WAYFORPAY_API_URL', API_URL)
+WAYFORPAY_TIMEOUT = getattr(config, 'WAYFORPAY_TIMEOUT', DEFAULT_TIMEOUT)
+WAYFORPAY_MAX_CONNECTIONS = getattr(config, 'WAYFORPAY_MAX_CONNECTIONS', DEFAULT_MAX_CONNECTIONS)
+WAYFORPAY_MAX_CONCURRENCY = getattr(config, 'WAYFORPAY_MAX_CONCURRENCY', DEFAULT_MAX_CONCURRENCY)
+WAYFORPAY_KEEPALIVE_INTERVAL = getattr(config, 'WAYFORPAY_KEEPALIVE_INTERVAL', 0)  # seconds between pings, 0 = off
+
+
+class ClientHealth:
+    """Outcome of the last round trip to the API, shared by every loop's client"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.last_status = None
+        self.last_latency = None
+        self.last_error = None
+        self.last_checked = None
+        self.failures = 0
+
+    def record(self, status=None, latency=None, error=None):
+        if error is None and status is not None and not 200 <= status < 300:
+            # the API answered, but not with a result (5xx, 405, a proxy error page...)
+            error = f"HTTP {status}"
+        with self._lock:
+            self.last_checked = time.time()
+            self.last_status = status
+            self.last_latency = latency
+            self.last_error = error
+            self.failures = self.failures + 1 if error else 0
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "ok": self.last_checked is not None and self.last_error is None,
+                "last_status": self.last_status,
+                "last_latency_ms": round(self.last_latency * 1000, 1) if self.last_latency is not None else None,
+                "last_error": self.last_error,
+                "last_checked": self.last_checked,
+                "consecutive_failures": self.failures,
+            }
+
+
+client_health = ClientHealth()
+_clients = weakref.WeakKeyDictionary()  # event loop -> AsyncWayForPay
+_clients_lock = threading.Lock()
+_keep_warm_task = None
+
+
+def create_client():
+    return AsyncWayForPay(MERCHANT_SECRET, MERCHANT_DOMAIN, api_url=WAYFORPAY_API_URL, timeout=WAYFORPAY_TIMEOUT,
+                          max_connections=WAYFORPAY_MAX_CONNECTIONS, max_concurrency=WAYFORPAY_MAX_CONCURRENCY)
+
+
+def get_wayforpay():
+    """WayForPay client of the running event loop, created on first use"""
+    owner = asyncio.get_running_loop()
+    with _clients_lock:
+        client = _clients.get(owner)
+        if client is None:
+            client = _clients[owner] = create_client()
+        return client
+
+
+async def create_plan_invoice(plan, order_reference=None):
+    """Invoice for one of PLANS (the plan or its name) with the configured merchant account"""
+    if isinstance(plan, str):
+        plan = PLANS[plan]
+    return await get_wayforpay().create_plan_invoice(MERCHANT_ID, "SimpleSignature", plan, order_reference)
+
+
+async def delete_invoice(order_reference):
+    """Remove an invoice nobody will pay, e.g. one whose checkout failed after it was created"""
+    return await get_wayforpay().delete_invoice(MERCHANT_ID, order_reference)
+
+
+async def check_health():
+    """One round trip to the API; records and returns the result"""
+    try:
+        status, latency = await get_wayforpay().ping(MERCHANT_ID)
+    except Exception as e:
+        client_health.record(error=repr(e))
+        print(f"WayForPay health check failed: {e!r}")
+    else:
+        client_health.record(status=status, latency=latency)
+        if not 200 <= status < 300:
+            print(f"WayForPay health check failed: HTTP {status}")
+    return client_health.snapshot()
+
+
+async def warm_up():
+    """Open the pooled connection to the API so the first checkout does not pay for the handshake"""
+    global _keep_warm_task
+    health = await check_health()
+    if health["ok"]:
+        print(f"WayForPay client warmed up ({MERCHANT_DOMAIN}, {len(PLANS)} plans, {health['last_latency_ms']}ms)")
+    if WAYFORPAY_KEEPALIVE_INTERVAL and _keep_warm_task is None:
+        _keep_warm_task = asyncio.create_task(keep_warm())
+    return health
+
+
+async def keep_warm(interval=WAYFORPAY_KEEPALIVE_INTERVAL):
+    """Ping the API every `interval` seconds so the pooled connection does not idle out"""
+    while True:
+        await asyncio.sleep(interval)
+        await check_health()
+
+
+def health():
+    return client_health.snapshot()
+
+
+async def close_wayforpay():
+    """Close the running loop's client, e.g. when its service shuts down"""
+    global _keep_warm_task
+    if _keep_warm_task is not None:
+        _keep_warm_task.cancel()
+        _keep_warm_task = None
+    with _clients_lock:
+        client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
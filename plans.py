@@ -0,0 +1,30 @@
+"""
+Subscription plans sold at checkout.
+
+Each plan is a wayforpay.InvoicePlan built once at import, so its signature parts are
+precomputed. A new tier is one more entry here (or in INVOICE_PLANS in config.py) and
+is immediately available at /payment/<name>; no new code path is needed.
+"""
+
+import config
+from config import COST_VALUE, COST_VALUE_YEARLY
+from wayforpay import InvoicePlan
+
+PRODUCT_NAME = "Оплата доступу до закритого Discord-каналу Community Upwork Revolution"
+
+# name -> (amount, regular mode, number of regular payments, days of access per payment)
+DEFAULT_PLANS = {
+    "monthly": (COST_VALUE, "monthly", 60, 30),
+    "yearly": (COST_VALUE_YEARLY, "yearly", 5, 365),
+}
+INVOICE_PLANS = getattr(config, 'INVOICE_PLANS', DEFAULT_PLANS)
+PLAN_CURRENCY = getattr(config, 'PLAN_CURRENCY', "USD")
+
+PLANS = {
+    name: InvoicePlan(name, amount, PLAN_CURRENCY, regular_mode, regular_count, [PRODUCT_NAME], sub_time=sub_time)
+    for name, (amount, regular_mode, regular_count, sub_time) in INVOICE_PLANS.items()
+}
+
+
+def get_plan(name):
+    return PLANS.get(name)
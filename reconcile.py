@@ -0,0 +1,189 @@
+"""
+Reconciliation of pending orders against WayForPay.
+
+An order stays at status 0 until its success or failure callback arrives, so an order
+whose callback was lost would stay pending forever. This job walks the pending orders
+older than RECONCILE_STALE_AFTER in batches, asks WayForPay for each invoice's status
+(at most RECONCILE_CONCURRENCY calls in flight and RECONCILE_RATE calls per second),
+and applies each batch at once: approved orders are marked paid and handed to the mail
+service (and anyone in wait_for_payment), declined/expired ones are deleted like
+callback_failure does. Orders WayForPay is still processing, or does not know, are left
+for the next run until they are RECONCILE_GIVE_UP_AFTER old; then they count as abandoned
+and are deleted too, after their invoice is removed so it can no longer be paid.
+
+The same task prunes webhook_deliveries rows older than WEBHOOK_DELIVERY_RETENTION, which
+are only needed while WayForPay may still retry a callback.
+
+Runs as a gateway cog every RECONCILE_INTERVAL_MINUTES, or once from the command line:
+
+    python reconcile.py            # apply the results
+    python reconcile.py --dry-run  # only report what would change
+"""
+
+import asyncio
+import sys
+import time
+from discord.ext import commands, tasks
+import config
+from config import MERCHANT_ID
+from dispatch import dispatch, DispatchStats, RateLimiter
+from notifications import paid_orders, payment_waiters
+from payment_client import get_wayforpay
+from sql_scripts import iter_stale_pending_orders, apply_reconciled_orders, prune_webhook_deliveries
+
+RECONCILE_STALE_AFTER = getattr(config, 'RECONCILE_STALE_AFTER', 3600)  # seconds before a pending order is checked
+RECONCILE_BATCH_SIZE = getattr(config, 'RECONCILE_BATCH_SIZE', 500)  # orders checked and applied together
+RECONCILE_CONCURRENCY = getattr(config, 'RECONCILE_CONCURRENCY', 10)  # status checks in flight at once
+RECONCILE_RATE = getattr(config, 'RECONCILE_RATE', 20)  # status checks per second, 0 = no cap
+RECONCILE_INTERVAL_MINUTES = getattr(config, 'RECONCILE_INTERVAL_MINUTES', 30)
+# seconds after which an order that is still unsettled (or unknown to WayForPay) is abandoned
+RECONCILE_GIVE_UP_AFTER = getattr(config, 'RECONCILE_GIVE_UP_AFTER', 7 * 86400)
+# seconds webhook_deliveries rows are kept; WayForPay gives up retrying a callback well within this
+WEBHOOK_DELIVERY_RETENTION = getattr(config, 'WEBHOOK_DELIVERY_RETENTION', 7 * 86400)
+
+APPROVED_STATUSES = {"Approved"}
+FAILED_STATUSES = {"Declined", "Expired", "Voided", "Refunded"}
+
+# Scheduled and manual runs take turns instead of checking the same orders twice
+reconcile_lock = asyncio.Lock()
+
+
+async def reconcile_pending_orders(dry_run: bool = False, stale_after: int = RECONCILE_STALE_AFTER,
+                                   batch_size: int = RECONCILE_BATCH_SIZE, concurrency: int = RECONCILE_CONCURRENCY,
+                                   rate: float = RECONCILE_RATE, give_up_after: int = RECONCILE_GIVE_UP_AFTER) -> str:
+    """Check every stale pending order once; returns a one-line summary"""
+    async with reconcile_lock:
+        client = get_wayforpay()
+        limiter = RateLimiter(rate)
+        stats = DispatchStats("Reconciliation")
+        now = int(time.time())
+        placed_before = now - stale_after
+        abandon_before = now - give_up_after
+        marked_paid = 0
+        deleted = 0
+        abandoned_total = 0
+
+        async for batch in iter_stale_pending_orders(placed_before, batch_size):
+            approved = {}  # order_reference -> payment date
+            failed = []
+            abandoned = []
+
+            async def check(order):
+                await limiter.wait()
+                result = await client.check_invoice(MERCHANT_ID, order["order_reference"])
+                if result is None:
+                    return False  # request failed, try again next run
+                if result.transactionStatus in APPROVED_STATUSES:
+                    try:
+                        paid_at = int(result.processingDate or 0)
+                    except (TypeError, ValueError):
+                        paid_at = 0
+                    approved[order["order_reference"]] = paid_at or int(time.time())
+                    return True
+                if result.transactionStatus in FAILED_STATUSES:
+                    failed.append(order["order_reference"])
+                    return True
+                if order["order_date"] >= abandon_before:
+                    return None  # still processing, or no such invoice
+                if result.transactionStatus is not None and not dry_run:
+                    # an open invoice could still be paid after its order is gone
+                    await limiter.wait()
+                    if not await client.delete_invoice(MERCHANT_ID, order["order_reference"]):
+                        return False
+                abandoned.append(order["order_reference"])
+                return True
+
+            stats.add(await dispatch("Reconciliation batch", batch, check, concurrency))
+
+            abandoned_total += len(abandoned)
+            if dry_run:
+                marked_paid += len(approved)
+                deleted += len(failed) + len(abandoned)
+                continue
+
+            try:
+                paid, removed = await apply_reconciled_orders(approved, failed + abandoned)
+            except Exception as e:
+                print(f"Error applying reconciliation batch: {e}")
+                continue
+            for order_reference, order_id in paid:
+                paid_orders.publish(order_reference)
+                if order_id is not None:
+                    payment_waiters.resolve(order_id)
+            marked_paid += len(paid)
+            deleted += removed
+
+        stats.finished_at = time.monotonic()
+        summary = (f"{stats.report()}; {marked_paid} {'would be ' if dry_run else ''}marked paid, "
+                   f"{deleted} {'would be ' if dry_run else ''}deleted ({abandoned_total} abandoned)")
+        print(summary)
+        return summary
+
+
+async def prune_deliveries(retention: int = WEBHOOK_DELIVERY_RETENTION) -> int:
+    """Forget applied webhook deliveries older than the retry window"""
+    pruned = await prune_webhook_deliveries(int(time.time()) - retention)
+    if pruned:
+        print(f"Pruned {pruned} webhook deliveries older than {retention // 86400} days")
+    return pruned
+
+
+@tasks.loop(minutes=RECONCILE_INTERVAL_MINUTES)
+async def reconcile_task():
+    try:
+        await reconcile_pending_orders()
+    except Exception as e:
+        print(f"Error in reconciliation: {e}")
+    try:
+        await prune_deliveries()
+    except Exception as e:
+        print(f"Error pruning webhook deliveries: {e}")
+
+
+class Reconciliation(commands.Cog):
+    """Catching up on payments whose WayForPay callback never arrived"""
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    def cog_unload(self):
+        reconcile_task.cancel()
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        if not reconcile_task.is_running():
+            reconcile_task.start()
+            print("Started reconciliation task")
+
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def reconcile_now(self, ctx):
+        """Manually check all stale pending orders against WayForPay"""
+        await ctx.send("Checking pending orders against WayForPay...")
+        await ctx.send(await reconcile_pending_orders())
+
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def reconcile_dry_run(self, ctx):
+        """Report what reconciliation would change, without changing anything"""
+        await ctx.send(await reconcile_pending_orders(dry_run=True))
+
+
+async def setup(bot):
+    await bot.add_cog(Reconciliation(bot))
+
+
+async def main(dry_run):
+    from models import dispose_engine
+    from payment_client import close_wayforpay
+    try:
+        await reconcile_pending_orders(dry_run=dry_run)
+        if not dry_run:
+            await prune_deliveries()
+    finally:
+        await close_wayforpay()
+        await dispose_engine()
+
+
+if __name__ == '__main__':
+    asyncio.run(main("--dry-run" in sys.argv))
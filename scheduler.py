@@ -1,28 +1,40 @@
 import schedule
 import time
 import asyncio
-import threading
 from discord.ext import commands, tasks
-from sql_scripts import select_all_users_with_expired_subs, select_users_for_30day_warning, get_user_by_discord_id
+from sql_scripts import (select_expired_users_batch, claim_users_for_30day_warning, get_user_by_discord_id,
+                         unmark_users_as_warned, get_job_cursor, set_job_cursor, clear_job_cursor)
 import discord
-from config import server_id, bot_token
-
-# Create a separate bot instance for the scheduler
-intents = discord.Intents.default()
-intents.members = True
-intents.guilds = True
-scheduler_bot = commands.Bot(command_prefix='!scheduler_', intents=intents)
+import config
+from config import server_id
+from dispatch import dispatch, DispatchStats
+from gateway import bot, run_gateway
 
 GUILD_ID = int(server_id)
 GRACE_PERIOD_SECONDS = 3600  # 1 hour grace period for new users
+WARNING_DM_CONCURRENCY = getattr(config, 'WARNING_DM_CONCURRENCY', 5)  # warning DMs in flight at once
+KICK_CONCURRENCY = getattr(config, 'KICK_CONCURRENCY', 3)  # members being DM'd/kicked at once
+KICK_BATCH_SIZE = getattr(config, 'KICK_BATCH_SIZE', 100)  # users per batch; progress is saved after each one
+KICK_RATE_ESTIMATE = getattr(config, 'KICK_RATE_ESTIMATE', 1.0)  # members/second, only used by the dry run estimate
+KICK_RESUME_INTERVAL_MINUTES = getattr(config, 'KICK_RESUME_INTERVAL_MINUTES', 15)
+KICK_JOB = "kick_expired_users"
+
+# Kick runs (daily task, resume task, admin commands) take turns instead of overlapping
+kick_lock = asyncio.Lock()
+
+async def get_discord_user(user_discord_id: int):
+    """Member/user from the gateway cache, falling back to a REST fetch only on a cache miss"""
+    guild = bot.get_guild(GUILD_ID)
+    user = (guild and guild.get_member(user_discord_id)) or bot.get_user(user_discord_id)
+    if user is None:
+        user = await bot.fetch_user(user_discord_id)
+    return user
 
-# Track warned users to avoid spam
-warned_users = set()
 
 async def send_warning_message(user_discord_id: int, days_remaining: int):
     """Send a warning message to user about subscription expiry"""
     try:
-        user = await scheduler_bot.fetch_user(user_discord_id)
+        user = await get_discord_user(user_discord_id)
         if user:
             warning_message = (
                 f"⚠️ **Увага!** ⚠️\n\n"
@@ -47,89 +59,135 @@ async def send_warning_message(user_discord_id: int, days_remaining: int):
 async def send_30day_warnings():
     """Send 30-day warnings to users whose subscriptions are expiring"""
     try:
-        users = await select_users_for_30day_warning()
-        current_time = int(time.time())
+        # Claim the users first (flag set in one conditional UPDATE), so a restart or another
+        # replica running the same sweep doesn't get them again and DM them twice
+        discord_ids = await claim_users_for_30day_warning()
         
-        print(f"Checking {len(users)} users for 30-day warnings")
+        print(f"Claimed {len(discord_ids)} users due a 30-day warning")
         
-        for user in users:
-            discord_id = user.discord_id if hasattr(user, 'discord_id') else user['discord_id']
-            last_payment = user.last_date_of_payment if hasattr(user, 'last_date_of_payment') else user['last_date_of_payment']
-            
-            # Skip if already warned recently
-            if discord_id in warned_users:
-                continue
-                
-            # Calculate days since last payment
-            days_since_payment = (current_time - last_payment) / 86400
-            
-            # Send warning if payment was 10 days ago (30 days left)
-            if 9 <= days_since_payment <= 11:  # 2-day window to catch the notification
-                success = await send_warning_message(discord_id, 30)
-                if success:
-                    warned_users.add(discord_id)
+        failed = []
+
+        async def warn(discord_id):
+            success = await send_warning_message(discord_id, 30)
+            if not success:
+                failed.append(discord_id)
+            return success
+
+        stats = await dispatch("30-day warnings", discord_ids, warn, WARNING_DM_CONCURRENCY)
+        print(stats.report())
+
+        # Users whose DM failed are due again on the next sweep
+        released = await unmark_users_as_warned(failed)
+        print(f"Released {released} users whose warning could not be sent")
                     
     except Exception as e:
         print(f"Error in send_30day_warnings: {e}")
 
 
-async def kick_expired_users():
-    """Kick users with expired subscriptions (40 days after last payment)"""
+async def kick_member(member, days_since_payment) -> bool:
+    """DM and kick one expired member"""
+    discord_id = member.id
     try:
-        users = await select_all_users_with_expired_subs()
-        current_time = int(time.time())
-
-        guild = scheduler_bot.get_guild(GUILD_ID)
-        if not guild:
-            print("Guild not found")
-            return
+        # Send final notification before kick
+        try:
+            await member.send(
+                "❌ **Вашу підписку було скасовано**\n\n"
+                "Ваша підписка на Upwork Revolution закінчилася, і ви були виключені з сервера.\n"
+                "Для повторного доступу, будь ласка, поновіть підписку через наш сайт.\n\n"
+                "Дякуємо за те, що були частиною нашої спільноти!"
+            )
+        except:
+            pass  # Ignore if can't send DM
+            
+        await member.kick(reason=f"Subscription expired {int(days_since_payment)} days ago")
+        print(f"Kicked user {discord_id} (expired {int(days_since_payment)} days ago)")
+        return True
+        
+    except Exception as e:
+        print(f"Failed to kick {discord_id}: {e}")
+        return False
 
-        print(f"Found {len(users)} users with expired subscriptions (40+ days)")
 
-        for user in users:
-            discord_id = user.discord_id if hasattr(user, 'discord_id') else user['discord_id']
-            last_payment = user.last_date_of_payment if hasattr(user, 'last_date_of_payment') else user['last_date_of_payment']
+def members_to_kick(guild, users, current_time):
+    """(member, days since payment) for the users of a batch that should be kicked now"""
+    to_kick = []
+    for user in users:
+        discord_id = user.discord_id
+        
+        # Additional safety check: only kick if really expired (40+ days)
+        days_since_payment = (current_time - user.last_date_of_payment) / 86400
+        if days_since_payment < 40:
+            continue
             
-            # Additional safety check: only kick if really expired (40+ days)
-            days_since_payment = (current_time - last_payment) / 86400
-            if days_since_payment < 40:
-                continue
-                
-            # Skip if within grace period from join (for new users)
-            join_ts = getattr(user, "date_of_payment", None) or user.get("date_of_payment")
-            if join_ts and (current_time - join_ts) < GRACE_PERIOD_SECONDS:
-                print(f"Skipping kick for {discord_id} (joined recently)")
-                continue
-
-            member = guild.get_member(int(discord_id))
-            if member:
-                try:
-                    # Send final notification before kick
-                    try:
-                        await member.send(
-                            "❌ **Вашу підписку було скасовано**\n\n"
-                            "Ваша підписка на Upwork Revolution закінчилася, і ви були виключені з сервера.\n"
-                            "Для повторного доступу, будь ласка, поновіть підписку через наш сайт.\n\n"
-                            "Дякуємо за те, що були частиною нашої спільноти!"
-                        )
-                    except:
-                        pass  # Ignore if can't send DM
-                        
-                    await member.kick(reason=f"Subscription expired {int(days_since_payment)} days ago")
-                    print(f"Kicked user {discord_id} (expired {int(days_since_payment)} days ago)")
-                    
-                    # Remove from warned users set
-                    warned_users.discard(discord_id)
-                    
-                except Exception as e:
-                    print(f"Failed to kick {discord_id}: {e}")
+        # Skip if within grace period from join (for new users)
+        join_ts = user.date_of_payment
+        if join_ts and (current_time - join_ts) < GRACE_PERIOD_SECONDS:
+            print(f"Skipping kick for {discord_id} (joined recently)")
+            continue
+
+        member = guild.get_member(int(discord_id))
+        if member:
+            to_kick.append((member, days_since_payment))
+        else:
+            print(f"Member {discord_id} not found in guild")
+    return to_kick
+
+
+async def kick_expired_users(dry_run: bool = False):
+    """
+    Kick users with expired subscriptions (40 days after last payment).
+
+    Users are processed in batches by id and the last finished id is saved in job_cursors,
+    so a run that is interrupted (crash, restart, Discord errors) continues where it
+    stopped instead of waiting for the next daily check. With dry_run nothing is sent or
+    kicked: it only reports how many members would be removed and roughly how long it takes.
+    Returns a one-line summary.
+    """
+    async with kick_lock:
+        try:
+            guild = bot.get_guild(GUILD_ID)
+            if not guild:
+                print("Guild not found")
+                return "Guild not found"
+
+            after_id = 0 if dry_run else (await get_job_cursor(KICK_JOB) or 0)
+            if after_id:
+                print(f"Resuming interrupted kick run after user id {after_id}")
+
+            stats = DispatchStats("Expired member kicks")
+            would_kick = 0
+            while True:
+                users = await select_expired_users_batch(after_id, KICK_BATCH_SIZE)
+                if not users:
+                    break
+
+                to_kick = members_to_kick(guild, users, int(time.time()))
+                if dry_run:
+                    would_kick += len(to_kick)
+                else:
+                    batch_stats = await dispatch(
+                        "Expired member kicks", to_kick, lambda item: kick_member(*item), KICK_CONCURRENCY
+                    )
+                    stats.add(batch_stats)
+                    stats.skipped += len(users) - len(to_kick)
+
+                after_id = users[-1].id
+                if not dry_run:
+                    await set_job_cursor(KICK_JOB, after_id)
+
+            if dry_run:
+                estimate = would_kick / KICK_RATE_ESTIMATE
+                summary = f"Dry run: {would_kick} members would be kicked, estimated {estimate / 60:.1f} minutes"
             else:
-                print(f"Member {discord_id} not found in guild")
-                # Remove from warned users set if they're not in guild
-                warned_users.discard(discord_id)
+                await clear_job_cursor(KICK_JOB)
+                summary = stats.report()
+
+            print(summary)
+            return summary
                 
-    except Exception as e:
-        print(f"Error in kick_expired_users: {e}")
+        except Exception as e:
+            print(f"Error in kick_expired_users: {e}")
+            return f"Kick run interrupted: {e}"
 
 
 @tasks.loop(hours=6)  # Check every 6 hours
@@ -146,94 +204,105 @@ async def check_subscription_task():
     await kick_expired_users()
 
 
-@tasks.loop(hours=24)  # Clean up warned users daily
-async def cleanup_warned_users():
-    """Clean up the warned users set to prevent memory issues"""
-    global warned_users
-    # Clear warnings older than 7 days to allow re-warning if needed
-    warned_users.clear()
-    print("Cleaned up warned users set")
-
+@tasks.loop(minutes=KICK_RESUME_INTERVAL_MINUTES)
+async def resume_kicks_task():
+    """Finish a kick run that was interrupted, without waiting for the daily check"""
+    if not kick_lock.locked() and await get_job_cursor(KICK_JOB) is not None:
+        print("Resuming interrupted subscription expiry run...")
+        await kick_expired_users()
+
+
+class Warnings(commands.Cog):
+    """30-day subscription expiry warnings"""
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    def cog_unload(self):
+        check_warnings_task.cancel()
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        if not check_warnings_task.is_running():
+            check_warnings_task.start()
+            print("Started warning check task")
+
+    # Manual commands for testing (admin only)
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def check_warnings_now(self, ctx):
+        """Manually trigger warning check"""
+        await ctx.send("Checking for users who need warnings...")
+        await send_30day_warnings()
+        await ctx.send("Warning check completed!")
+
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def user_status(self, ctx, discord_id: int):
+        """Check a specific user's subscription status"""
+        try:
+            user = await get_user_by_discord_id(discord_id)
+            if user:
+                current_time = int(time.time())
+                days_since_payment = (current_time - user.last_date_of_payment) / 86400
+                
+                status_msg = (
+                    f"**User Status for {discord_id}:**\n"
+                    f"Email: {user.email or 'N/A'}\n"
+                    f"Days since last payment: {int(days_since_payment)}\n"
+                    f"Last payment: <t:{user.last_date_of_payment}:F>\n"
+                    f"Subscription expires: <t:{user.last_date_of_payment + (40 * 86400)}:F>\n"
+                    f"Status: {'⚠️ Warning sent' if user.warned_30_days else '✅ Active' if days_since_payment < 30 else '❌ Expiring soon'}"
+                )
+                await ctx.send(status_msg)
+            else:
+                await ctx.send(f"User {discord_id} not found in database")
+        except Exception as e:
+            await ctx.send(f"Error checking user status: {e}")
 
-@scheduler_bot.event
-async def on_ready():
-    print(f'Scheduler bot logged in as {scheduler_bot.user}')
-    
-    if not check_warnings_task.is_running():
-        check_warnings_task.start()
-        print("Started warning check task")
-        
-    if not check_subscription_task.is_running():
-        check_subscription_task.start()
-        print("Started subscription check task")
-        
-    if not cleanup_warned_users.is_running():
-        cleanup_warned_users.start()
-        print("Started cleanup task")
 
+class Kicks(commands.Cog):
+    """Removing members whose subscription has expired"""
 
-# Manual commands for testing (admin only)
-@scheduler_bot.command()
-@commands.has_permissions(administrator=True)
-async def check_warnings_now(ctx):
-    """Manually trigger warning check"""
-    await ctx.send("Checking for users who need warnings...")
-    await send_30day_warnings()
-    await ctx.send("Warning check completed!")
+    def __init__(self, bot):
+        self.bot = bot
 
+    def cog_unload(self):
+        check_subscription_task.cancel()
+        resume_kicks_task.cancel()
 
-@scheduler_bot.command()
-@commands.has_permissions(administrator=True)
-async def check_expired_now(ctx):
-    """Manually trigger expired user check"""
-    await ctx.send("Checking for expired users...")
-    await kick_expired_users()
-    await ctx.send("Expired user check completed!")
+    @commands.Cog.listener()
+    async def on_ready(self):
+        print(f'Scheduler cogs ready on {self.bot.user}')
 
+        if not check_subscription_task.is_running():
+            check_subscription_task.start()
+            print("Started subscription check task")
 
-@scheduler_bot.command()
-@commands.has_permissions(administrator=True)
-async def user_status(ctx, discord_id: int):
-    """Check a specific user's subscription status"""
-    try:
-        user = await get_user_by_discord_id(discord_id)
-        if user:
-            current_time = int(time.time())
-            days_since_payment = (current_time - user.last_date_of_payment) / 86400
-            
-            status_msg = (
-                f"**User Status for {discord_id}:**\n"
-                f"Email: {user.email or 'N/A'}\n"
-                f"Days since last payment: {int(days_since_payment)}\n"
-                f"Last payment: <t:{user.last_date_of_payment}:F>\n"
-                f"Subscription expires: <t:{user.last_date_of_payment + (40 * 86400)}:F>\n"
-                f"Status: {'⚠️ Warning sent' if discord_id in warned_users else '✅ Active' if days_since_payment < 30 else '❌ Expiring soon'}"
-            )
-            await ctx.send(status_msg)
-        else:
-            await ctx.send(f"User {discord_id} not found in database")
-    except Exception as e:
-        await ctx.send(f"Error checking user status: {e}")
+        if not resume_kicks_task.is_running():
+            resume_kicks_task.start()
+            print("Started kick resume task")
 
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def check_expired_now(self, ctx):
+        """Manually trigger expired user check"""
+        await ctx.send("Checking for expired users...")
+        summary = await kick_expired_users()
+        await ctx.send(f"Expired user check completed! {summary}")
 
-def run_scheduler_bot():
-    """Run the scheduler bot in its own event loop"""
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        scheduler_bot.run(bot_token)
-    except Exception as e:
-        print(f"Error running scheduler bot: {e}")
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def check_expired_dry_run(self, ctx):
+        """Report how many expired members would be kicked, without kicking anyone"""
+        await ctx.send(await kick_expired_users(dry_run=True))
 
 
-def run_scheduler():
-    """Start the scheduler in a separate thread"""
-    scheduler_thread = threading.Thread(target=run_scheduler_bot, daemon=True)
-    scheduler_thread.start()
-    print("Scheduler thread started")
-    return scheduler_thread
+async def setup(bot):
+    await bot.add_cog(Warnings(bot))
+    await bot.add_cog(Kicks(bot))
 
 
 if __name__ == '__main__':
-    # Run scheduler independently
-    run_scheduler_bot()
\ No newline at end of file
+    # Run only the scheduler cogs on their own gateway connection
+    run_gateway(["scheduler"])
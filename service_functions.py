@@ -1,59 +1,60 @@
 import asyncio
 import random
+from sqlalchemy.exc import IntegrityError
 from sql_scripts import *
 
 
-async def generate_unique_order_id(all_orders_id, length=10) -> str:
-    existing_ids = set(all_orders_id)
-    while True:
-        order_id = ''.join(random.choices('0123456789', k=length))
-        if order_id not in existing_ids:
-            return order_id
+ORDER_ID_LENGTH = 10
+ORDER_ID_ATTEMPTS = 5
 
 
-async def add_new_order(email, join_link, amount, sub_time):
-    try:
-        all_orders_id = []
-        all_orders_list = await select_orders()
-
-        for order in all_orders_list:
-            all_orders_id.append(order['order_id'])
-
-        new_order_id = await generate_unique_order_id(all_orders_id)
+def generate_order_id(length=ORDER_ID_LENGTH) -> int:
+    return random.randint(10 ** (length - 1), 10 ** length - 1)
 
-        await add_order(int(new_order_id), email, join_link, amount=amount, sub_time=int(sub_time), order_status=0)
 
-        return int(new_order_id)
+async def add_new_order(email, join_link, amount, sub_time, order_reference=None):
+    try:
+        # orders.order_id has a unique index, so a taken id shows up as an IntegrityError
+        # on insert and we simply draw another one instead of scanning the whole table
+        for _ in range(ORDER_ID_ATTEMPTS):
+            new_order_id = generate_order_id()
+            try:
+                await add_order(new_order_id, email, join_link, amount=amount, sub_time=int(sub_time), order_status=0,
+                                order_reference=order_reference)
+                return new_order_id
+            except IntegrityError:
+                print(f"Order id {new_order_id} is already taken, retrying")
+
+        raise Exception(f"Could not allocate a free order id in {ORDER_ID_ATTEMPTS} attempts")
     except Exception as error:
         print(f"Error in service_functions > add_new_order: {error}")
 
 
-async def add_order_reference_sql(order_id, order_reference):
-    try:
-        await update_user_order_reference(order_id, order_reference)
-    except Exception as e:
-        print(f"Error in service_functions > add_order_reference_sql: {e}")
-
-
-async def update_order_status_sql(order_reference, new_status):
-    try:
-        await update_order_status_by_order_reference(order_reference, new_status)
-    except Exception as e:
-        print(f"Error in service_functions > update_order_status_sql: {e}")
-
-
-async def update_user_last_payment_date_sql(user_email, new_date):
-    """Update user's last payment date and reset warning status"""
-    try:
-        # Update payment date
-        await update_user_last_payment_date(user_email, new_date)
-        
-        # Reset warning status when user makes a payment
-        await reset_user_warning_status(user_email)
-        
+async def apply_payment_sql(order_reference, user_email=None, new_date=None, delivery_key=None):
+    """
+    Payment date, warning reset and order status for a success webhook in one transaction.
+
+    With a delivery_key (see idempotency.delivery_key) a delivery that was already applied
+    is skipped and None is returned; otherwise returns the order_id of the order marked
+    paid, or False if there was no pending order.
+    Unlike the other *_sql helpers this lets database errors through, so the webhook can
+    answer with an error and WayForPay retries the callback.
+    """
+    if delivery_key is None:
+        result = await apply_payment(order_reference, user_email, new_date, paid_order_status)
+    else:
+        result = await apply_payment_once(delivery_key, user_email, new_date, paid_order_status)
+        if result is None:
+            print(f"Delivery {delivery_key} was already applied")
+            return None
+
+    users_updated, paid_order_id = result
+    if users_updated:
         print(f"Updated payment date and reset warning for {user_email}")
-    except Exception as e:
-        print(f"Error in service_functions > update_user_last_payment_date: {e}")
+    if paid_order_id is None:
+        print(f"No pending order {order_reference} to mark as paid")
+        return False
+    return paid_order_id
 
 
 async def delete_order_sql(order_reference):
@@ -61,25 +62,3 @@ async def delete_order_sql(order_reference):
         await delete_order_by_order_reference(order_reference)
     except Exception as e:
         print(f"Error in service_functions > delete_order_sql: {e}")
-
-
-async def reset_user_warning_status(user_email):
-    """Reset user's warning status when they make a payment"""
-    try:
-        from sql_scripts import async_session
-        from models import Users
-        from sqlalchemy import select
-        
-        async with async_session() as session:
-            result = await session.execute(
-                select(Users).where(Users.email == user_email)
-            )
-            user = result.scalar_one_or_none()
-            if user:
-                user.warned_30_days = False
-                await session.commit()
-                return True
-            return False
-    except Exception as e:
-        print(f"Error resetting warning status for {user_email}: {e}")
-        return False
\ No newline at end of file
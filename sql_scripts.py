@@ -1,14 +1,16 @@
 import asyncio
 import time
 from datetime import datetime
-from sqlalchemy import select
+from sqlalchemy import select, insert, update, delete, bindparam, text, and_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import class_mapper
-from models import Orders, Users, async_session
+from models import Orders, Users, JobCursors, PooledInvites, WebhookDeliveries, PendingJoins, async_session
+from notifications import payment_waiters, PAYMENT_CHANNEL, PAYMENT_WAIT_TIMEOUT
 from config import *
 
 
-async def add_order(order_id: int, email: str, join_link: str, amount: str, sub_time, order_status: int = 0) -> Orders:
+async def add_order(order_id: int, email: str, join_link: str, amount: str, sub_time, order_status: int = 0,
+                    order_reference: str = None) -> Orders:
     current_unix_time = int(time.time())
     async with async_session() as session:
         new_order = Orders(
@@ -18,7 +20,8 @@ async def add_order(order_id: int, email: str, join_link: str, amount: str, sub_
             amount_to_pay=amount,
             sub_time=int(sub_time),
             order_date=current_unix_time,
-            order_status=order_status
+            order_status=order_status,
+            order_reference=order_reference
         )
         session.add(new_order)
         await session.commit()
@@ -39,6 +42,8 @@ async def add_or_update_user(email, link, discord_name, discord_server_name, dis
             user.date_of_payment = date_of_payment
             # Set last_date_of_payment to the same as date_of_payment for new payments
             user.last_date_of_payment = date_of_payment
+            # New payment period, so the 30-day warning is due again
+            user.warned_30_days = False
 
             if user.sub_time and user.sub_time > current_time:
                 new_subscription_expiry = user.sub_time + subscription_duration_sec
@@ -65,52 +70,148 @@ async def add_or_update_user(email, link, discord_name, discord_server_name, dis
         await session.commit()
 
 
-async def wait_for_payment(order_id: int, timeout: int = 300, interval: int = 5) -> Orders:
-    start_time = datetime.utcnow()
-    while (datetime.utcnow() - start_time).total_seconds() < timeout:
-        async with async_session() as session:
-            result = await session.execute(select(Orders).where(Orders.order_id == order_id))
-            order = result.scalars().first()
-            if order and order.order_status == 3:
-                return order
-        await asyncio.sleep(interval)
-    return None
+async def wait_for_payment(order_id: int, timeout: int = PAYMENT_WAIT_TIMEOUT) -> dict:
+    """
+    The order once it is paid, or None after `timeout` seconds.
+
+    Waits on notifications.payment_waiters, which the code marking orders paid resolves, so
+    waiting costs no queries; the order is read once when the payment has arrived.
+    """
+    if not await payment_waiters.wait(order_id, timeout):
+        return None
+    async with async_session() as session:
+        result = await session.execute(select_order_rows.where(Orders.order_id == order_id))
+        order = result.one_or_none()
+        return dict(zip(ORDER_KEYS, order)) if order else None
+
 
+# Column list for plain order reads, resolved once at import. Selecting the columns instead of
+# the Orders entity skips ORM hydration and the identity map, and zipping the plain row tuples
+# with the precomputed keys is cheaper than converting each RowMapping.
+ORDER_COLUMNS = tuple(Orders.__table__.columns)
+ORDER_KEYS = tuple(column.key for column in ORDER_COLUMNS)
+select_order_rows = select(*ORDER_COLUMNS)
+ORDER_STREAM_BATCH_SIZE = 1000  # rows per query for iter_orders
 
-async def select_orders() -> Orders:
+
+async def select_orders() -> list[dict]:
+    """Every order at once; use iter_orders for anything that walks a large table"""
     async with async_session() as session:
-        result = await session.execute(select(Orders))
-        order = result.fetchall()
-        if order:
-            return [{column.key: getattr(row.Orders, column.key) for column in class_mapper(Orders).columns} for row in order]
-        return order
+        result = await session.execute(select_order_rows)
+        return [dict(zip(ORDER_KEYS, row)) for row in result]
 
 
-async def select_orders_with_paid_status() -> Orders:
+async def select_orders_with_paid_status() -> list[dict]:
     async with async_session() as session:
-        result = await session.execute(select(Orders).where(Orders.order_status == paid_order_status))
-        order = result.fetchall()
-        if order:
-            return [{column.key: getattr(row.Orders, column.key) for column in class_mapper(Orders).columns} for row in order]
-        return order
+        result = await session.execute(select_order_rows.where(Orders.order_status == paid_order_status))
+        return [dict(zip(ORDER_KEYS, row)) for row in result]
+
+
+async def iter_orders(order_status: int = None, batch_size: int = ORDER_STREAM_BATCH_SIZE, after_id: int = 0):
+    """
+    Async generator over orders (optionally with one status) as dicts, in id order.
+
+    Rows are fetched batch_size at a time with keyset pagination on id, each batch in its
+    own short session, so memory stays flat however large the table is and no transaction
+    is held open while the caller works through a batch.
+    """
+    query = select_order_rows.order_by(Orders.id).limit(batch_size)
+    if order_status is not None:
+        query = query.where(Orders.order_status == order_status)
+
+    while True:
+        async with async_session() as session:
+            rows = (await session.execute(query.where(Orders.id > after_id))).all()
+        for row in rows:
+            yield dict(zip(ORDER_KEYS, row))
+        if len(rows) < batch_size:
+            return
+        after_id = rows[-1].id
+
+
+def iter_orders_with_paid_status(batch_size: int = ORDER_STREAM_BATCH_SIZE):
+    return iter_orders(paid_order_status, batch_size)
+
+
+async def iter_stale_pending_orders(placed_before: int, batch_size: int = ORDER_STREAM_BATCH_SIZE, after_id: int = 0):
+    """
+    Batches (lists) of pending orders with an invoice reference placed before `placed_before`,
+    as {id, order_reference, email, order_date} dicts. Same keyset walk as iter_orders, but only the
+    columns a status check needs, and a whole batch at a time so it can be applied in bulk.
+    """
+    query = (
+        select(Orders.id, Orders.order_reference, Orders.email, Orders.order_date)
+        .where(Orders.order_status == 0, Orders.order_reference.isnot(None), Orders.order_date < placed_before)
+        .order_by(Orders.id)
+        .limit(batch_size)
+    )
+    while True:
+        async with async_session() as session:
+            rows = (await session.execute(query.where(Orders.id > after_id))).all()
+        if rows:
+            yield [{"id": row.id, "order_reference": row.order_reference, "email": row.email,
+                    "order_date": row.order_date} for row in rows]
+        if len(rows) < batch_size:
+            return
+        after_id = rows[-1].id
+
+
+async def apply_reconciled_orders(approved: dict, failed, paid_status: int = paid_order_status) -> tuple[list, int]:
+    """
+    Apply one batch of invoice status checks in a single transaction.
+
+    `approved` maps order_reference -> payment date. Those still pending are marked paid with
+    one UPDATE ... RETURNING, and their users get the payment date and a warning reset in one
+    executemany; orders in `failed` that are still pending are removed with one DELETE.
+    The pending condition makes a webhook that lands in the meantime win, so nothing is applied
+    twice. Returns ((order_reference, order_id) of the orders marked paid, number of orders deleted).
+    """
+    paid = []
+    deleted = 0
+    async with async_session() as session:
+        async with session.begin():
+            if approved:
+                result = await session.execute(
+                    update(Orders)
+                    .where(Orders.order_reference.in_(list(approved)), Orders.order_status == 0)
+                    .values(order_status=paid_status)
+                    .returning(Orders.order_reference, Orders.order_id, Orders.email)
+                    .execution_options(synchronize_session=False)
+                )
+                paid = result.all()
+                await notify_paid(session, [order_id for _, order_id, _ in paid if order_id is not None])
+                payments = [{"b_email": email, "b_date": approved[order_reference]}
+                            for order_reference, _, email in paid if email]
+                if payments:
+                    users = Users.__table__
+                    await session.execute(
+                        update(users)
+                        .where(users.c.email == bindparam("b_email"))
+                        .values(last_date_of_payment=bindparam("b_date"), warned_30_days=False),
+                        payments
+                    )
+            if failed:
+                result = await session.execute(
+                    delete(Orders)
+                    .where(Orders.order_reference.in_(list(failed)), Orders.order_status == 0)
+                    .execution_options(synchronize_session=False)
+                )
+                deleted = result.rowcount
+    return [(order_reference, order_id) for order_reference, order_id, _ in paid], deleted
 
 
 async def select_order_by_order_reference(order_reference) -> dict:
     async with async_session() as session:
-        result = await session.execute(select(Orders).where(Orders.order_reference == order_reference))
-        order = result.scalar_one_or_none()
-        if order:
-            return {column.key: getattr(order, column.key) for column in class_mapper(Orders).columns}
-        return None
+        result = await session.execute(select_order_rows.where(Orders.order_reference == order_reference))
+        order = result.one_or_none()
+        return dict(zip(ORDER_KEYS, order)) if order else None
 
 
 async def select_order_by_discord_link(discord_link) -> dict:
     async with async_session() as session:
-        result = await session.execute(select(Orders).where(Orders.link == discord_link))
-        order = result.scalar_one_or_none()
-        if order:
-            return {column.key: getattr(order, column.key) for column in class_mapper(Orders).columns}
-        return None
+        result = await session.execute(select_order_rows.where(Orders.link == discord_link))
+        order = result.one_or_none()
+        return dict(zip(ORDER_KEYS, order)) if order else None
 
 async def add_user_from_order(order: Orders) -> Users:
     async with async_session() as session:
@@ -126,39 +227,42 @@ async def add_user_from_order(order: Orders) -> Users:
         return new_user
 
 
-async def update_user_with_discord_id(join_link: str, discord_id: int) -> Users:
+async def update_user_with_discord_id(join_link: str, discord_id: int) -> int:
+    # only the first user with this link, as before; one statement instead of load + flush
+    first_user = select(Users.id).where(Users.link == join_link).order_by(Users.id).limit(1).scalar_subquery()
     async with async_session() as session:
-        result = await session.execute(select(Users).where(Users.link == join_link))
-        user = result.scalars().first()
-        if user:
-            user.discord_id = discord_id
-            user.link = None  # удаляем ссылку, чтобы нельзя было повторно вступить по ней
-            await session.commit()
-            return user
-        return None
+        result = await session.execute(
+            update(Users)
+            .where(Users.id == first_user)
+            .values(discord_id=discord_id, link=None)  # удаляем ссылку, чтобы нельзя было повторно вступить по ней
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+        return result.rowcount
 
 
-async def update_user_order_reference(order_id, order_reference):
+async def update_user_order_reference(order_id, order_reference) -> int:
     async with async_session() as session:
-        result = await session.execute(select(Orders).where(Orders.order_id == order_id))
-        order = result.scalars().first()
-        if order:
-            order.order_reference = order_reference
-            await session.commit()
+        result = await session.execute(
+            update(Orders)
+            .where(Orders.order_id == order_id)
+            .values(order_reference=order_reference)
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+        return result.rowcount
 
 
-async def update_order_status_by_order_reference(order_reference, new_status):
+async def update_order_status_by_order_reference(order_reference, new_status) -> int:
     async with async_session() as session:
         result = await session.execute(
-            select(Orders).where(
-                Orders.order_reference == order_reference,
-                Orders.order_status == 0
-            )
+            update(Orders)
+            .where(Orders.order_reference == order_reference, Orders.order_status == 0)
+            .values(order_status=new_status)
+            .execution_options(synchronize_session=False)
         )
-        order = result.scalars().first()
-        if order:
-            order.order_status = new_status
-            await session.commit()
+        await session.commit()
+        return result.rowcount
 
 
 async def update_order_status_by_order_reference_v2(order_reference: str, new_status: int) -> bool:
@@ -176,30 +280,164 @@ async def update_order_status_by_order_reference_v2(order_reference: str, new_st
         return False
 
 
-async def delete_order_by_order_reference(order_reference):
+async def notify_paid(session, order_ids):
+    """On Postgres, NOTIFY other processes' payment listeners; delivered when the transaction commits"""
+    if order_ids and session.bind.dialect.name == "postgresql":
+        await session.execute(
+            text("SELECT pg_notify(:channel, order_id) FROM unnest(CAST(:order_ids AS text[])) AS order_id"),
+            {"channel": PAYMENT_CHANNEL, "order_ids": [str(order_id) for order_id in order_ids]}
+        )
+
+
+async def _apply_payment(session, order_reference, user_email, new_date, paid_status) -> tuple[int, int]:
+    users_updated = 0
+    if user_email and new_date:
+        result = await session.execute(
+            update(Users)
+            .where(Users.email == user_email)
+            .values(last_date_of_payment=new_date, warned_30_days=False)
+            .execution_options(synchronize_session=False)
+        )
+        users_updated = result.rowcount
+
+    result = await session.execute(
+        update(Orders)
+        .where(Orders.order_reference == order_reference, Orders.order_status == 0)
+        .values(order_status=paid_status)
+        .returning(Orders.order_id)
+        .execution_options(synchronize_session=False)
+    )
+    paid_order_id = result.scalar()
+    if paid_order_id is not None:
+        await notify_paid(session, [paid_order_id])
+    return users_updated, paid_order_id
+
+
+async def apply_payment(order_reference: str, user_email: str = None, new_date: int = None,
+                        paid_status: int = paid_order_status) -> tuple[int, int]:
+    """
+    Record a successful payment in one transaction.
+
+    Moves the user's last payment date, clears their 30-day warning and marks the pending
+    order as paid with two set-based UPDATEs on a single session, so the webhook either
+    applies all of it or nothing. Returns (users updated, order_id of the order marked paid,
+    or None if there was no pending order).
+    """
     async with async_session() as session:
-        result = await session.execute(select(Orders).where(Orders.order_reference == order_reference))
-        order = result.scalars().first()
-        if order:
-            await session.delete(order)
-            await session.commit()
+        async with session.begin():
+            return await _apply_payment(session, order_reference, user_email, new_date, paid_status)
+
+
+async def apply_payment_once(delivery_key: tuple, user_email: str = None, new_date: int = None,
+                             paid_status: int = paid_order_status):
+    """
+    apply_payment for one webhook delivery, keyed by (orderReference, transactionStatus,
+    processingDate). The delivery row is inserted first in the same transaction, so a
+    retried delivery fails on its primary key before touching users or orders and the
+    payment is never applied twice. Returns None for a duplicate, else apply_payment's result.
+    """
+    order_reference, transaction_status, processing_date = delivery_key
+    try:
+        async with async_session() as session:
+            async with session.begin():
+                await session.execute(insert(WebhookDeliveries).values(
+                    order_reference=order_reference,
+                    transaction_status=transaction_status,
+                    processing_date=processing_date,
+                    received_at=int(time.time()),
+                ))
+                return await _apply_payment(session, order_reference, user_email, new_date, paid_status)
+    except IntegrityError:
+        return None
 
 
-# Fixed function: Get users who should receive 30-day warning
-async def select_users_for_30day_warning() -> list[Users]:
-    """Get users whose payment expires in 30 days and haven't been warned yet"""
-    current_time = int(time.time())
-    warning_threshold = current_time + (30 * 86400)  # 30 days from now
-    
+async def prune_webhook_deliveries(received_before: int) -> int:
+    """Delete delivery records received before `received_before`; WayForPay stops retrying long before"""
     async with async_session() as session:
         result = await session.execute(
-            select(Users).where(
-                Users.last_date_of_payment < warning_threshold,
-                Users.last_date_of_payment > (current_time - 10 * 86400),  # Not too old
-                Users.discord_id.isnot(None)  # Has Discord ID
-            )
+            delete(WebhookDeliveries)
+            .where(WebhookDeliveries.received_at < received_before)
+            .execution_options(synchronize_session=False)
         )
-        return result.scalars().all()
+        await session.commit()
+        return result.rowcount
+
+
+async def claim_paid_orders(limit: int = 100, order_reference: str = None) -> list[dict]:
+    """
+    Flip up to `limit` paid orders to finished_order_status in one statement and return them.
+
+    The candidate rows are locked with FOR UPDATE SKIP LOCKED (ignored on SQLite, which
+    serialises writers anyway), so several mail workers can claim concurrently and each
+    order is returned to exactly one of them.
+    """
+    claimable = select(Orders.id).where(Orders.order_status == paid_order_status)
+    if order_reference is not None:
+        claimable = claimable.where(Orders.order_reference == order_reference)
+    claimable = claimable.order_by(Orders.id).limit(limit).with_for_update(skip_locked=True)
+
+    stmt = (
+        update(Orders)
+        .where(Orders.id.in_(claimable), Orders.order_status == paid_order_status)
+        .values(order_status=finished_order_status)
+        .returning(Orders.order_reference, Orders.email, Orders.link)
+        .execution_options(synchronize_session=False)
+    )
+    async with async_session() as session:
+        result = await session.execute(stmt)
+        orders = [dict(row) for row in result.mappings()]
+        await session.commit()
+        return orders
+
+
+async def delete_order_by_order_reference(order_reference) -> int:
+    async with async_session() as session:
+        result = await session.execute(
+            delete(Orders)
+            .where(Orders.order_reference == order_reference)
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+        return result.rowcount
+
+
+def _due_30day_warning(current_time):
+    """Users who paid 9-11 days ago, i.e. have about 30 days left of the 40-day period, and have not been warned yet"""
+    return and_(
+        # 2-day window so a 6-hourly sweep can't miss anyone
+        Users.last_date_of_payment.between(current_time - 11 * 86400, current_time - 9 * 86400),
+        Users.warned_30_days.isnot(True),  # NULL on rows created before the column existed
+        Users.discord_id.isnot(None)  # Has Discord ID
+    )
+
+
+# Get users who should receive the 30-day warning
+async def select_users_for_30day_warning():
+    """(discord_id, last_date_of_payment) rows of the users due the 30-day warning"""
+    async with async_session() as session:
+        result = await session.execute(
+            select(Users.discord_id, Users.last_date_of_payment).where(_due_30day_warning(int(time.time())))
+        )
+        return result.all()
+
+
+async def claim_users_for_30day_warning() -> list[int]:
+    """
+    Mark the users select_users_for_30day_warning would return as warned and return their
+    discord_ids, in one conditional UPDATE. Only rows still unwarned are updated, so two
+    replicas (or a rerun after a restart) never get the same user back and DM them twice.
+    """
+    async with async_session() as session:
+        result = await session.execute(
+            update(Users)
+            .where(_due_30day_warning(int(time.time())))
+            .values(warned_30_days=True)
+            .returning(Users.discord_id)
+            .execution_options(synchronize_session=False)
+        )
+        discord_ids = list(result.scalars())
+        await session.commit()
+        return discord_ids
 
 
 # Fixed function: Get users with expired subscriptions (40 days)
@@ -218,35 +456,72 @@ async def select_all_users_with_expired_subs() -> list[Users]:
         return result.scalars().all()
 
 
-# New function: Mark user as warned
-async def mark_user_as_warned(discord_id: int):
-    """Mark user as having received a 30-day warning"""
+async def select_expired_users_batch(after_id: int, limit: int):
+    """
+    Next `limit` users (by id, after `after_id`) whose last payment is 40+ days old.
+    Rows carry id, discord_id, last_date_of_payment and date_of_payment.
+    """
+    expiry_threshold = int(time.time()) - (40 * 86400)
+
     async with async_session() as session:
         result = await session.execute(
-            select(Users).where(Users.discord_id == discord_id)
+            select(Users.id, Users.discord_id, Users.last_date_of_payment, Users.date_of_payment)
+            .where(
+                Users.last_date_of_payment < expiry_threshold,
+                Users.discord_id.isnot(None),
+                Users.id > after_id
+            )
+            .order_by(Users.id)
+            .limit(limit)
         )
-        user = result.scalar_one_or_none()
-        if user:
-            # You might want to add a 'warned' field to your Users model
-            # For now, we'll use a different approach in the scheduler
-            await session.commit()
-            return True
-        return False
+        return result.all()
+
+
+async def get_job_cursor(name: str):
+    """Saved position of an unfinished job run, or None"""
+    async with async_session() as session:
+        result = await session.execute(select(JobCursors.position).where(JobCursors.name == name))
+        return result.scalar_one_or_none()
+
+
+async def set_job_cursor(name: str, position: int):
+    async with async_session() as session:
+        await session.merge(JobCursors(name=name, position=position, updated_at=int(time.time())))
+        await session.commit()
+
+
+async def clear_job_cursor(name: str):
+    async with async_session() as session:
+        await session.execute(delete(JobCursors).where(JobCursors.name == name))
+        await session.commit()
+
+
+async def unmark_users_as_warned(discord_ids) -> int:
+    """Clear warned_30_days again, e.g. for claimed users whose warning DM could not be sent"""
+    if not discord_ids:
+        return 0
+    async with async_session() as session:
+        result = await session.execute(
+            update(Users)
+            .where(Users.discord_id.in_(discord_ids))
+            .values(warned_30_days=False)
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+        return result.rowcount
 
 
-async def update_user_last_payment_date(user_email, new_date):
+async def update_user_last_payment_date(user_email, new_date) -> int:
     """Update user's last payment date when they make a payment"""
     async with async_session() as session:
-        async with session.begin():
-            result = await session.execute(
-                select(Users).where(Users.email == user_email)
-            )
-            user = result.scalar_one_or_none()
-            if user:
-                user.last_date_of_payment = new_date
-                await session.commit()
-                return True
-            return False
+        result = await session.execute(
+            update(Users)
+            .where(Users.email == user_email)
+            .values(last_date_of_payment=new_date)
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+        return result.rowcount
 
 
 # New function: Get user by Discord ID
@@ -256,4 +531,77 @@ async def get_user_by_discord_id(discord_id: int) -> Users:
         result = await session.execute(
             select(Users).where(Users.discord_id == discord_id)
         )
-        return result.scalar_one_or_none()
\ No newline at end of file
+        return result.scalar_one_or_none()
+
+
+async def add_pooled_invite(code: str, url: str, expires_at: int = None):
+    async with async_session() as session:
+        session.add(PooledInvites(code=code, url=url, expires_at=expires_at, created_at=int(time.time())))
+        await session.commit()
+
+
+async def select_pooled_invites() -> list:
+    """(code, url, expires_at) of pooled invites not yet given to an order, oldest first"""
+    async with async_session() as session:
+        result = await session.execute(
+            select(PooledInvites.code, PooledInvites.url, PooledInvites.expires_at)
+            # an invite popped right before a crash is already on an order but may still have a row
+            .where(~select(Orders.id).where(Orders.link == PooledInvites.url).exists())
+            .order_by(PooledInvites.created_at)
+        )
+        return result.all()
+
+
+async def delete_pooled_invites(codes) -> int:
+    if not codes:
+        return 0
+    async with async_session() as session:
+        result = await session.execute(delete(PooledInvites).where(PooledInvites.code.in_(codes)))
+        await session.commit()
+        return result.rowcount
+
+
+def _pending_join_dict(row) -> dict:
+    return {"discord_id": row.discord_id, "discord_name": row.discord_name,
+            "discord_server_name": row.discord_server_name, "joined_at": row.joined_at,
+            "batch": row.batch, "candidates": row.candidates.split() if row.candidates else []}
+
+
+async def add_pending_join(discord_id, discord_name, discord_server_name, joined_at, batch, candidates):
+    async with async_session() as session:
+        await session.merge(PendingJoins(discord_id=discord_id, discord_name=discord_name,
+                                         discord_server_name=discord_server_name, joined_at=joined_at,
+                                         batch=batch, candidates=" ".join(candidates)))
+        await session.commit()
+
+
+async def select_pending_joins() -> list:
+    """Pending joins as dicts, oldest first"""
+    async with async_session() as session:
+        result = await session.execute(select(PendingJoins).order_by(PendingJoins.joined_at))
+        return [_pending_join_dict(row) for row in result.scalars()]
+
+
+async def claim_pending_join(discord_id, link):
+    """
+    Take a pending join off the list as resolved to `link`, in one transaction: one use of
+    `link` is removed from the candidates of the rest of its batch. Returns (the join, the
+    rest of the batch) as dicts, or None if it is not pending (any more).
+    """
+    async with async_session() as session:
+        async with session.begin():
+            result = await session.execute(
+                delete(PendingJoins).where(PendingJoins.discord_id == discord_id).returning(PendingJoins)
+            )
+            join = result.scalar_one_or_none()
+            if join is None:
+                return None
+            rest = (await session.execute(
+                select(PendingJoins).where(PendingJoins.batch == join.batch).with_for_update()
+            )).scalars().all()
+            for other in rest:
+                candidates = other.candidates.split()
+                if link in candidates:
+                    candidates.remove(link)
+                    other.candidates = " ".join(candidates)
+            return _pending_join_dict(join), [_pending_join_dict(other) for other in rest]
@@ -43,19 +43,6 @@ def check_config():
         print(f"❌ Configuration error: {e}")
         return False
 
-def start_scheduler():
-    """Start the scheduler service"""
-    try:
-        from scheduler import run_scheduler
-        print("🕐 Starting scheduler service...")
-        scheduler_thread = run_scheduler()
-        time.sleep(1)
-        print("✓ Scheduler service started")
-        return scheduler_thread
-    except Exception as e:
-        print(f"❌ Failed to start scheduler: {e}")
-        return None
-
 def start_mail_service():
     """Start the mail service"""
     try:
@@ -79,36 +66,12 @@ def start_mail_service():
         print(f"❌ Failed to start mail service: {e}")
         return None
 
-def start_discord_bot():
-    """Start the main Discord bot"""
+def start_web_app():
+    """Start the web application (ASGI) together with the gateway bot on one event loop"""
     try:
-        from discord_bot import bot, bot_token
+        from app_main import run_bot_and_web, WEB_BIND
         
-        def run_bot():
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            try:
-                bot.run(bot_token)
-            except Exception as e:
-                print(f"❌ Discord bot error: {e}")
-        
-        print("🤖 Starting Discord bot...")
-        bot_thread = threading.Thread(target=run_bot, daemon=True)
-        bot_thread.start()
-        time.sleep(2)
-        print("✓ Discord bot started")
-        return bot_thread
-    except Exception as e:
-        print(f"❌ Failed to start Discord bot: {e}")
-        return None
-
-def start_flask_app():
-    """Start the Flask web application"""
-    try:
-        from flask import Flask
-        from app_main import app
-        
-        print("🌐 Starting Flask web application...")
+        print("🌐 Starting web application and Discord gateway...")
         print("   - Payment processing endpoint")
         print("   - Webhook handlers")
         print("   - Web interface")
@@ -119,16 +82,16 @@ def start_flask_app():
         print("✓ Scheduler: Managing user subscriptions and warnings")
         print("✓ Mail Service: Sending payment confirmation emails")
         print("✓ Discord Bot: Handling invites and user management")
-        print("✓ Flask App: Processing payments and webhooks")
+        print("✓ Web App: Processing payments and webhooks")
         print("=" * 60)
-        print(f"Web interface available at: http://localhost:5000")
+        print(f"Web interface available at: http://{WEB_BIND}")
         print("Press Ctrl+C to stop all services")
         print("=" * 60)
         
-        app.run(debug=False, use_reloader=False, host='0.0.0.0', port=5000)
+        asyncio.run(run_bot_and_web())
         
     except Exception as e:
-        print(f"❌ Failed to start Flask app: {e}")
+        print(f"❌ Failed to start web app: {e}")
         return False
 
 def main():
@@ -145,29 +108,20 @@ def main():
     # Start services in order
     services = []
     
-    # 1. Scheduler (subscription management)
-    scheduler_thread = start_scheduler()
-    if scheduler_thread:
-        services.append(("Scheduler", scheduler_thread))
-    
-    # 2. Mail service (email notifications)
+    # 1. Mail service (email notifications)
     mail_thread = start_mail_service()
     if mail_thread:
         services.append(("Mail Service", mail_thread))
     
-    # 3. Discord bot (user management)
-    bot_thread = start_discord_bot()
-    if bot_thread:
-        services.append(("Discord Bot", bot_thread))
-    
     # Small delay for all services to initialize
     print("⏳ Waiting for services to initialize...")
     time.sleep(3)
     print()
     
-    # 4. Flask app (web interface) - runs in main thread
+    # 2. Web app and the single Discord gateway connection (invites, join tracking,
+    #    warnings, kicks) - runs in main thread
     try:
-        start_flask_app()
+        start_web_app()
     except KeyboardInterrupt:
         print("\n" + "=" * 60)
         print("🛑 Shutdown signal received...")
@@ -1,13 +1,76 @@
-import requests
+import asyncio
 import hashlib
 import hmac
 import json
+import threading
 from random import randint
 import time
 
+import aiohttp
+
 
 API_URL = 'https://api.wayforpay.com/api'
 
+DEFAULT_TIMEOUT = 10            # seconds for a whole API call
+DEFAULT_CONNECT_TIMEOUT = 5     # seconds for TCP+TLS setup
+DEFAULT_MAX_CONNECTIONS = 10    # keep-alive connections held open to the API
+DEFAULT_MAX_CONCURRENCY = 10    # API calls allowed in flight at once
+DEFAULT_KEEPALIVE_TIMEOUT = 60  # seconds an idle connection stays in the pool
+PING_ORDER_REFERENCE = "HEALTHCHECK"  # looked up by ping(), never invoiced
+
+
+def new_order_reference():
+    """Reference for a new invoice; callers may pick it up front to store the order before the invoice exists"""
+    return f"DH{randint(1000000000, 9999999999)}"
+
+
+class InvoicePlan:
+    """
+    One subscription tier: what is sold, how often it recurs and how many days of access
+    each payment buys (sub_time, stored with the order).
+
+    The parts of the CREATE_INVOICE signature string and request body that only depend
+    on the plan ("amount;currency;names;counts;prices" and the product/regular fields)
+    are built once here, so an invoice only adds the merchant, reference and date.
+    """
+
+    __slots__ = ("name", "amount", "currency", "regular_mode", "regular_count",
+                 "product_names", "product_prices", "product_counts", "sub_time", "signature_tail", "static_params")
+
+    def __init__(self, name, amount, currency, regular_mode, regular_count,
+                 product_names, product_prices=None, product_counts=None, sub_time=None):
+        self.name = name
+        self.amount = amount
+        self.currency = currency
+        self.regular_mode = regular_mode
+        self.regular_count = regular_count
+        self.product_names = list(product_names)
+        self.product_prices = list(product_prices if product_prices is not None else [amount])
+        self.product_counts = list(product_counts if product_counts is not None else [1] * len(self.product_names))
+        self.sub_time = sub_time
+
+        self.signature_tail = ';'.join([
+            str(amount), currency,
+            ';'.join(map(str, self.product_names)),
+            ';'.join(map(str, self.product_counts)),
+            ';'.join(map(str, self.product_prices)),
+        ])
+        self.static_params = {
+            "amount": amount,
+            "currency": currency,
+            "productName": self.product_names,
+            "productPrice": self.product_prices,
+            "productCount": self.product_counts,
+            "requiredRectoken": 1,
+            "allowRegular": True,
+            "regularMode": regular_mode,
+            "regularCount": regular_count,
+            "regularBehavior": "preset"
+        }
+
+    def __repr__(self):
+        return f"InvoicePlan({self.name!r}, {self.amount} {self.currency}, {self.regular_mode} x{self.regular_count}, {self.sub_time} days)"
+
 
 class InvoiceCreateResult:
     def __init__(self, invoice_url, reason, reason_code, qr_code, orderReference):
@@ -47,85 +110,95 @@ class InvoiceStatusResult:
         return self.__dict__
 
 
-class WayForPay:
-    def __init__(self, key, domain_name):
-        self.__key = key
-        self.__domain_name = domain_name
-    def hash_md5(self, string):
-        hash_result = hmac.new(
-            self.__key.encode('utf-8'),
-            string.encode('utf-8'),
-            hashlib.md5
-        ).hexdigest()
-
-        return hash_result
-
-    def create_invoice(self, merchantAccount, merchantAuthType, amount, currency, *args, **kwargs):
-        orderReference = f"DH{randint(1000000000, 9999999999)}"
-        orderDate = int(time.time())
-        productNames = kwargs.get('productNames', [])
-        productPrices = kwargs.get('productPrices', [])
-        productCounts = kwargs.get('productCounts', [])
+class AsyncWayForPay:
+    """
+    WayForPay API client for use inside an event loop.
 
-        product_names_data = ';'.join(map(str, productNames))
-        product_counts_data = ';'.join(map(str, productCounts))
-        product_prices_data = ';'.join(map(str, productPrices))
+    All calls go through one aiohttp session, so the TCP+TLS connection to the API is
+    kept alive and reused between invoices. The session is created on first use and
+    belongs to the loop that made that call; call close() on the same loop when done.
+    """
 
-        string = f'{merchantAccount};{self.__domain_name};{orderReference};{orderDate};{amount};{currency};{product_names_data};{product_counts_data};{product_prices_data}'
+    def __init__(self, key, domain_name, api_url=API_URL, timeout=DEFAULT_TIMEOUT,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT):
+        self.__key = key
+        self.__domain_name = domain_name
+        self.api_url = api_url
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self.max_connections = max_connections
+        self.max_concurrency = max_concurrency
+        self.keepalive_timeout = keepalive_timeout
+        self._session = None
+        self._semaphore = None
+        # keyed once; signing copies it instead of re-deriving the HMAC key pads every time
+        self._hmac = hmac.new(key.encode('utf-8'), digestmod=hashlib.md5)
+        self._invoice_prefix = None  # "merchantAccount;domain;" for the last merchant used
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
 
+    def hash_md5(self, string):
+        signer = self._hmac.copy()
+        signer.update(string.encode('utf-8'))
+        return signer.hexdigest()
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def ping(self, merchantAccount, orderReference=PING_ORDER_REFERENCE):
+        """
+        CHECK_STATUS round trip for a reference that is never invoiced, returns (http status, seconds).
+
+        The API only answers POST, so a HEAD gets 405 even when it is up; a status lookup is
+        read-only and a healthy API answers it with 200 ("Order not found"). The connection
+        is left in the keep-alive pool, so the next invoice goes out without the handshake.
+        """
         params = {
-            "transactionType": "CREATE_INVOICE",
+            "transactionType": "CHECK_STATUS",
             "merchantSecretKey": self.__key,
             "merchantAccount": merchantAccount,
-            "merchantAuthType": merchantAuthType,
-            "merchantDomainName": self.__domain_name,
-            "merchantSignature": self.hash_md5(string),
-            "apiVersion": "1",
             "orderReference": orderReference,
-            "orderDate": orderDate,
-            "amount": amount,
-            "currency": currency,
-            "productName": productNames,
-            "productPrice": productPrices,
-            "productCount": productCounts,
-            "requiredRectoken": 1,
-            "allowRegular": True,
-            "regularMode": "monthly", 
-            "regularCount": 60,              # TODO change this
-            "regularBehavior": "preset"
+            "merchantSignature": self.hash_md5(f"{merchantAccount};{orderReference}"),
+            "apiVersion": '1'
         }
-
-        try:
-            result = requests.post(url=API_URL, json=params)
-            response_dict = json.loads(result.text)
-            print("Response from WayForPay:", response_dict)
-
-            if "invoiceUrl" not in response_dict:
-                print("Error creating transaction. Reason:", response_dict.get("reason"),
-                      "Code:", response_dict.get("reasonCode"))
-                return False
-
-            invoice_url = response_dict["invoiceUrl"]
-
-            return InvoiceCreateResult(invoice_url, response_dict.get("reason"), response_dict.get("reasonCode"),
-                                       response_dict.get("qrCode"), orderReference)
-
-        except Exception as e:
-            print(f'Error: {e}')
-            return False
-
-    def create_yearly_invoice(self, merchantAccount, merchantAuthType, amount, currency, *args, **kwargs):
-        orderReference = f"DH{randint(1000000000, 9999999999)}"
-        orderDate = int(time.time())
-        productNames = kwargs.get('productNames', [])
-        productPrices = kwargs.get('productPrices', [])
-        productCounts = kwargs.get('productCounts', [])
-
-        product_names_data = ';'.join(map(str, productNames))
-        product_counts_data = ';'.join(map(str, productCounts))
-        product_prices_data = ';'.join(map(str, productPrices))
-
-        string = f'{merchantAccount};{self.__domain_name};{orderReference};{orderDate};{amount};{currency};{product_names_data};{product_counts_data};{product_prices_data}'
+        session = self._get_session()
+        start = time.perf_counter()
+        async with self._semaphore:
+            # the body isn't decoded, an error page still reports its status
+            async with session.post(self.api_url, json=params) as result:
+                await result.read()
+                return result.status, time.perf_counter() - start
+
+    async def _post(self, params):
+        """POST params to the API, returns (http status, decoded json body)"""
+        session = self._get_session()
+        async with self._semaphore:
+            async with session.post(self.api_url, json=params) as result:
+                # WayForPay does not always send a json content type, so decode the text ourselves
+                return result.status, json.loads(await result.text())
+
+    def build_invoice_params(self, merchantAccount, merchantAuthType, plan, orderReference=None, orderDate=None):
+        """CREATE_INVOICE request body for `plan`; the same builder serves every plan"""
+        orderReference = orderReference or new_order_reference()
+        orderDate = orderDate or int(time.time())
+
+        prefix = self._invoice_prefix
+        if prefix is None or prefix[0] != merchantAccount:
+            prefix = self._invoice_prefix = (merchantAccount, f"{merchantAccount};{self.__domain_name};")
+        string = f"{prefix[1]}{orderReference};{orderDate};{plan.signature_tail}"
 
         params = {
             "transactionType": "CREATE_INVOICE",
@@ -137,21 +210,16 @@ class WayForPay:
             "apiVersion": "1",
             "orderReference": orderReference,
             "orderDate": orderDate,
-            "amount": amount,
-            "currency": currency,
-            "productName": productNames,
-            "productPrice": productPrices,
-            "productCount": productCounts,
-            "requiredRectoken": 1,
-            "allowRegular": True,
-            "regularMode": "yearly", 
-            "regularCount": 5,              # TODO change this
-            "regularBehavior": "preset"
         }
+        params.update(plan.static_params)
+        return params
+
+    async def create_plan_invoice(self, merchantAccount, merchantAuthType, plan, orderReference=None):
+        params = self.build_invoice_params(merchantAccount, merchantAuthType, plan, orderReference)
+        orderReference = params["orderReference"]
 
         try:
-            result = requests.post(url=API_URL, json=params)
-            response_dict = json.loads(result.text)
+            _, response_dict = await self._post(params)
             print("Response from WayForPay:", response_dict)
 
             if "invoiceUrl" not in response_dict:
@@ -165,10 +233,32 @@ class WayForPay:
                                        response_dict.get("qrCode"), orderReference)
 
         except Exception as e:
-            print(f'Error: {e}')
+            print(f'Error: {e!r}')
             return False
 
-    def check_invoice(self, merchantAccount, orderReference):
+    async def _create_invoice(self, merchantAccount, merchantAuthType, amount, currency, regularMode, regularCount, **kwargs):
+        # ad-hoc plan for callers that pass the products themselves
+        plan = InvoicePlan(regularMode, amount, currency, regularMode, regularCount,
+                           kwargs.get('productNames', []), kwargs.get('productPrices', []),
+                           kwargs.get('productCounts', []))
+        return await self.create_plan_invoice(merchantAccount, merchantAuthType, plan, kwargs.get('orderReference'))
+
+    async def _create_default_plan_invoice(self, plan_name, merchantAccount, merchantAuthType, amount, currency, **kwargs):
+        from plans import DEFAULT_PLANS  # plans builds its InvoicePlans with this module
+
+        _, regular_mode, regular_count, _ = DEFAULT_PLANS[plan_name]
+        return await self._create_invoice(merchantAccount, merchantAuthType, amount, currency,
+                                          regularMode=regular_mode, regularCount=regular_count, **kwargs)
+
+    async def create_invoice(self, merchantAccount, merchantAuthType, amount, currency, *args, **kwargs):
+        return await self._create_default_plan_invoice("monthly", merchantAccount, merchantAuthType, amount, currency,
+                                                       **kwargs)
+
+    async def create_yearly_invoice(self, merchantAccount, merchantAuthType, amount, currency, *args, **kwargs):
+        return await self._create_default_plan_invoice("yearly", merchantAccount, merchantAuthType, amount, currency,
+                                                       **kwargs)
+
+    async def check_invoice(self, merchantAccount, orderReference):
         apiVersion = '1'
         string = f"{merchantAccount};{orderReference}"
 
@@ -182,10 +272,9 @@ class WayForPay:
         }
 
         try:
-            result = requests.post(url=API_URL, json=params)
+            status, response_dict = await self._post(params)
 
-            if result.status_code == 200:
-                response_dict = json.loads(result.text)
+            if status == 200:
                 reason = response_dict["reason"]
                 reasonCode = response_dict.get("reasonCode", None)
                 orderReference = response_dict.get("orderReference", None)
@@ -208,10 +297,10 @@ class WayForPay:
                 return InvoiceStatusResult(response_dict, reason, reasonCode, orderReference, amount, currency, authCode, createdDate, processingDate, cardPan, cardType, issuerBankCountry, issuerBankName, transactionStatus, refundAmount, settlementDate, settlementAmount, fee, merchantSignature)
 
         except Exception as e:
-            print(f'Error: {e}')
+            print(f'Error: {e!r}')
             return None
 
-    def delete_invoice(self, merchantAccount, orderReference):
+    async def delete_invoice(self, merchantAccount, orderReference):
         try:
             apiVersion = '1'
             string = f"{merchantAccount};{orderReference}"
@@ -223,15 +312,76 @@ class WayForPay:
                 "merchantSignature": self.hash_md5(string),
                 "apiVersion": apiVersion
             }
-            result = requests.post(url=API_URL, json=params)
+            status, _ = await self._post(params)
 
-            if result.status_code == 200:
+            if status == 200:
                 return True
 
         except Exception as e:
-            print(f'Error: {e}')
+            print(f'Error: {e!r}')
             return None
 
+
+def accept_response(key, order_reference):
+    """
+    Signed answer to a serviceUrl callback. WayForPay keeps retrying a callback until it
+    gets this back; the signature is HMAC-MD5 of "orderReference;accept;time".
+    """
+    now = int(time.time())
+    signature = hmac.new(key.encode('utf-8'), f"{order_reference};accept;{now}".encode('utf-8'), hashlib.md5).hexdigest()
+    return {"orderReference": order_reference, "status": "accept", "time": now, "signature": signature}
+
+
+_background_loop = None
+_background_loop_lock = threading.Lock()
+
+
+def get_background_loop():
+    """Event loop on a daemon thread that runs WayForPay calls for synchronous callers"""
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="wayforpay-client", daemon=True).start()
+            _background_loop = loop
+        return _background_loop
+
+
+class WayForPay:
+    """
+    Blocking facade over AsyncWayForPay for code that is not running in an event loop.
+
+    Calls are executed on a shared background loop, so every WayForPay instance in the
+    process keeps its connection pool warm between calls instead of reconnecting.
+    """
+
+    def __init__(self, key, domain_name, **client_options):
+        self._client = AsyncWayForPay(key, domain_name, **client_options)
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, get_background_loop()).result()
+
+    def hash_md5(self, string):
+        return self._client.hash_md5(string)
+
+    def create_invoice(self, merchantAccount, merchantAuthType, amount, currency, *args, **kwargs):
+        return self._run(self._client.create_invoice(merchantAccount, merchantAuthType, amount, currency, *args, **kwargs))
+
+    def create_yearly_invoice(self, merchantAccount, merchantAuthType, amount, currency, *args, **kwargs):
+        return self._run(self._client.create_yearly_invoice(merchantAccount, merchantAuthType, amount, currency, *args, **kwargs))
+
+    def create_plan_invoice(self, merchantAccount, merchantAuthType, plan, orderReference=None):
+        return self._run(self._client.create_plan_invoice(merchantAccount, merchantAuthType, plan, orderReference))
+
+    def check_invoice(self, merchantAccount, orderReference):
+        return self._run(self._client.check_invoice(merchantAccount, orderReference))
+
+    def delete_invoice(self, merchantAccount, orderReference):
+        return self._run(self._client.delete_invoice(merchantAccount, orderReference))
+
+    def close(self):
+        self._run(self._client.close())
+
     # def create_regular_payment(self, merchantAccount, merchantAuthType, amount, currency, recToken, *args, **kwargs):
     #     try:
     #         orderReference = f"DH{randint(1000000000, 9999999999)}"